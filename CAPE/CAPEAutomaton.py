@@ -1,5 +1,7 @@
 from Event import *
 from Agent import *
+from Grid import *
+from Neighbourhood import *
 import numpy as np
 import itertools
 import math
@@ -11,7 +13,8 @@ import csv
 class Automaton:
 
     def __init__(self, shape, attributes, formats, time_parameters, model_parameters, output_location, values_to_record,
-                 attribute_grids_to_record, initialisation, numpy_seed = None, debug = False):
+                 attribute_grids_to_record, initialisation, numpy_seed = None, debug = False,
+                 static_attributes=None, double_buffer=False):
         """
         Hybrid cellular automaton and agent-based model.
         :param shape: Shape of cellular grid (lattice)
@@ -25,6 +28,11 @@ class Automaton:
         :param initialisation: Dictionary of objects/values to be assigned to attributes at beginning of run
         :param numpy_seed: Optional seed for remove randomness - if None, random, else numpy is seeded to give same
                outcome each time
+        :param static_attributes: Attributes which are not updated by the cellular automaton. With double buffering
+               these are stored once and shared by the grid and work grid
+        :param double_buffer: If True, the work grid is not copied to the grid at the end of each step. Instead
+               non-static numeric attributes swap between the two grids (update_cells must then write every cell of
+               them) and object attributes have only the cells changed by events carried across
         """
 
         self.debug = debug
@@ -64,8 +72,8 @@ class Automaton:
         self.time_step = time_parameters['time_step']
         assert ('time_limit' in time_parameters.keys()), "Time parameter 'time_limit' must be defined"
         self.time_limit = time_parameters['time_limit'] / self.time_step
-        # Create the grids
-        self.grid = np.zeros(shape, dtype={'names':attributes, 'formats':formats})
+        # Create the grids (one contiguous array per attribute)
+        self.grid = Grid(shape, attributes, formats)
         # List of agents TODO - may be redundant
         self.agents = []
         # Grid initialisation
@@ -75,11 +83,21 @@ class Automaton:
             values = initialisation[attribute]
             # Set the required values. If it's an agent, add it to the list
             for address in values:
-                self.grid[address][attribute] = values[address]
+                self.grid[attribute][address] = values[address]
                 if isinstance(values[address], Agent):
                     self.agents.append(values[address])
 
-        self.work_grid = self.grid.copy()
+        self.double_buffer = double_buffer
+        if static_attributes is None:
+            static_attributes = []
+        for attribute in static_attributes:
+            assert attribute in self.attributes, "Invalid static attribute: {0} is not in attribute list"\
+                .format(attribute)
+        self.static_attributes = static_attributes
+        if self.double_buffer:
+            self.work_grid = self.grid.copy(shared=self.static_attributes)
+        else:
+            self.work_grid = self.grid.copy()
 
         # NEIGHBOURHOODS
         # Builds dictionaries of neighbour cells for use with neighbour functions
@@ -111,6 +129,17 @@ class Automaton:
                         break
             self.moore_relative[depth] = reduced_row_moore
 
+        # Neighbours of every cell for each type and depth, built once from the relative tables above, and the address
+        # of each cell by flat index
+        self.neighbour_tables = {'moore': dict(), 'von_neumann': dict()}
+        for depth in range(1, self.max_depth + 1):
+            self.neighbour_tables['moore'][depth] = NeighbourTable(self.grid.shape, self.moore_relative[depth])
+            self.neighbour_tables['von_neumann'][depth] = NeighbourTable(self.grid.shape,
+                                                                         self.von_neumann_relative[depth])
+        self.cell_addresses = np.empty(int(np.prod(self.grid.shape)), dtype=object)
+        for index, address in enumerate(itertools.product(*[range(size) for size in self.grid.shape])):
+            self.cell_addresses[index] = address
+
         # Event lists
         self.potential_events = []
         self.acceptable_events = []
@@ -155,11 +184,34 @@ class Automaton:
             self.perform_events()
 
             # Set the main grid
-            self.grid = self.work_grid.copy()
+            if self.double_buffer:
+                self.swap_grids()
+            else:
+                self.grid = self.work_grid.copy()
 
             # Record if necessary
             self.record()
 
+    def swap_grids(self):
+        """
+        Double-buffered replacement for copying the work grid to the grid. Static attributes are shared so need
+        nothing, other numeric attributes swap arrays between the grids, and for object attributes only the cells
+        written to in the work grid this step are copied to the grid
+        :return:
+        """
+        for attribute in self.attributes:
+            if attribute in self.static_attributes:
+                continue
+            if self.grid[attribute].dtype == object:
+                grid_values = self.grid[attribute]
+                work_grid_values = self.work_grid[attribute]
+                for address in self.work_grid.changed:
+                    grid_values[address] = work_grid_values[address]
+            else:
+                self.grid.fields[attribute], self.work_grid.fields[attribute] = \
+                    self.work_grid.fields[attribute], self.grid.fields[attribute]
+        self.work_grid.changed.clear()
+
     def record(self):
         # Recording
         if self.time % self.time_parameters['interval_to_record_grid'] == 0:
@@ -208,20 +260,56 @@ class Automaton:
         :return:
         """
         neighbours = {}
-        # Check type
-        if type == 'moore':
-            relative_addresses = self.moore_relative[depth]
-        elif type == 'von_neumann':
-            relative_addresses = self.von_neumann_relative[depth]
-        else:
-            raise Exception, "Invalid neighbourhood type"
-        # For each relative address, apply the coordinates to address to get new addresses
-        for n in relative_addresses:
-            neighbour_address = tuple([address[i] + n[i] for i in range(len(address))])
-            if self.is_on_grid(neighbour_address):
-                neighbours[neighbour_address] = self.grid[neighbour_address]
+        for neighbour_address in self.cell_addresses[self.neighbour_indices(address, depth, type)]:
+            neighbours[neighbour_address] = self.grid[neighbour_address]
         return neighbours
 
+    def neighbour_indices(self, address, depth, type='moore'):
+        """
+        Flat indices of the neighbours of an address, in the same order as the dict given by neighbours. The array is
+        a view of the neighbour table, so must not be written to (copy it first to shuffle it)
+        :param address: The address which requires neighbours
+        :param depth: The depth to search for
+        :param type: The type of neighbourhood (moore or von_neumann)
+        :return:
+        """
+        if type not in self.neighbour_tables:
+            raise Exception, "Invalid neighbourhood type"
+        table = self.neighbour_tables[type][depth]
+        return table.neighbours(table.flat_index(address))
+
+    def gather_neighbour_indices(self, addresses, depth, type='moore'):
+        """
+        Flat indices of the neighbours of many addresses in one call
+        :param addresses: List of addresses which require neighbours
+        :param depth: The depth to search for
+        :param type: The type of neighbourhood (moore or von_neumann)
+        :return: Neighbours of all the addresses, one address after another (each in the order of neighbour_indices),
+                 and offsets - the neighbours of the i-th address are at offsets[i]:offsets[i + 1]
+        """
+        if type not in self.neighbour_tables:
+            raise Exception, "Invalid neighbourhood type"
+        table = self.neighbour_tables[type][depth]
+        return table.gather(table.flat_indices(addresses))
+
+    def flat_indices(self, addresses):
+        """
+        Flat indices of addresses on the grid
+        :param addresses: List of addresses
+        :return: Array of flat indices
+        """
+        return self.neighbour_tables['moore'][1].flat_indices(addresses)
+
+    def addresses_of(self, indices):
+        """
+        Addresses of cells given by flat index
+        :param indices: Flat indices (array) or a single flat index
+        :return: List of addresses, or a single address
+        """
+        if np.isscalar(indices):
+            return self.cell_addresses[indices]
+        return self.cell_addresses[indices].tolist()
+
     def moore_neighbours(self, address, depth):
         """
         Get all moore neighbours (N, E, S, W, NE, NW, SE, SW) to a given address
@@ -240,6 +328,49 @@ class Automaton:
         """
         return self.neighbours(address, depth, 'von_neumann')
 
+    def box_sum(self, values, radius):
+        """
+        For each cell, the sum of values over all cells within a Chebyshev distance (the cell and its Moore
+        neighbours up to depth radius), using a summed-area table. Cells off the grid count as zero
+        :param values: Array of grid shape
+        :param radius: Chebyshev distance
+        :return: Array of grid shape
+        """
+        width = 2 * radius + 1
+        table = np.zeros((values.shape[0] + width, values.shape[1] + width), dtype=values.dtype)
+        table[radius + 1:radius + 1 + values.shape[0], radius + 1:radius + 1 + values.shape[1]] = values
+        table = table.cumsum(0).cumsum(1)
+        return table[width:, width:] - table[:-width, width:] - table[width:, :-width] + table[:-width, :-width]
+
+    def nearest_depths(self, mask, type='moore'):
+        """
+        For each cell, the depth of the nearest cell in a mask - the lowest depth at which the neighbours of the given
+        type include a cell of the mask (0 for cells in the mask), found by growing the mask one depth at a time.
+        max_depth + 1 where there is none within max_depth
+        :param mask: Boolean array of grid shape
+        :param type: The type of neighbourhood (moore or von_neumann)
+        :return: Integer array of grid shape
+        """
+        if type == 'moore':
+            relative_addresses = self.moore_relative[1]
+        elif type == 'von_neumann':
+            relative_addresses = self.von_neumann_relative[1]
+        else:
+            raise Exception, "Invalid neighbourhood type"
+        depths = np.full(mask.shape, self.max_depth + 1, dtype=int)
+        depths[mask] = 0
+        reached = np.asarray(mask, dtype=bool)
+        padded = np.zeros((mask.shape[0] + 2, mask.shape[1] + 2), dtype=bool)
+        for depth in range(1, self.max_depth + 1):
+            padded[1:-1, 1:-1] = reached
+            grown = reached.copy()
+            for relative_address in relative_addresses:
+                grown |= padded[1 + relative_address[0]:1 + relative_address[0] + mask.shape[0],
+                                1 + relative_address[1]:1 + relative_address[1] + mask.shape[1]]
+            depths[grown & ~reached] = depth
+            reached = grown
+        return depths
+
     def record_grids(self):
         """
         Write the contents of the grid to the output file (based on specified agent codes)
@@ -272,13 +403,22 @@ class Automaton:
         Can be overridden if a different resolution method is required (e.g. using a priority system)
         :return:
         """
-        processed_addresses = []
+        return self.resolve_events(self.potential_events, set())
+
+    def resolve_events(self, events, processed_addresses):
+        """
+        Picks events in random order, discarding any with a dependent address that has already been processed (by an
+        earlier event, or given as processed). The list of events is emptied
+        :param events: List of potential events
+        :param processed_addresses: Set of addresses already processed, added to as events are accepted
+        :return: Acceptable events
+        """
         acceptable_events = []
 
-        np.random.shuffle(self.potential_events)
+        np.random.shuffle(events)
 
-        while len(self.potential_events) > 0:
-            event = self.potential_events.pop()
+        while len(events) > 0:
+            event = events.pop()
             acceptable = True
 
             for address in event.dependent_addresses:
@@ -292,7 +432,7 @@ class Automaton:
                 for address in event.impacted_addresses:
                     if address not in processed_addresses:
                         amended_impacted_addresses.append(address)
-                        processed_addresses.append(address)
+                        processed_addresses.add(address)
                 event.impacted_addresses = amended_impacted_addresses
                 acceptable_events.append(event)
 
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class Grid:
+
+    def __init__(self, shape, attributes, formats):
+        """
+        Lattice of cells, stored as a structure of arrays. Each attribute is held in its own contiguous array, so
+        whole-field operations (slicing, reductions) run over contiguous memory rather than strided records.
+        :param shape: Shape of the grid
+        :param attributes: Attributes of cells in grid
+        :param formats: Formats of attributes (int, float, object, etc.)
+        """
+        self.shape = tuple(shape)
+        self.attributes = list(attributes)
+        self.formats = list(formats)
+        self.fields = dict()
+        for attribute, format in zip(self.attributes, self.formats):
+            self.fields[attribute] = np.zeros(self.shape, dtype=format)
+        # Addresses written to through cells (used to carry object attributes across when double buffering)
+        self.changed = set()
+
+    def __getitem__(self, key):
+        """
+        grid['attribute'] gives the array for that attribute, grid[address] gives the cell at that address
+        :param key: Attribute name or address
+        :return:
+        """
+        if isinstance(key, basestring):
+            return self.fields[key]
+        return Cell(self, key)
+
+    def __setitem__(self, attribute, values):
+        """
+        Set the values of an attribute. Values are written into the existing array (not rebound), so any other
+        references to the array see the new values
+        :param attribute: Attribute name
+        :param values: Single value or array of grid shape
+        :return:
+        """
+        self.fields[attribute][...] = values
+
+    def values(self, attribute, indices):
+        """
+        Values of an attribute at a set of cells
+        :param attribute: Attribute name
+        :param indices: Flat indices of the cells
+        :return: Array of the values (a copy)
+        """
+        return self.fields[attribute].ravel()[indices]
+
+    def copy(self, shared=None):
+        """
+        Copy of the grid, with copies of every attribute array
+        :param shared: Attributes whose arrays are not copied - the new grid refers to the same array as this grid
+        :return:
+        """
+        if shared is None:
+            shared = []
+        grid = Grid(self.shape, [], [])
+        grid.attributes = list(self.attributes)
+        grid.formats = list(self.formats)
+        for attribute in self.fields:
+            if attribute in shared:
+                grid.fields[attribute] = self.fields[attribute]
+            else:
+                grid.fields[attribute] = self.fields[attribute].copy()
+        return grid
+
+
+class Cell:
+
+    def __init__(self, grid, address):
+        """
+        A single cell of a grid. Reads and writes go straight to the attribute arrays of the grid
+        :param grid: Grid the cell belongs to
+        :param address: Address of the cell
+        """
+        self.grid = grid
+        self.address = address
+
+    def __getitem__(self, attribute):
+        return self.grid.fields[attribute][self.address]
+
+    def __setitem__(self, attribute, value):
+        self.grid.fields[attribute][self.address] = value
+        self.grid.changed.add(self.address)
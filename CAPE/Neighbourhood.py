@@ -0,0 +1,80 @@
+import numpy as np
+
+
+class NeighbourTable:
+
+    def __init__(self, shape, relative_addresses):
+        """
+        Neighbours of every cell of a grid for one neighbourhood (type and depth), built once. Stored CSR-style: the
+        flat indices of the neighbours of the cell with flat index i are indices[offsets[i]:offsets[i + 1]], with
+        neighbours off the grid left out. The neighbours of every cell are in the order of the relative addresses
+        (random choices made by position among them depend on that order), and queries never change the table
+        :param shape: Shape of the grid
+        :param relative_addresses: Relative addresses of the neighbourhood (e.g. a row of moore_relative)
+        """
+        self.shape = tuple(shape)
+        self.relative_addresses = list(relative_addresses)
+        # Flat index of an address is its dot product with the strides
+        self.strides = [int(np.prod(self.shape[axis + 1:])) for axis in range(len(self.shape))]
+        coordinates = np.indices(self.shape).reshape(len(self.shape), -1)
+        neighbours = np.zeros((coordinates.shape[1], len(self.relative_addresses)), dtype=int)
+        on_grid = np.ones(neighbours.shape, dtype=bool)
+        for column, relative_address in enumerate(self.relative_addresses):
+            for axis in range(len(self.shape)):
+                neighbour = coordinates[axis] + relative_address[axis]
+                on_grid[:, column] &= (neighbour >= 0) & (neighbour < self.shape[axis])
+                neighbours[:, column] += neighbour * self.strides[axis]
+        # Rows are cells, so selecting the cells on the grid keeps each cell's neighbours together and in order
+        self.indices = neighbours[on_grid]
+        self.offsets = np.zeros(neighbours.shape[0] + 1, dtype=int)
+        np.cumsum(on_grid.sum(axis=1), out=self.offsets[1:])
+
+    def flat_index(self, address):
+        """
+        Flat index of an address on the grid
+        :param address: Address of a cell
+        :return:
+        """
+        index = 0
+        for coordinate, stride in zip(address, self.strides):
+            index += coordinate * stride
+        return index
+
+    def flat_indices(self, addresses):
+        """
+        Flat indices of many addresses
+        :param addresses: List of addresses
+        :return: Array of flat indices
+        """
+        return np.array(addresses, dtype=int).reshape(-1, len(self.shape)).dot(self.strides)
+
+    def address(self, index):
+        """
+        Address of the cell with a flat index
+        :param index: Flat index of a cell
+        :return:
+        """
+        return tuple([(index // stride) % size for size, stride in zip(self.shape, self.strides)])
+
+    def neighbours(self, index):
+        """
+        Flat indices of the neighbours of a cell (a view of the table, not to be written to)
+        :param index: Flat index of the cell
+        :return:
+        """
+        return self.indices[self.offsets[index]:self.offsets[index + 1]]
+
+    def gather(self, cells):
+        """
+        Neighbours of many cells at once
+        :param cells: Flat indices of the cells (array)
+        :return: Flat indices of the neighbours of all the cells, one cell after another (each in the order given by
+                 neighbours), and offsets - the neighbours of the i-th cell are at offsets[i]:offsets[i + 1]
+        """
+        cells = np.asarray(cells, dtype=int)
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+        offsets = np.zeros(len(cells) + 1, dtype=int)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], counts)
+        return self.indices[positions], offsets
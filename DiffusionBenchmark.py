@@ -0,0 +1,52 @@
+"""
+Time the tiled (threads) and subdomain (processes) diffusion engines against the single-threaded engine, for
+increasing numbers of workers.
+Usage: python DiffusionBenchmark.py [grid size] [maximum threads] [steps]
+"""
+from TBAutomaton.TBDiffusion import *
+
+import sys
+import time
+
+size = int(sys.argv[1]) if len(sys.argv) > 1 else 1001
+maximum_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+steps = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+shape = (size, size)
+np.random.seed(0)
+values = np.random.random(shape)
+# Rates vary between cells (as they do near caseum), so the cached face rates are used
+rate = np.where(np.random.random(shape) < 0.1, 0.5, 1.0)
+source = np.random.random(shape)
+decay = 0.1
+out = np.empty(shape)
+time_step = 0.001
+spatial_step = 0.2
+
+
+def time_engine(engine):
+    """
+    Mean time of one diffusion step (after one untimed step to allocate buffers and start workers)
+    :param engine: Diffusion engine
+    :return:
+    """
+    engine.step('field', values, rate, source, decay, time_step, spatial_step, out)
+    start = time.time()
+    for i in range(steps):
+        engine.step('field', values, rate, source, decay, time_step, spatial_step, out)
+    elapsed = time.time() - start
+    # Stopping the workers is not part of a step
+    engine.close()
+    return elapsed / steps
+
+print 'Grid: ', shape, ' Steps: ', steps
+single = time_engine(DiffusionEngine(shape))
+print "explicit          {0:8.2f} ms".format(single * 1000)
+
+workers = 1
+while workers <= maximum_workers:
+    tiled = time_engine(TiledDiffusionEngine(shape, workers))
+    print "tiled x {0:<8d} {1:8.2f} ms   speed-up {2:5.2f}".format(workers, tiled * 1000, single / tiled)
+    subdomain = time_engine(SubdomainDiffusionEngine(shape, workers, ['field']))
+    print "subdomain x {0:<4d} {1:8.2f} ms   speed-up {2:5.2f}".format(workers, subdomain * 1000, single / subdomain)
+    workers *= 2
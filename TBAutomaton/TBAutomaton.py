@@ -1,7 +1,9 @@
 from CAPE.CAPEAutomaton import *
 from TBAgents import *
 from TBEvents import *
-from collections import Counter
+from TBDiffusion import *
+import multiprocessing
+import bisect
 import cProfile
 
 
@@ -9,7 +11,8 @@ class TBAutomaton(Automaton):
 
     def __init__(self, shape, time_parameters, model_parameters, output_location,
                  blood_vessel_addresses, initial_macrophage_addresses,
-                 initial_fast_bacteria_addresses, initial_slow_bacteria_addresses, numpy_seed = None, debug = False):
+                 initial_fast_bacteria_addresses, initial_slow_bacteria_addresses, numpy_seed = None, debug = False,
+                 diffusion_parameters=None):
         """
         Specific model of CAPE Automaton to investigate TB infection. Grid is square of alveolar tissue, agents are
         bacteria and immune cells that act upon the tissue. Cellular automaton handles diffusion of oxygen,
@@ -22,11 +25,35 @@ class TBAutomaton(Automaton):
         :param initial_macrophage_addresses: Addresses to place macrophages
         :param initial_fast_bacteria_addresses: Addresses to place fast bacteria
         :param initial_slow_bacteria_addresses: Addresses to place slow bacteria
+        :param diffusion_parameters: Optional settings for the diffusion solver (engine, workers, diffusion_interval,
+               diffusion_sub_steps, adaptive_time_step, implicit_theta, matrix_theta, sparse_tile_size,
+               sparse_threshold, oxygen_coarsening, chemokine_solver, validate, steady_state_tolerance,
+               subdomain_agents), and species - any further diffusing species, as a dictionary of species name to
+               keyword arguments of DiffusingSpecies
         """
-        # Hard-coded attributes and formats
-        attributes = ['oxygen', 'chemotherapy', 'chemokine', 'contents', 'oxygen_diffusion_rate',
-                      'chemotherapy_diffusion_rate', 'blood_vessel']
-        formats = ['float', 'float', 'float', 'object', 'float', 'float', 'float']
+        if diffusion_parameters is None:
+            diffusion_parameters = dict()
+
+        # Diffusing species - oxygen, chemotherapy and chemokine, plus any others declared
+        self.species = [DiffusingSpecies('oxygen', 'oxygen_diffusion', caseum_reduces_diffusion=True,
+                                         from_blood_vessels='oxygen_from_source',
+                                         uptake_by_bacteria='oxygen_uptake_from_bacteria',
+                                         coarsening=diffusion_parameters.get('oxygen_coarsening', 1)),
+                        DiffusingSpecies('chemotherapy', 'chemotherapy_diffusion', caseum_reduces_diffusion=True,
+                                         from_blood_vessels='chemotherapy_from_source', decay='chemotherapy_decay',
+                                         schedule='chemotherapy'),
+                        DiffusingSpecies('chemokine', 'chemokine_diffusion', from_bacteria='chemokine_from_bacteria',
+                                         from_macrophages='chemokine_from_macrophage', decay='chemokine_decay',
+                                         solver=diffusion_parameters.get('chemokine_solver', 'engine'))]
+        for name in sorted(diffusion_parameters.get('species', dict())):
+            self.species.append(DiffusingSpecies(name, **diffusion_parameters['species'][name]))
+        self.species_names = [species.name for species in self.species]
+        rate_attributes = [species.name + '_diffusion_rate' for species in self.species
+                           if species.caseum_reduces_diffusion]
+
+        # Hard-coded attributes and formats (plus the diffusing species and their diffusion rates)
+        attributes = self.species_names + ['contents'] + rate_attributes + ['blood_vessel']
+        formats = ['float'] * len(self.species_names) + ['object'] + ['float'] * len(rate_attributes) + ['float']
 
         # Initialise list (blood vessels never change)
         self.blood_vessel_addresses = blood_vessel_addresses
@@ -39,8 +66,8 @@ class TBAutomaton(Automaton):
         initialisation = {}
         initialisation['contents'] = {}
         initialisation['oxygen'] = {}
-        initialisation['oxygen_diffusion_rate'] = {}
-        initialisation['chemotherapy_diffusion_rate'] = {}
+        for attribute in rate_attributes:
+            initialisation[attribute] = {}
         initialisation['blood_vessel'] = {}
         # Blood vessels & oxygen
         self.blood_vessel_addresses = blood_vessel_addresses
@@ -66,10 +93,12 @@ class TBAutomaton(Automaton):
             self.bacteria.append(sbac)
 
         # Set initial diffusion rates (will reduce with caseum)
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                initialisation['oxygen_diffusion_rate'][(x,y)] = model_parameters['oxygen_diffusion']
-                initialisation['chemotherapy_diffusion_rate'][(x, y)] = model_parameters['chemotherapy_diffusion']
+        for species in self.species:
+            if species.caseum_reduces_diffusion:
+                rate = species.coefficient('diffusion', model_parameters)
+                for x in range(shape[0]):
+                    for y in range(shape[1]):
+                        initialisation[species.name + '_diffusion_rate'][(x, y)] = rate
 
         # Hard-coded column headers for recording
         self.values_to_record = ["fast_bacteria", "fast_bacteria_resting", "slow_bacteria", "slow_bacteria_resting",
@@ -83,19 +112,190 @@ class TBAutomaton(Automaton):
         # Add an attribute for the maximum neighbourhood depth
         model_parameters['max_depth'] = 3
 
+        # Diffusion rates and blood vessels are not changed by diffusion, so are shared by the grid and work grid
+        static_attributes = rate_attributes + ['blood_vessel']
+
         # Super class initialisation
         Automaton.__init__(self, shape, attributes, formats, time_parameters, model_parameters, output_location,
                            self.values_to_record, self.grids_to_record, initialisation,
-                           numpy_seed=numpy_seed, debug=debug)
+                           numpy_seed=numpy_seed, debug=debug, static_attributes=static_attributes,
+                           double_buffer=True)
+
+        # Unreduced values of the static attributes (caseum reduces them)
+        self.unreduced_values = dict()
+        for attribute in static_attributes:
+            self.unreduced_values[attribute] = self.grid[attribute].copy()
+
+        # Caseum map - for each cell, how much caseum is within the distance to reduce diffusion, and whether the
+        # cell's diffusion has been reduced. Built on first use, then updated as caseum is added
+        self.caseum_counts = np.zeros(shape, dtype=int)
+        self.caseum_reduced = np.zeros(shape, dtype=bool)
+        self.caseum_counted = 0
+        self.caseum_map_parameters = None
+
+        # Presence of bacteria / non-resting macrophages (1 where present, 0 elsewhere), used as diffusion sources.
+        # Kept up to date by the events which add, remove or move these agents or change macrophage state
+        self.bacteria_mask = np.zeros(shape, dtype=float)
+        self.non_resting_macrophage_mask = np.zeros(shape, dtype=float)
+        self.rebuild_presence_masks()
+
+        # Free cells (empty and not a blood vessel), where agents can be placed. Kept up to date by the events which
+        # add, remove or move agents
+        self.free_mask = np.zeros(shape, dtype=bool)
+        self.rebuild_free_mask()
+
+        # Diffusion of the species
+        self.diffusion_parameters = diffusion_parameters
+        engine = diffusion_parameters.get('engine', 'explicit')
+        if engine == 'explicit':
+            self.diffusion_engine = DiffusionEngine(shape)
+        elif engine == 'stacked':
+            self.diffusion_engine = StackedDiffusionEngine(shape)
+        elif engine == 'tiled':
+            self.diffusion_engine = TiledDiffusionEngine(shape, int(diffusion_parameters.get('workers', 1)))
+        elif engine == 'subdomain':
+            self.diffusion_engine = SubdomainDiffusionEngine(shape, int(diffusion_parameters.get('workers', 1)),
+                                                             self.species_names)
+        elif engine == 'sparse':
+            self.diffusion_engine = SparseDiffusionEngine(shape, int(diffusion_parameters.get('sparse_tile_size', 16)),
+                                                          diffusion_parameters.get('sparse_threshold', 0.0))
+        elif engine == 'matrix':
+            self.diffusion_engine = MatrixDiffusionEngine(shape, diffusion_parameters.get('matrix_theta', 0.0))
+        elif engine == 'implicit':
+            self.diffusion_engine = ImplicitDiffusionEngine(shape, diffusion_parameters.get('implicit_theta', 1.0))
+        else:
+            raise Exception, "Invalid diffusion engine: {0}".format(engine)
+        # Agent events generated subdomain by subdomain (bands of rows, one per worker, as the subdomain engine), each
+        # by a worker process which owns it for the run. The worker processes are started with the first step
+        self.agent_bands = None
+        if diffusion_parameters.get('subdomain_agents', False):
+            workers = min(int(diffusion_parameters.get('workers', 1)), shape[0])
+            assert workers >= 1, "Invalid number of workers: {0}".format(workers)
+            bounds = np.linspace(0, shape[0], workers + 1).astype(int)
+            self.agent_bands = zip(bounds[:-1], bounds[1:])
+        # Events accepted by the subdomains' own conflict passes this step
+        self.subdomain_accepted = []
+        self.agent_processes = None
+        self.agent_connections = None
+        # Number of time steps covered by each diffusion update (fields are held in between)
+        self.diffusion_interval = int(diffusion_parameters.get('diffusion_interval', 1))
+        assert self.diffusion_interval >= 1, "Diffusion interval must be at least 1"
+        # Number of solver steps each diffusion update is split into. Agents are not processed between these, so the
+        # time step can be set for the agents and the fields still solved at a finer (stable) step
+        self.diffusion_sub_steps = int(diffusion_parameters.get('diffusion_sub_steps', 1))
+        assert self.diffusion_sub_steps >= 1, "Diffusion sub-steps must be at least 1"
+        # If True, the number of sub-steps of each field is instead the fewest for which the explicit scheme is stable
+        # with the current diffusion rates and decays (so falls as caseum lowers the rates). The agent time step is
+        # unchanged
+        self.adaptive_time_step = diffusion_parameters.get('adaptive_time_step', False)
+        # Solver steps taken for each field, the fields already warned of an unstable time step, and the fields whose
+        # fixed time step has been checked against the stable step since the diffusion rates last changed
+        self.solver_steps = dict.fromkeys(self.species_names, 0)
+        self.unstable_fields = set()
+        self.checked_fields = set()
+
+        # Species solved on a grid coarser than the agent grid, keyed by name
+        self.coarse_grids = dict()
+        for species in self.species:
+            if species.coarsening > 1:
+                self.coarse_grids[species.name] = CoarseGrid(shape, species.coarsening)
+        # Species solved exactly over each update by the spectral solver, keyed by name
+        self.spectral_fields = dict()
+        for species in self.species:
+            if species.solver == 'spectral':
+                self.spectral_fields[species.name] = SpectralField(shape)
+        # Solvers used in place of the diffusion engine
+        self.field_solvers = dict(self.coarse_grids)
+        self.field_solvers.update(self.spectral_fields)
+
+        # Sources and decays of the diffusing fields (plus a working array), allocated once and recalculated in place
+        self.diffusion_terms = dict()
+        for term in [name + '_source' for name in self.species_names] + \
+                [name + '_decay' for name in self.species_names] + ['scratch']:
+            self.diffusion_terms[term] = np.zeros(shape, dtype=float)
+
+        # Steady state detection - once the largest change in a field over an update is below the tolerance, updates
+        # of that field are skipped until its sources or diffusion rates change. Zero disables
+        self.steady_state_tolerance = diffusion_parameters.get('steady_state_tolerance', 0.0)
+        # Fields which are steady, with their sources and decays at the point they became steady kept in buffers
+        self.steady_fields = set()
+        if self.steady_state_tolerance > 0:
+            for name in self.species_names:
+                for term in ['_steady_source', '_steady_decay']:
+                    self.diffusion_terms[name + term] = np.zeros(shape, dtype=float)
+        self.diffusion_updates = dict.fromkeys(self.species_names, 0)
+        self.skipped_updates = dict.fromkeys(self.species_names, 0)
+
+        # Validation mode - every diffusion update is compared against the explicit scheme run at the automaton time
+        # step, and the largest differences are written to file
+        self.validation_file = None
+        if diffusion_parameters.get('validate', False):
+            self.validation_engine = DiffusionEngine(shape)
+            self.validation_file = open(self.output_location + 'diffusion_validation.csv', 'w')
+            writer = csv.writer(self.validation_file, delimiter=',')
+            writer.writerow(['timestep'] + self.species_names)
+            # Fields solved on coarse grids are also solved at full resolution alongside, and the errors of the coarse
+            # solutions written to file
+            self.full_resolution_fields = dict()
+            if self.coarse_grids:
+                self.coarse_error_file = open(self.output_location + 'coarse_error_report.csv', 'w')
+                writer = csv.writer(self.coarse_error_file, delimiter=',')
+                header = ['timestep']
+                for name in sorted(self.coarse_grids):
+                    header += [name + '_max_error', name + '_relative_error']
+                    self.full_resolution_fields[name] = self.grid[name].copy()
+                writer.writerow(header)
 
         # Maxima
         self.max_oxygen = 0.0
         self.max_chemotherapy = 0.0
         self.max_chemokine = 0.0
+        # Maximum of each field in the grid. Produced by the diffusion engine with each update, so the maxima don't
+        # need separate passes over the fields
+        self.field_maxima = dict()
+        self.update_field_maxima()
 
         # Chemotherapy scheduling
         self.chemo_schedule1_start = np.random.randint(self.model_parameters['chemotherapy_schedule1_start_lower'],
                                                        self.model_parameters['chemotherapy_schedule1_start_upper'])
+        # Time steps (start, end) when chemotherapy is given. Converted from the schedule on first use
+        self.chemotherapy_windows = None
+        # For species only present while chemotherapy is given, the field arrays (of the grid / work grid) which are
+        # known to be all zero. While chemotherapy is not given, these need no writes at all
+        self.zero_field_arrays = dict()
+        for species in self.species:
+            if species.schedule == 'chemotherapy':
+                self.zero_field_arrays[species.name] = [self.grid[species.name], self.work_grid[species.name]]
+
+    def update_field_maxima(self):
+        """
+        Recalculate the maxima of the fields from the grid (needed if the fields are changed other than by diffusion)
+        :return:
+        """
+        for field in self.species_names:
+            self.field_maxima[field] = self.grid[field].max()
+
+    def rebuild_presence_masks(self):
+        """
+        Recalculate the bacteria and non-resting macrophage masks from the agent lists (needed if agents are added or
+        changed other than through events)
+        :return:
+        """
+        self.bacteria_mask[...] = 0
+        for b in self.bacteria:
+            self.bacteria_mask[b.address] = 1
+        self.non_resting_macrophage_mask[...] = 0
+        for m in self.macrophages:
+            if m.state != 'resting':
+                self.non_resting_macrophage_mask[m.address] = 1
+
+    def rebuild_free_mask(self):
+        """
+        Recalculate the free cell mask from the grid (needed if the contents are changed other than through events)
+        :return:
+        """
+        self.free_mask[...] = (self.grid['contents'] == 0) & (self.grid['blood_vessel'] == 0.0)
+        self.grid.changed.clear()
 
     # OVERRIDE
     def timestep_output(self):
@@ -106,6 +306,39 @@ class TBAutomaton(Automaton):
         print "t =", self.time * self.time_step, "- Bac =", len(self.bacteria), "- Mac =", len(self.macrophages), \
             "- T-cell =", len(self.t_cells), "- Cas =", len(self.caseum_addresses)
 
+    # OVERRIDE
+    def close_files(self):
+        Automaton.close_files(self)
+        self.diffusion_engine.close()
+        self.stop_agent_workers()
+        if self.validation_file is not None:
+            self.validation_file.close()
+            if self.coarse_grids:
+                self.coarse_error_file.close()
+
+    # OVERRIDE
+    def run(self):
+        Automaton.run(self)
+        self.diffusion_engine.close()
+        self.stop_agent_workers()
+        if self.steady_state_tolerance > 0:
+            self.write_steady_state_report()
+        if self.adaptive_time_step:
+            self.write_solver_step_report()
+        if isinstance(self.diffusion_engine, SparseDiffusionEngine):
+            self.write_sparse_diffusion_report()
+
+    def write_steady_state_report(self):
+        """
+        Write the number of diffusion updates of each field, and how many were skipped as the field was steady
+        :return:
+        """
+        with open(self.output_location + 'steady_state_report.csv', 'w') as report_file:
+            writer = csv.writer(report_file, delimiter=',')
+            writer.writerow(['field', 'updates', 'skipped'])
+            for field in self.species_names:
+                writer.writerow([field, self.diffusion_updates[field], self.skipped_updates[field]])
+
     # OVERRIDE
     def record_counts(self):
         # Count up the totals of each bacteria, macrophage, etc and write the to the file
@@ -136,322 +369,552 @@ class TBAutomaton(Automaton):
     def update_cells(self):
         """
         Run the cellular automaton update. Runs pre-process first to determine diffusion rates. Then runs diffusion
-        to calculate new values (written to work grid)
+        to calculate new values (written to work grid). Diffusion runs once every diffusion_interval time steps, and
+        the fields are carried over unchanged in between
         :return:
         """
-        # Update the current maxima
-        self.max_oxygen = self.grid['oxygen'].max()
-        self.max_chemotherapy = self.grid['chemotherapy'].max()
-        self.max_chemokine = self.grid['chemokine'].max()
+        # Update the current maxima (from the last diffusion update)
+        self.max_oxygen = self.field_maxima['oxygen']
+        self.max_chemotherapy = self.field_maxima['chemotherapy']
+        self.max_chemokine = self.field_maxima['chemokine']
+
+        # Between diffusion updates the fields are held
+        if (self.time - 1) % self.diffusion_interval != 0:
+            for field in self.species_names:
+                if self.field_in_grid(field):
+                    self.work_grid[field] = self.grid[field]
+                    self.field_written(field)
+                else:
+                    self.clear_field(field)
+            return
 
         self.diffusion_pre_process()
-        chemo = (self.chemo_schedule1_start / self.time_step) <= self.time < \
-                (self.model_parameters['chemotherapy_schedule1_end'] / self.time_step) or \
-                self.model_parameters['chemotherapy_schedule2_start'] / self.time_step <= self.time
-        self.diffusion(chemo)
+        self.diffusion(self.chemotherapy_scheduled())
+
+    def chemotherapy_scheduled(self):
+        """
+        Whether chemotherapy is given at the current time step. Given from the start of schedule 1 to the end of
+        schedule 1, and again from the start of schedule 2 onwards
+        :return:
+        """
+        if self.chemotherapy_windows is None:
+            self.chemotherapy_windows = [
+                (self.chemo_schedule1_start / self.time_step,
+                 self.model_parameters['chemotherapy_schedule1_end'] / self.time_step),
+                (self.model_parameters['chemotherapy_schedule2_start'] / self.time_step, float('inf'))]
+        for start, end in self.chemotherapy_windows:
+            if start <= self.time < end:
+                return True
+        return False
+
+    def field_in_grid(self, field):
+        """
+        Whether a field of the grid may be non-zero (only species given with chemotherapy are tracked)
+        :param field: Name of the field
+        :return:
+        """
+        if field not in self.zero_field_arrays:
+            return True
+        return not any(array is self.grid[field] for array in self.zero_field_arrays[field])
+
+    def field_written(self, field):
+        """
+        Record that a field of the work grid has been written to (so may no longer be zero)
+        :param field: Name of the field
+        :return:
+        """
+        if field in self.zero_field_arrays:
+            self.zero_field_arrays[field] = [array for array in self.zero_field_arrays[field]
+                                             if array is not self.work_grid[field]]
+
+    def clear_field(self, field):
+        """
+        Set a field of the work grid to zero. Nothing is written if it is already known to be zero
+        :param field: Name of the field (a species given with chemotherapy)
+        :return:
+        """
+        array = self.work_grid[field]
+        if field in self.field_solvers:
+            self.field_solvers[field].reset()
+        if not any(array is zero_array for zero_array in self.zero_field_arrays[field]):
+            array[...] = 0.0
+            self.zero_field_arrays[field].append(array)
+        self.field_maxima[field] = 0.0
+        self.steady_fields.discard(field)
 
     def diffusion_pre_process(self):
         """
         Pre-processing to calculate diffusion rates. If a cell is too close to too much caseum (determined by model
         parameters caseum_distance_to_reduce_diffusion and caseum_threshold_to_reduce_diffusion, then it's diffusion
         rates (and excretion rate if a blood vessel is present) are decreased.
+
+        Caseum is only ever added, so the count of caseum near each cell is kept between calls and only updated
+        around caseum added to caseum_addresses since the last call. The map is rebuilt in bulk if the caseum
+        parameters change.
         :return:
         """
-
-        # Loop through every caseum address and record the addresses that are within the required distance
-        affected_addresses = []
-        for caseum_address in self.caseum_addresses:
-            for d in range(1, int(self.model_parameters['caseum_distance_to_reduce_diffusion'])+1):
-                neighbours = self.moore_neighbours(caseum_address,d)
-                affected_addresses += neighbours
-
-        # Affected addresses is now a list of all address within the range of cells with caseum. Multiple records of the
-        # same address imply cell is too close to more than one caseum. So count how often each address appears.
-        counted = Counter(affected_addresses)
-        for address in counted:
-            # If the count is greater than the threshold, reduce diffusion
-            if counted[address] >= self.model_parameters['caseum_threshold_to_reduce_diffusion']:
-                self.grid[address]['oxygen_diffusion_rate'] = self.model_parameters['oxygen_diffusion'] / \
-                                                              self.model_parameters['diffusion_caseum_reduction']
-                self.grid[address]['chemotherapy_diffusion_rate'] = self.model_parameters['chemotherapy_diffusion'] / \
-                                                        self.model_parameters['diffusion_caseum_reduction']
-                # Reduce excretion if blood vessel
-                if self.grid[address]['blood_vessel'] > 0.0:
-                    self.grid[address]['blood_vessel'] /= self.model_parameters['diffusion_caseum_reduction']
+        # No caseum, so nothing to reduce
+        if not self.caseum_addresses:
+            return
+
+        parameters = (int(self.model_parameters['caseum_distance_to_reduce_diffusion']),
+                      self.model_parameters['caseum_threshold_to_reduce_diffusion'],
+                      self.model_parameters.get('diffusion_caseum_reduction'))
+        if parameters != self.caseum_map_parameters:
+            self.rebuild_caseum_map(parameters)
+            return
+
+        distance = parameters[0]
+        for caseum_address in self.caseum_addresses[self.caseum_counted:]:
+            # Every cell within the distance (on the grid) is near one more caseum - apart from the caseum cell itself
+            region = (slice(max(caseum_address[0] - distance, 0), caseum_address[0] + distance + 1),
+                      slice(max(caseum_address[1] - distance, 0), caseum_address[1] + distance + 1))
+            self.caseum_counts[region] += 1
+            self.caseum_counts[caseum_address] -= 1
+            self.reduce_diffusion(region)
+        self.caseum_counted = len(self.caseum_addresses)
+
+    def rebuild_caseum_map(self, parameters):
+        """
+        Recount the caseum near every cell (summed over the caseum distance with a summed-area table) and reapply the
+        diffusion reductions from the unreduced values
+        :param parameters: Caseum distance, threshold and reduction
+        :return:
+        """
+        self.caseum_map_parameters = parameters
+        caseum = np.zeros(self.grid.shape, dtype=int)
+        np.add.at(caseum, tuple(zip(*self.caseum_addresses)), 1)
+        self.caseum_counts = self.box_sum(caseum, parameters[0]) - caseum
+        self.caseum_counted = len(self.caseum_addresses)
+
+        for attribute in self.unreduced_values:
+            self.grid[attribute] = self.unreduced_values[attribute]
+        self.caseum_reduced[...] = False
+        self.diffusion_rates_changed()
+        self.reduce_diffusion((slice(None), slice(None)))
+
+    def reduce_diffusion(self, region):
+        """
+        Reduce the diffusion rates (and blood vessel excretion) of cells in the region which are now near enough
+        caseum, and have not already been reduced
+        :param region: Tuple of slices
+        :return:
+        """
+        threshold = self.caseum_map_parameters[1]
+        reduction = self.caseum_map_parameters[2]
+        newly_reduced = (self.caseum_counts[region] >= threshold) & ~self.caseum_reduced[region]
+        if not newly_reduced.any():
+            return
+        self.caseum_reduced[region] |= newly_reduced
+        for species in self.species:
+            if species.caseum_reduces_diffusion:
+                self.grid[species.name + '_diffusion_rate'][region][newly_reduced] = \
+                    species.coefficient('diffusion', self.model_parameters) / reduction
+        # Reduce excretion if blood vessel
+        self.grid['blood_vessel'][region][newly_reduced] = \
+            self.unreduced_values['blood_vessel'][region][newly_reduced] / reduction
+        self.diffusion_rates_changed()
+
+    def diffusion_rates_changed(self):
+        """
+        Discard the diffusion coefficients cached by the diffusion engines, after the diffusion rates have changed
+        :return:
+        """
+        self.diffusion_engine.invalidate()
+        for solver in self.field_solvers.values():
+            solver.invalidate()
+        if self.validation_file is not None:
+            self.validation_engine.invalidate()
+        # Fields may no longer be steady, and the stable time steps have changed
+        self.steady_fields.clear()
+        self.checked_fields.clear()
 
     def diffusion(self, chemo):
         """
-        Calculate new values from diffusion of chemicals (oxygen, chemotherapy, chemokine). Finite difference scheme
-        based on the differences between value in the cell and values in von Neumann neighbours to depth 1, and the
-        contents of the cell. Different equations for center cells (who have all 4 neighbours) and edge cells (who have
-        less than 4).
+        Calculate new values from diffusion of chemicals (oxygen, chemotherapy, chemokine and any other species).
+        Finite difference scheme based on the differences between value in the cell and values in von Neumann
+        neighbours to depth 1, and the contents of the cell. Edge cells use a mirrored halo (zero-flux boundary), so
+        all cells share one stencil.
         :param chemo: Boolean to indicate if chemo is present.
         :return:
         """
-
-        # TODO - veeeeery long (but based off TBModel.cpp). Have to cater for edge cases separately as they have
-        # different equations
-
-        # Diffusion works by taking a section of the grid, taking corresponding neighbour grids of same size by slicing
-        # the original grid with an offset. Results in 5 grids of the same size. Then can apply the diffusion function
-        # to all cells at once within that sub-grid
-
-        # Grids to indicate presence of bacteria / non-resting macrophage
-        # Take an initial grid of zeros of same shape as main grid, change address which have bacteria to 1
-        bac_grid = np.zeros(self.grid.shape)
-        for b in self.bacteria:
-            bac_grid[b.address] = 1
-        # Take an initial grid of zeros of same shape as main grid, change address which have non-resting mac to 1
-        non_resting_mac_grid = np.zeros(self.grid.shape)
-        for m in self.macrophages:
-            if m.state != 'resting':
-                non_resting_mac_grid[m.address] = 1
-
-        # Center grid (of size X-2 x Y-2)
-        cell = self.grid[1:-1, 1:-1]
-        above = self.grid[:-2, 1:-1]
-        below = self.grid[2:, 1:-1]
-        left = self.grid[1:-1, :-2]
-        right = self.grid[1:-1, 2:]
-        cell_has_bacteria = bac_grid[1:-1, 1:-1]
-        # Multiply by -1 to give grid of 0s and 1s for macrophages
-        cell_has_non_resting_macrophage = non_resting_mac_grid[1:-1, 1:-1]
-
-        # oxygen
-        self.work_grid['oxygen'][1:-1,1:-1] = cell['oxygen'] + self.time_step * \
-            (((((cell['oxygen_diffusion_rate'] + below['oxygen_diffusion_rate'])/2) *
-               (below['oxygen'] - cell['oxygen']) -
-               ((cell['oxygen_diffusion_rate'] + above['oxygen_diffusion_rate'])/2) *
-                (cell['oxygen'] - above['oxygen'])) /
-            self.model_parameters['spatial_step'] ** 2) +
-            ((((cell['oxygen_diffusion_rate'] + right['oxygen_diffusion_rate'])/2) *
-                (right['oxygen'] - cell['oxygen']) -
-              ((cell['oxygen_diffusion_rate'] + left['oxygen_diffusion_rate'])/2) *
-                (cell['oxygen'] - left['oxygen'])) /
-            self.model_parameters['spatial_step'] ** 2) +
-            (self.model_parameters['oxygen_from_source'] * cell['blood_vessel']) -
-            (self.model_parameters['oxygen_uptake_from_bacteria'] * cell['oxygen'] * cell_has_bacteria))
-
-        # chemotherapy
-        if chemo:
-            self.work_grid['chemotherapy'][1:-1, 1:-1] = cell['chemotherapy'] + self.time_step * \
-                (((((cell['chemotherapy_diffusion_rate'] + below['chemotherapy_diffusion_rate']) / 2) *
-                    (below['chemotherapy'] - cell['chemotherapy']) -
-                    ((cell['chemotherapy_diffusion_rate'] + above['chemotherapy_diffusion_rate']) / 2) *
-                    (cell['chemotherapy'] - above['chemotherapy'])) /
-                    self.model_parameters['spatial_step'] ** 2) +
-                    ((((cell['chemotherapy_diffusion_rate'] + right['chemotherapy_diffusion_rate']) / 2) *
-                    (right['chemotherapy'] - cell['chemotherapy']) -
-                    ((cell['chemotherapy_diffusion_rate'] + left['chemotherapy_diffusion_rate']) / 2) *
-                    (cell['chemotherapy'] -left['chemotherapy'])) /
-                    self.model_parameters['spatial_step'] ** 2) +
-                    (self.model_parameters['chemotherapy_from_source'] * cell['blood_vessel']) -
-                    (self.model_parameters['chemotherapy_decay'] * cell['chemotherapy']))
-
-        self.work_grid['chemokine'][1:-1, 1:-1] = cell['chemokine'] + self.time_step * \
-            (((self.model_parameters['chemokine_diffusion'] * (below['chemokine'] - cell['chemokine']) -
-               self.model_parameters['chemokine_diffusion'] * (cell['chemokine'] - above['chemokine'])) /
-              self.model_parameters['spatial_step'] ** 2) +
-            ((self.model_parameters['chemokine_diffusion'] * (right['chemokine'] - cell['chemokine']) -
-              self.model_parameters['chemokine_diffusion'] * (cell['chemokine'] - left['chemokine'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-             self.model_parameters['chemokine_from_bacteria'] * cell_has_bacteria +
-             (self.model_parameters['chemokine_from_macrophage'] * cell_has_non_resting_macrophage) -
-             self.model_parameters['chemokine_decay'] * cell['chemokine'])
-
-        # Edges
-        # Top row (no corners) - size (X-2 x Y)
-        cell = self.grid[:1, 1:-1]
-        below = self.grid[1:2, 1:-1]
-        left = self.grid[:1, 0:-2]
-        right = self.grid[:1, 2:]
-        cell_has_bacteria = bac_grid[:1, 1:-1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[:1, 1:-1] * -1
-        work_grid = self.work_grid[:1, 1:-1]
-        self.diffusion_3_neighbours(chemo, cell, [left, right], below, cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # LEFT
-        cell = self.grid[1:-1, :1]
-        above = self.grid[0:-2, :1]
-        right = self.grid[1:-1, 1:2]
-        below = self.grid[2:, :1]
-        cell_has_bacteria = bac_grid[1:-1, :1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[1:-1, :1] * -1
-        work_grid = self.work_grid[1:-1, :1]
-        self.diffusion_3_neighbours(chemo, cell, [above, below], right, cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # RIGHT
-        cell = self.grid[1:-1, -1:]
-        above = self.grid[0:-2, -1:]
-        left = self.grid[1:-1, -2:-1]
-        below = self.grid[2:, -1:]
-        cell_has_bacteria = bac_grid[1:-1, -1:]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[1:-1, -1:] * -1
-        work_grid = self.work_grid[1:-1, -1:]
-        self.diffusion_3_neighbours(chemo, cell, [above, below], left, cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # BOTTOM ROW
-        cell = self.grid[-1:, 1:-1]
-        above = self.grid[-2:-1, 1:-1]
-        left = self.grid[-1:, 0:-2]
-        right = self.grid[-1:, 2:]
-        cell_has_bacteria = bac_grid[-1:, 1:-1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[-1:, 1:-1] * -1
-        work_grid = self.work_grid[-1:, 1:-1]
-        self.diffusion_3_neighbours(chemo, cell, [left, right], above, cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        #CORNERS
-        # Top left
-        cell = self.grid[:1, :1]
-        below = self.grid[:1, 1:2]
-        right = self.grid[1:2, :1]
-        cell_has_bacteria = bac_grid[:1, :1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[:1, :1] * -1
-        work_grid = self.work_grid[:1, :1]
-        self.diffusion_2_neighbours(chemo, cell, [below, right], cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # Top right
-        cell = self.grid[:1, -1:]
-        below = self.grid[1:2, -1:]
-        left = self.grid[:1, -2:-1]
-        cell_has_bacteria = bac_grid[:1, :1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[:1, -1:] * -1
-        work_grid = self.work_grid[:1, -1:]
-        self.diffusion_2_neighbours(chemo, cell, [below, left], cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # Bottom left
-        cell = self.grid[-1:, :1]
-        above = self.grid[-2:-1, :1]
-        right = self.grid[-1:, 1:2]
-        cell_has_bacteria = bac_grid[-1:, :1]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[-1:, :1] * -1
-        work_grid = self.work_grid[-1:, :1]
-        self.diffusion_2_neighbours(chemo, cell, [above, right], cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        # Bottom right
-        cell = self.grid[-1:, -1:]
-        above = self.grid[-2:-1, -1:]
-        left = self.grid[-1:, -2:-1]
-        cell_has_bacteria = bac_grid[-1:, -1:]
-        cell_has_non_resting_macrophage = non_resting_mac_grid[-1:, -1:] * -1
-        work_grid = self.work_grid[-1:, -1:]
-        self.diffusion_2_neighbours(chemo, cell, [above, left], cell_has_bacteria,
-                                    cell_has_non_resting_macrophage, work_grid)
-
-        if not chemo:
-            self.work_grid['chemotherapy'] = np.zeros(self.grid.shape,dtype=float)
-
-    def diffusion_3_neighbours(self, chemo, cell, paired_neighbours, non_paired_neighbour, cell_has_bacteria,
-                               cell_has_non_resting_macrophage, work_grid):
-        """
-        For cells with 3 neighbours (4th would be off grid - i.e. top row, left column etc.) run diffusion rules
-        :param chemo: 
-        :param cell: 
-        :param paired_neighbours: 
-        :param non_paired_neighbour: 
-        :param cell_has_bacteria: 
-        :param cell_has_non_resting_macrophage: 
-        :param work_grid: 
-        :return: 
-        """
-        work_grid['oxygen'] = cell['oxygen'] + self.time_step * (
-            ((cell['oxygen_diffusion_rate'] * (non_paired_neighbour['oxygen'] - 2 * cell['oxygen'] + non_paired_neighbour['oxygen'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            ((cell['oxygen_diffusion_rate'] * (paired_neighbours[0]['oxygen'] - 2 * cell['oxygen'] + paired_neighbours[1]['oxygen'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            (self.model_parameters['oxygen_from_source'] * cell['blood_vessel']) +
-            (self.model_parameters['oxygen_uptake_from_bacteria'] * cell['oxygen'] *
-             cell_has_bacteria)
-        )
-        if chemo:
-            work_grid['chemotherapy'] = cell['chemotherapy'] + self.time_step * (
-                ((cell['chemotherapy_diffusion_rate'] * (non_paired_neighbour['chemotherapy'] - 2 * cell['chemotherapy'] +
-                                                         non_paired_neighbour['chemotherapy'])) /
-                 self.model_parameters['spatial_step'] ** 2) +
-                ((cell['chemotherapy_diffusion_rate'] * (paired_neighbours[0]['chemotherapy'] - 2 * cell['chemotherapy'] +
-                                                         paired_neighbours[1]['chemotherapy'])) /
-                 self.model_parameters['spatial_step'] ** 2) +
-                (self.model_parameters['chemotherapy_from_source'] * cell['blood_vessel']) +
-                (self.model_parameters['chemotherapy_decay'] * cell['chemotherapy'])
-            )
-        work_grid['chemokine'] = cell['chemokine'] + self.time_step * (
-            ((self.model_parameters['chemokine_diffusion'] * (non_paired_neighbour['chemokine'] - 2 * cell['chemokine'] +
-                                                              non_paired_neighbour['chemokine'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            ((self.model_parameters['chemokine_diffusion'] * (paired_neighbours[0]['chemokine'] - 2 * cell['chemokine'] +
-                                                              paired_neighbours[1]['chemokine'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            self.model_parameters['chemokine_from_bacteria'] * cell_has_bacteria +
-            self.model_parameters['chemokine_from_macrophage'] *
-            (cell_has_non_resting_macrophage) +
-            self.model_parameters['chemokine_decay'] * cell['chemokine']
-        )
-
-    def diffusion_2_neighbours(self, chemo, cell, neighbours, cell_has_bacteria,
-                               cell_has_non_resting_macrophage, work_grid):
-        """
-        For cells with 2 neighbours (other 2 would be off grid - i.e. corners) run diffusion rules
-        :param chemo:
-        :param cell:
-        :param neighbours:
-        :param cell_has_bacteria:
-        :param cell_has_non_resting_macrophage:
-        :param work_grid:
-        :return:
-        """
-
-        work_grid['oxygen'] = cell['oxygen'] + self.time_step * (
-            ((cell['oxygen_diffusion_rate'] * (neighbours[0]['oxygen'] - 2 * cell['oxygen'] + neighbours[0]['oxygen'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            ((cell['oxygen_diffusion_rate'] * (neighbours[1]['oxygen'] - 2 * cell['oxygen'] + neighbours[1]['oxygen'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            (self.model_parameters['oxygen_from_source'] * cell['blood_vessel']) +
-            (self.model_parameters['oxygen_uptake_from_bacteria'] * cell['oxygen'] *
-             cell_has_bacteria)
-        )
-        if chemo:
-            work_grid['chemotherapy'] = cell['chemotherapy'] + self.time_step * (
-                ((cell['chemotherapy_diffusion_rate'] * (neighbours[0]['chemotherapy'] - 2 * cell['chemotherapy'] +
-                                                         neighbours[0]['chemotherapy'])) /
-                 self.model_parameters['spatial_step'] ** 2) +
-                ((cell['chemotherapy_diffusion_rate'] * (neighbours[1]['chemotherapy'] - 2 * cell['chemotherapy'] +
-                                                         neighbours[1]['chemotherapy'])) /
-                 self.model_parameters['spatial_step'] ** 2) +
-                (self.model_parameters['chemotherapy_from_source'] * cell['blood_vessel']) +
-                (self.model_parameters['chemotherapy_decay'] * cell['chemotherapy'])
-            )
-        work_grid['chemokine'] = cell['chemokine'] + self.time_step * (
-            ((self.model_parameters['chemokine_diffusion'] * (neighbours[0]['chemokine'] - 2 * cell['chemokine'] +
-                                                              neighbours[0]['chemokine'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            ((self.model_parameters['chemokine_diffusion'] * (neighbours[1]['chemokine'] - 2 * cell['chemokine'] +
-                                                              neighbours[1]['chemokine'])) /
-             self.model_parameters['spatial_step'] ** 2) +
-            self.model_parameters['chemokine_from_bacteria'] * cell_has_bacteria +
-            self.model_parameters['chemokine_from_macrophage'] *
-            (cell_has_non_resting_macrophage) +
-            self.model_parameters['chemokine_decay'] * cell['chemokine']
-        )
+        # Name, diffusion rate, source and decay of each diffusing field
+        fields = []
+        for species in self.species:
+            if species.schedule == 'chemotherapy' and not chemo:
+                self.clear_field(species.name)
+                continue
+            if species.caseum_reduces_diffusion:
+                rate = self.grid[species.name + '_diffusion_rate']
+            else:
+                rate = species.coefficient('diffusion', self.model_parameters)
+            source, decay = self.diffusion_sources(species)
+            fields.append((species.name, rate, source, decay))
+            self.field_written(species.name)
+
+        # Fields which have reached a steady state are carried over
+        active_fields = []
+        for name, rate, source, decay in fields:
+            self.diffusion_updates[name] += 1
+            if self.is_steady(name, source, decay):
+                self.work_grid[name] = self.grid[name]
+                self.skipped_updates[name] += 1
+            else:
+                active_fields.append((name, rate, source, decay))
+
+        # Fields taking the same number of sub-steps are advanced together
+        groups = dict()
+        for name, rate, source, decay in active_fields:
+            sub_steps = self.sub_steps(name, rate, decay)
+            groups.setdefault(sub_steps, []).append((name, rate, source, decay))
+            self.solver_steps[name] += sub_steps
+        for sub_steps in sorted(groups):
+            group = [field for field in groups[sub_steps] if field[0] not in self.field_solvers]
+            time_step = self.time_step * self.diffusion_interval / sub_steps
+            for name, rate, source, decay in groups[sub_steps]:
+                if name in self.field_solvers:
+                    self.field_maxima[name] = self.field_solvers[name].step(
+                        self.grid[name], rate, source, decay, time_step, self.model_parameters['spatial_step'],
+                        sub_steps, self.work_grid[name])
+            values = [self.grid[name] for name, rate, source, decay in group]
+            # Sources are held fixed over the sub-steps
+            for sub_step in range(sub_steps):
+                maxima = self.diffusion_engine.step_fields(
+                    [(name, values[index], rate, source, decay, self.work_grid[name])
+                     for index, (name, rate, source, decay) in enumerate(group)],
+                    time_step, self.model_parameters['spatial_step'])
+                values = [self.work_grid[name] for name, rate, source, decay in group]
+            for index, (name, rate, source, decay) in enumerate(group):
+                self.field_maxima[name] = maxima[index]
+
+        if self.steady_state_tolerance > 0:
+            for name, rate, source, decay in active_fields:
+                change = np.subtract(self.work_grid[name], self.grid[name], out=self.diffusion_terms['scratch'])
+                if np.abs(change, out=change).max() < self.steady_state_tolerance:
+                    np.copyto(self.diffusion_terms[name + '_steady_source'], source)
+                    np.copyto(self.diffusion_terms[name + '_steady_decay'], decay)
+                    self.steady_fields.add(name)
+
+        if self.validation_file is not None:
+            self.validate_diffusion(fields)
+            if self.coarse_grids:
+                self.coarse_errors(active_fields)
+
+    def sub_steps(self, name, rate, decay):
+        """
+        Number of solver steps to split a diffusion update of a field into. Either the fixed number of sub-steps (with
+        a warning if that is above the stable step of the engine - checked once after each change of the diffusion
+        rates) or, with an adaptive time step, the fewest steps which are stable. Fields with the spectral solver take
+        a single (exact) step
+        :param name: Name of the field
+        :param rate: Diffusion rate of the field
+        :param decay: Decay of the field
+        :return:
+        """
+        if name in self.spectral_fields:
+            return 1
+        if not self.adaptive_time_step:
+            if name in self.checked_fields:
+                return self.diffusion_sub_steps
+            self.checked_fields.add(name)
+        if name in self.coarse_grids:
+            stable_time_step = self.coarse_grids[name].stable_time_step(rate, decay,
+                                                                         self.model_parameters['spatial_step'])
+        else:
+            stable_time_step = self.diffusion_engine.stable_time_step(name, rate, decay,
+                                                                      self.model_parameters['spatial_step'])
+        update_time = self.time_step * self.diffusion_interval
+        if stable_time_step is None:
+            return self.diffusion_sub_steps
+        if self.adaptive_time_step:
+            return max(1, int(math.ceil(update_time / stable_time_step)))
+        if update_time / self.diffusion_sub_steps > stable_time_step and name not in self.unstable_fields:
+            print "Warning: time step of {0} diffusion ({1}) is above the stable time step ({2})".format(
+                name, update_time / self.diffusion_sub_steps, stable_time_step)
+            self.unstable_fields.add(name)
+        return self.diffusion_sub_steps
+
+    def diffusion_sources(self, species):
+        """
+        Source and decay of a species, calculated in place from blood vessels, bacteria and non-resting macrophages
+        (maintained by the events). Terms whose coefficient is None are left out
+        :param species: Diffusing species
+        :return: Source and decay - arrays of grid shape, or single values if there are no per-cell terms
+        """
+        source = self.diffusion_terms[species.name + '_source']
+        scratch = self.diffusion_terms['scratch']
+        source_terms = [(species.coefficient('from_blood_vessels', self.model_parameters), self.grid['blood_vessel']),
+                        (species.coefficient('from_bacteria', self.model_parameters), self.bacteria_mask),
+                        (species.coefficient('from_macrophages', self.model_parameters),
+                         self.non_resting_macrophage_mask)]
+        source_terms = [(coefficient, grid) for coefficient, grid in source_terms if coefficient is not None]
+        if source_terms:
+            np.multiply(source_terms[0][0], source_terms[0][1], out=source)
+            for coefficient, grid in source_terms[1:]:
+                np.multiply(coefficient, grid, out=scratch)
+                np.add(source, scratch, out=source)
+        else:
+            source = 0.0
+
+        decay = species.coefficient('decay', self.model_parameters)
+        uptake = species.coefficient('uptake_by_bacteria', self.model_parameters)
+        if uptake is not None:
+            decay_grid = self.diffusion_terms[species.name + '_decay']
+            np.multiply(uptake, self.bacteria_mask, out=decay_grid)
+            if decay is not None:
+                np.add(decay_grid, decay, out=decay_grid)
+            decay = decay_grid
+        elif decay is None:
+            decay = 0.0
+        return source, decay
+
+    def is_steady(self, name, source, decay):
+        """
+        Whether a field is steady - it changed by less than the tolerance in an earlier update, and its source and
+        decay are the same as they were then (diffusion rate changes clear the steady fields)
+        :param name: Name of the field
+        :param source: Current source of the field
+        :param decay: Current decay of the field
+        :return:
+        """
+        if name not in self.steady_fields:
+            return False
+        # Sources and decays are either per-cell or the same for every cell, compared against the buffers either way
+        if (self.diffusion_terms[name + '_steady_source'] == source).all() and \
+                (self.diffusion_terms[name + '_steady_decay'] == decay).all():
+            return True
+        self.steady_fields.remove(name)
+        return False
+
+    def validate_diffusion(self, fields):
+        """
+        Compare the latest diffusion update against the explicit scheme, run over the same interval (with sources held
+        fixed) at the automaton time step divided by the number of sub-steps, or at the stable step of the explicit
+        scheme if that is smaller. The largest absolute difference in each field is written to file
+        :param fields: Name, diffusion rate, source and decay of each field that was diffused
+        :return:
+        """
+        update_time = self.time_step * self.diffusion_interval
+        differences = dict.fromkeys(self.species_names, 0.0)
+        for name, rate, source, decay in fields:
+            steps = self.diffusion_interval * self.diffusion_sub_steps
+            stable_time_step = self.validation_engine.stable_time_step(name, rate, decay,
+                                                                       self.model_parameters['spatial_step'])
+            if stable_time_step is not None:
+                steps = max(steps, int(math.ceil(update_time / stable_time_step)))
+            reference = self.grid[name].copy()
+            for i in range(steps):
+                self.validation_engine.step(name, reference, rate, source, decay, update_time / steps,
+                                            self.model_parameters['spatial_step'], reference)
+            differences[name] = np.abs(self.work_grid[name] - reference).max()
+        writer = csv.writer(self.validation_file, delimiter=',')
+        writer.writerow([self.time * self.time_step] + [differences[name] for name in self.species_names])
+
+    def write_solver_step_report(self):
+        """
+        Write the number of diffusion updates of each field, the solver steps taken for them, and the effective
+        solver time step
+        :return:
+        """
+        with open(self.output_location + 'solver_step_report.csv', 'w') as report_file:
+            writer = csv.writer(report_file, delimiter=',')
+            writer.writerow(['field', 'updates', 'solver_steps', 'mean_time_step'])
+            for field in self.species_names:
+                updates = self.diffusion_updates[field] - self.skipped_updates[field]
+                mean_time_step = 0.0
+                if self.solver_steps[field] > 0:
+                    mean_time_step = updates * self.time_step * self.diffusion_interval / self.solver_steps[field]
+                writer.writerow([field, updates, self.solver_steps[field], mean_time_step])
+
+    def write_sparse_diffusion_report(self):
+        """
+        Write the mean fraction of the grid updated by each solver step of each field, and the speed-up over updating
+        the whole grid that this gives (in cells updated)
+        :return:
+        """
+        with open(self.output_location + 'sparse_diffusion_report.csv', 'w') as report_file:
+            writer = csv.writer(report_file, delimiter=',')
+            writer.writerow(['field', 'solver_steps', 'updated_fraction', 'speed_up'])
+            for field in self.species_names:
+                fraction = self.diffusion_engine.updated_fraction(field)
+                speed_up = 1.0 / fraction if fraction > 0 else float('inf')
+                writer.writerow([field, self.diffusion_engine.steps.get(field, 0), fraction, speed_up])
+
+    def coarse_errors(self, active_fields):
+        """
+        Advance the full resolution solutions of the fields solved on coarse grids (by the explicit scheme, at a
+        stable step), and write the largest difference between each and the coarse solution interpolated to the
+        agent grid, absolute and relative to the largest value of the full resolution solution
+        :param active_fields: Name, diffusion rate, source and decay of each field that was updated
+        :return:
+        """
+        update_time = self.time_step * self.diffusion_interval
+        for name, rate, source, decay in active_fields:
+            if name not in self.coarse_grids:
+                continue
+            steps = self.diffusion_sub_steps
+            stable_time_step = self.validation_engine.stable_time_step(name, rate, decay,
+                                                                       self.model_parameters['spatial_step'])
+            if stable_time_step is not None:
+                steps = max(steps, int(math.ceil(update_time / stable_time_step)))
+            reference = self.full_resolution_fields[name]
+            for step in range(steps):
+                self.validation_engine.step(name, reference, rate, source, decay, update_time / steps,
+                                            self.model_parameters['spatial_step'], reference)
+        row = [self.time * self.time_step]
+        for name in sorted(self.coarse_grids):
+            reference = self.full_resolution_fields[name]
+            error = np.abs(self.work_grid[name] - reference).max()
+            largest = np.abs(reference).max()
+            row += [error, error / largest if largest > 0 else 0.0]
+        writer = csv.writer(self.coarse_error_file, delimiter=',')
+        writer.writerow(row)
 
     # OVERRIDE
     def generate_events_from_agents(self):
+        if self.agent_bands is not None:
+            return self.subdomain_events()
+        return self.agent_events(self.bacteria, self.t_cells, self.macrophages, self.blood_vessel_addresses,
+                                 self.total_bacteria(), self.field_in_grid('chemotherapy'))
+
+    def agent_events(self, bacteria, t_cells, macrophages, blood_vessel_addresses, total_bacteria, chemotherapy):
+        """
+        Events of a set of agents - all of them, or those of a subdomain
+        :param bacteria: List of bacteria
+        :param t_cells: List of T-cells
+        :param macrophages: List of macrophages
+        :param blood_vessel_addresses: Addresses of the blood vessels recruiting
+        :param total_bacteria: Number of bacteria over the whole grid
+        :param chemotherapy: Whether there is any chemotherapy in the grid
+        :return:
+        """
         events = []
-        events += self.bacteria_processes()
-        events += self.t_cell_recruitment()
-        events += self.macrophage_recruitment()
-        events += self.chemotherapy_killing_bacteria()
-        events += self.chemotherapy_killing_macrophages()
-        events += self.t_cell_processes()
-        events += self.macrophage_processes()
+        events += self.bacteria_processes(bacteria)
+        events += self.t_cell_recruitment(blood_vessel_addresses, total_bacteria)
+        events += self.macrophage_recruitment(blood_vessel_addresses, total_bacteria)
+        # No chemotherapy in the grid, so nothing can be killed by it
+        if chemotherapy:
+            events += self.chemotherapy_killing_bacteria(bacteria)
+            events += self.chemotherapy_killing_macrophages(macrophages)
+        events += self.t_cell_processes(t_cells)
+        events += self.macrophage_processes(macrophages)
         return events
 
+    def subdomain_agents(self):
+        """
+        Agents and blood vessels of each subdomain, found from the row of their address
+        :return: List of dictionaries of bacteria, t_cells, macrophages and blood_vessel_addresses, one per subdomain
+        """
+        starts = [start for start, end in self.agent_bands]
+        subdomains = [dict(bacteria=[], t_cells=[], macrophages=[], blood_vessel_addresses=[])
+                      for band in self.agent_bands]
+        for kind, agents in [('bacteria', self.bacteria), ('t_cells', self.t_cells),
+                             ('macrophages', self.macrophages)]:
+            for agent in agents:
+                subdomains[bisect.bisect_right(starts, agent.address[0]) - 1][kind].append(agent)
+        for address in self.blood_vessel_addresses:
+            subdomains[bisect.bisect_right(starts, address[0]) - 1]['blood_vessel_addresses'].append(address)
+        return subdomains
+
+    def subdomain_core(self, index):
+        """
+        Rows of a subdomain which no other subdomain's events can reach. An event's addresses are at most max_depth
+        rows from its agent, so these are the rows further than that from any other subdomain
+        :param index: Index of the subdomain
+        :return: First row of the core, and the row after its last row
+        """
+        start, end = self.agent_bands[index]
+        if start > 0:
+            start += self.max_depth
+        if end < self.grid.shape[0]:
+            end -= self.max_depth
+        return start, max(start, end)
+
+    def subdomain_events(self):
+        """
+        Generate the agent events subdomain by subdomain, in parallel. Each subdomain's events are generated by its
+        worker process, with its own random stream (seeded from the main one), from the state of the subdomain and its
+        halo rows. The worker resolves the conflicts between those of its events which lie wholly in its core, as
+        conflict_resolve_events, and returns the events it accepts, the rest of its events (which touch boundary cells)
+        and the new ages of its agents
+        :return: Events touching boundary cells, left for the cross-domain pass of conflict_resolve_events
+        """
+        if self.agent_processes is None:
+            self.start_agent_workers()
+        subdomains = self.subdomain_agents()
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=len(subdomains))
+        # Counted over the whole grid, so not by the workers
+        total_bacteria = self.total_bacteria()
+        chemotherapy = self.field_in_grid('chemotherapy')
+        self.update_free_mask()
+        rows = self.grid.shape[0]
+        for (start, end), agents, seed, connection in zip(self.agent_bands, subdomains, seeds, self.agent_connections):
+            # Events reach at most max_depth rows beyond the subdomain, so nothing further out is needed
+            low, high = max(start - self.max_depth, 0), min(end + self.max_depth, rows)
+            fields = dict()
+            for field in ['contents', 'blood_vessel', 'oxygen', 'chemotherapy', 'chemokine']:
+                fields[field] = self.grid[field][low:high]
+            connection.send(dict(time=self.time, maxima=(self.max_oxygen, self.max_chemotherapy, self.max_chemokine),
+                                 total_bacteria=total_bacteria, chemotherapy=chemotherapy, seed=seed, rows=(low, high),
+                                 fields=fields, free_mask=self.free_mask[low:high], agents=agents))
+
+        boundary_events = []
+        self.subdomain_accepted = []
+        for connection, agents in zip(self.agent_connections, subdomains):
+            accepted, boundary, ages = connection.recv()
+            self.subdomain_accepted += accepted
+            boundary_events += boundary
+            # Ages were incremented in the worker's copy of the agents
+            for kind in ages:
+                for agent, age in zip(agents[kind], ages[kind]):
+                    agent.age = age
+        return boundary_events
+
+    def start_agent_workers(self):
+        """
+        Start a worker process for each subdomain of the agents
+        :return:
+        """
+        self.agent_processes = []
+        self.agent_connections = []
+        for index in range(len(self.agent_bands)):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=subdomain_agent_worker, args=(self, index, worker_connection))
+            process.daemon = True
+            process.start()
+            self.agent_processes.append(process)
+            self.agent_connections.append(connection)
+
+    def stop_agent_workers(self):
+        """
+        Stop the worker processes of the agent subdomains
+        :return:
+        """
+        if self.agent_processes is not None:
+            for connection in self.agent_connections:
+                connection.send(None)
+            for process in self.agent_processes:
+                process.join()
+            self.agent_processes = None
+            self.agent_connections = None
+
+    # OVERRIDE
+    def conflict_resolve_events(self):
+        """
+        With events generated by subdomain, the cross-domain conflict pass. The events touching boundary cells are
+        resolved as conflict_resolve_events, with the addresses impacted by the events which the subdomains accepted in
+        their cores already processed
+        :return:
+        """
+        if self.agent_bands is None:
+            return Automaton.conflict_resolve_events(self)
+        processed_addresses = set()
+        for event in self.subdomain_accepted:
+            processed_addresses.update(event.impacted_addresses)
+        acceptable_events = self.subdomain_accepted + self.resolve_events(self.potential_events, processed_addresses)
+        self.subdomain_accepted = []
+        return acceptable_events
+
     def oxygen_scale(self, address):
         if self.max_oxygen == 0.0:
             return 0.0
@@ -470,60 +933,188 @@ class TBAutomaton(Automaton):
         else:
             return (self.grid[address]['chemokine'] / self.max_chemokine) * 100.0
 
+    def chemokine_scales(self, indices):
+        """
+        Chemokine scale (as chemokine_scale) at a set of cells
+        :param indices: Flat indices of the cells
+        :return: Array of scales
+        """
+        chemokine = self.grid.values('chemokine', indices)
+        if self.max_chemokine == 0.0:
+            return np.zeros(len(chemokine))
+        return (chemokine / self.max_chemokine) * 100.0
+
+    def free_cells(self, indices):
+        """
+        Which of a set of cells are free - empty and not a blood vessel
+        :param indices: Flat indices of the cells
+        :return: Boolean array
+        """
+        self.update_free_mask()
+        return self.free_mask.ravel()[indices]
+
+    def free_neighbours(self, addresses, depth, type='moore'):
+        """
+        Free neighbours of many addresses (e.g. of every bacterium) in one call
+        :param addresses: List of addresses
+        :param depth: Depth of the neighbourhood
+        :param type: Type of neighbourhood (moore or von_neumann)
+        :return: Flat indices of the free neighbours of all the addresses, one address after another (each in the order
+                 of neighbour_indices), and offsets - those of the i-th address are at offsets[i]:offsets[i + 1]
+        """
+        neighbours, offsets = self.gather_neighbour_indices(addresses, depth, type)
+        free = self.free_cells(neighbours)
+        # Free neighbours before each position
+        free_counts = np.zeros(len(free) + 1, dtype=int)
+        np.cumsum(free, out=free_counts[1:])
+        return neighbours[free], free_counts[offsets]
+
+    def nearest_free_neighbours(self, addresses, type='moore', depth_map=None):
+        """
+        Free neighbours of many addresses at the lowest depth (up to the maximum depth) at which each address has any,
+        found from a map of the depth of the nearest free cell
+        :param addresses: List of addresses
+        :param type: Type of neighbourhood (moore or von_neumann)
+        :param depth_map: Depth of the nearest free cell in the neighbourhood, from nearest_depths of the free mask, if
+               already built (built here if None)
+        :return: Flat indices of the free neighbours of all the addresses, one address after another (each in the order
+                 of neighbour_indices), offsets - those of the i-th address are at offsets[i]:offsets[i + 1] - and
+                 the depth of each address's free neighbours (max_depth + 1 if there are none)
+        """
+        if not addresses:
+            return np.zeros(0, dtype=int), np.zeros(1, dtype=int), np.zeros(0, dtype=int)
+        self.update_free_mask()
+        if depth_map is None:
+            depth_map = self.nearest_depths(self.free_mask, type)
+        cells = self.flat_indices(addresses)
+        depths = depth_map.ravel()[cells]
+        # A free address is at depth 0 of the map, so its nearest free neighbours are searched for depth by depth
+        for index in np.flatnonzero(depths == 0):
+            depths[index] = self.max_depth + 1
+            for depth in range(1, self.max_depth + 1):
+                if self.free_cells(self.neighbour_indices(addresses[index], depth, type)).any():
+                    depths[index] = depth
+                    break
+        # Free neighbours of the addresses at each depth, then put back in the order of the addresses
+        free = [np.zeros(0, dtype=int)]
+        owners = [np.zeros(0, dtype=int)]
+        for depth in range(1, self.max_depth + 1):
+            at_depth = np.flatnonzero(depths == depth)
+            if len(at_depth) == 0:
+                continue
+            neighbours, offsets = self.gather_neighbour_indices([addresses[index] for index in at_depth], depth, type)
+            is_free = self.free_cells(neighbours)
+            free.append(neighbours[is_free])
+            owners.append(np.repeat(at_depth, np.diff(offsets))[is_free])
+        free = np.concatenate(free)
+        owners = np.concatenate(owners)
+        order = np.argsort(owners, kind='mergesort')
+        offsets = np.zeros(len(cells) + 1, dtype=int)
+        np.cumsum(np.bincount(owners, minlength=len(cells)), out=offsets[1:])
+        return free[order], offsets, depths
+
+    def sample_free_neighbours(self, addresses, number, type='moore'):
+        """
+        Up to a number of free neighbours around each of many addresses, nearest depths first and in random order
+        within a depth (each depth's neighbours are shuffled, up to the depth at which enough are found)
+        :param addresses: List of addresses
+        :param number: Number of free neighbours wanted for each address
+        :param type: Type of neighbourhood (moore or von_neumann)
+        :return: List of the addresses of the free neighbours found for each address
+        """
+        samples = []
+        for address in addresses:
+            sample = []
+            for depth in range(1, self.max_depth + 1):
+                neighbours = self.neighbour_indices(address, depth, type).copy()
+                # Shuffle the neighbours so we don't give priority
+                np.random.shuffle(neighbours)
+                sample += self.addresses_of(neighbours[self.free_cells(neighbours)][:number - len(sample)])
+                # Enough found so don't check other depths
+                if len(sample) == number:
+                    break
+            samples.append(sample)
+        return samples
+
+    def update_free_mask(self):
+        """
+        Bring the free cell mask up to date with any cells written straight to the grid (rather than by events)
+        :return:
+        """
+        if self.grid.changed:
+            for address in self.grid.changed:
+                self.free_mask[address] = self.grid[address]['contents'] == 0 and \
+                                          self.grid[address]['blood_vessel'] == 0.0
+            self.grid.changed.clear()
+
     def total_bacteria(self):
         return len(self.bacteria) + sum([m.intracellular_bacteria for m in self.macrophages])
 
     def find_max_chemokine_neighbour(self, neighbours):
         """
-        Given neighbour addresses, find the neighbour which has the highest level of chemokine
-        :param neighbours:
-        :return:
+        Given neighbours, find the neighbour which has the highest level of chemokine
+        :param neighbours: Flat indices of the neighbours (from neighbour_indices)
+        :return: Address of the neighbour and its chemokine scale
         """
-        max_chemokine = 0.0
-        highest_indices = []
-        for index in neighbours:
-
-            if neighbours[index]['chemokine'] > max_chemokine:
-                max_chemokine = neighbours[index]['chemokine']
-                highest_indices = [index]
-            elif neighbours[index]['chemokine'] == max_chemokine:
-                highest_indices.append(index)
+        chemokine = self.grid.values('chemokine', neighbours)
+        highest_indices = neighbours[chemokine == max(chemokine.max(), 0.0)]
 
         # Tie-breaking. If just one pick it, else pick any one index at random
         choice = np.random.randint(0, len(highest_indices))
-        chosen_index = highest_indices[choice]
+        chosen_address = self.addresses_of(highest_indices[choice])
 
-        return [chosen_index, self.chemokine_scale(chosen_index)]
+        return [chosen_address, self.chemokine_scale(chosen_address)]
 
-    def bacteria_processes(self):
+    def bacteria_processes(self, bacteria=None):
         """
         Bacteria replicate (produce a new bacterium agent) once they reach a certain age.
+        :param bacteria: Bacteria to process (all of them if None)
         :return:
         """
+        if bacteria is None:
+            bacteria = self.bacteria
         bacteria_events = []
+        # Bacteria grouped by resting, or by the neighbourhood they divide into, and the position of each in its group
+        addresses = {'resting': [], 'moore': [], 'von_neumann': []}
+        positions = []
+        for bacterium in bacteria:
+            if bacterium.resting:
+                group = 'resting'
+            elif bacterium.division_neighbourhood == 'mo':
+                group = 'moore'
+            else:
+                group = 'von_neumann'
+            positions.append(len(addresses[group]))
+            addresses[group].append(bacterium.address)
+        # Depth of the nearest free cell in each neighbourhood the bacteria divide into, built once for every cell
+        self.update_free_mask()
+        depth_maps = dict()
+        for type in ['moore', 'von_neumann']:
+            if addresses[type]:
+                depth_maps[type] = self.nearest_depths(self.free_mask, type)
+        # Resting bacteria wake if any Moore neighbour up to depth 3 is free - any free cell within a Chebyshev distance
+        # of 3, as the bacterium's own cell is not free. Read from the Moore depth map if there is one, else counted
+        # for every cell at once
+        if addresses['resting']:
+            cells = self.flat_indices(addresses['resting'])
+            if 'moore' in depth_maps:
+                free_space = depth_maps['moore'].ravel()[cells] <= 3
+            else:
+                free_space = self.box_sum(self.free_mask, 3).ravel()[cells] > 0
+        # Free neighbours of every other bacterium at the lowest depth with any, in the neighbourhood it divides into
+        free_neighbours = dict()
+        for type in ['moore', 'von_neumann']:
+            free_neighbours[type] = self.nearest_free_neighbours(addresses[type], type, depth_maps.get(type))
         # Loop through every bacteria, check age against a (stochastic) threshold, generate event if age is higher than
         # threshold
-        for bacterium in self.bacteria:
+        for bacterium, position in zip(bacteria, positions):
             # Increment age
             bacterium.age += self.time_step
             # If the bacterium is resting, check if it can become non-resting (space available)
             if bacterium.resting:
-                space_found = False
-                for depth in range(1, 4):
-                    # Get neighbours
-                    neighbours = self.moore_neighbours(bacterium.address, depth)
-                    for n in neighbours:
-                        # Is neighbour empty?
-                        neighbour = self.grid[n]
-                        if neighbour is not None and neighbour['blood_vessel'] == 0.0 and neighbour['contents'] == 0:
-                            new_event = BacteriumStateChange(bacterium.address, 'resting', False)
-                            bacteria_events.append(new_event)
-                            space_found = True
-                            # Don't check other neighbours
-                            break
-                    # Space found so don't check further depths
-                    if space_found:
-                        break
+                if free_space[position]:
+                    new_event = BacteriumStateChange(bacterium.address, 'resting', False)
+                    bacteria_events.append(new_event)
                 # Skip to next bacterium, resting bacteria can't perform other actions
                 continue
 
@@ -553,112 +1144,110 @@ class TBAutomaton(Automaton):
             # If the time is sufficient enough, bacteria can replicate
             if self.time % replication_time == 0:
 
-                # Look for free neighbours
-                free_neighbours = []
-                # TODO - COMP - maybe 4 shouldn't be hard coded?
-                for depth in range(1, 4):
-                    # Pull the neighbours from the appropriate neighbourhood
-                    if bacterium.division_neighbourhood == 'mo':
-                        neighbours = self.moore_neighbours(bacterium.address, depth)
-                    else:
-                        neighbours = self.von_neumann_neighbours(bacterium.address, depth)
-                    # Find a free neighbour (not a blood vessel and contents == 0.0)
-                    for neighbour_address in neighbours:
-                        neighbour = self.grid[neighbour_address]
-                        if neighbour is not None and neighbour['contents'] == 0 and neighbour['blood_vessel'] == 0.0:
-                            free_neighbours.append(neighbour_address)
-                    # If a free neighbour found, don't look at greater depths
-                    if len(free_neighbours) > 0:
-                        break
+                # Free neighbours (not a blood vessel and contents == 0.0) at the lowest depth up to 3, from the
+                # appropriate neighbourhood
+                if bacterium.division_neighbourhood == 'mo':
+                    free, offsets = free_neighbours['moore'][:2]
+                else:
+                    free, offsets = free_neighbours['von_neumann'][:2]
+                bacterium_free_neighbours = free[offsets[position]:offsets[position + 1]]
                 # A free neighbour has not been found anywhere
-                if len(free_neighbours) == 0:
+                if len(bacterium_free_neighbours) == 0:
                     # Bacterium will change to resting state (quorum sensing)
                     new_event = BacteriumStateChange(bacterium.address, 'resting', True)
                     bacteria_events.append(new_event)
                 else:  # Free space found
                     # Pick a free neighbour at random
-                    neighbour_address = free_neighbours[np.random.randint(len(free_neighbours))]
+                    neighbour_address = self.addresses_of(
+                        bacterium_free_neighbours[np.random.randint(len(bacterium_free_neighbours))])
                     # Create event and add to list of potential events
                     new_event = BacteriumReplication(bacterium.address, neighbour_address, bacterium.metabolism)
                     bacteria_events.append(new_event)
 
         return bacteria_events
 
-    def t_cell_recruitment(self):
+    def t_cell_recruitment(self, blood_vessel_addresses=None, total_bacteria=None):
         """
         Once bacteria over entire system reach a threshold, t-cells enter the system. Creates an event to add a t-cell
         to a cell next to a blood vessel
+        :param blood_vessel_addresses: Addresses of the blood vessels recruiting (all of them if None)
+        :param total_bacteria: Number of bacteria over the whole grid (counted if None)
         :return:
         """
+        if blood_vessel_addresses is None:
+            blood_vessel_addresses = self.blood_vessel_addresses
+        if total_bacteria is None:
+            total_bacteria = self.total_bacteria()
         t_cell_recruitment_events = []
         # When global amount of bacteria exceeds threshold
-        if self.total_bacteria() >= self.model_parameters['bacteria_threshold_for_t_cells']:
+        if total_bacteria >= self.model_parameters['bacteria_threshold_for_t_cells']:
+            # Free von Neumann neighbours of every blood vessel
+            free, offsets = self.free_neighbours(blood_vessel_addresses, 1, 'von_neumann')
             # Each blood vessel
-            for blood_vessel_address in self.blood_vessel_addresses:
+            for index, blood_vessel_address in enumerate(blood_vessel_addresses):
                 # Generate event if probability according to parameters
                 r = np.random.randint(1, 101)
                 if r <= self.model_parameters['t_cell_recruitment_probability']:
-                    # Get von Neumann neighbours
-                    neighbours = self.von_neumann_neighbours(blood_vessel_address,1)
-                    # Loop through all neighbours to find suitable options
-                    free_neighbours = []
-                    for neighbour_address in neighbours:
-                        neighbour = self.grid[neighbour_address]
-                        # Check neighbour is on the grid, is empty and has a sufficiently high chemokine level
-                        if neighbour is not None and neighbour['blood_vessel'] == 0.0 and neighbour['contents'] == 0 \
-                                and self.chemokine_scale(neighbour_address) > \
-                                self.model_parameters['chemokine_scale_for_t_cell_recruitment']:
-                            free_neighbours.append(neighbour_address)
+                    # Suitable neighbours are empty and have a sufficiently high chemokine level
+                    free_neighbours = free[offsets[index]:offsets[index + 1]]
+                    free_neighbours = free_neighbours[self.chemokine_scales(free_neighbours) >
+                                                      self.model_parameters['chemokine_scale_for_t_cell_recruitment']]
                     # Check there is at least one suitable neighbour
                     if len(free_neighbours) > 0:
                         # Pick one of the neighbours
-                        neighbour_address = free_neighbours[np.random.randint(len(free_neighbours))]
+                        neighbour_address = self.addresses_of(free_neighbours[np.random.randint(len(free_neighbours))])
                         # Create event
                         new_event = RecruitTCell(blood_vessel_address, neighbour_address)
                         t_cell_recruitment_events.append(new_event)
         return t_cell_recruitment_events
 
-    def macrophage_recruitment(self):
+    def macrophage_recruitment(self, blood_vessel_addresses=None, total_bacteria=None):
         """
         Each step for each source vessel, there is a probability that macrophage will be recruited
+        :param blood_vessel_addresses: Addresses of the blood vessels recruiting (all of them if None)
+        :param total_bacteria: Number of bacteria over the whole grid (counted if None)
         :return:
         """
+        if blood_vessel_addresses is None:
+            blood_vessel_addresses = self.blood_vessel_addresses
+        if total_bacteria is None:
+            total_bacteria = self.total_bacteria()
         recruitment_events = []
-        if self.total_bacteria() >= self.model_parameters['bacteria_threshold_for_macrophage_recruitment']:
+        if total_bacteria >= self.model_parameters['bacteria_threshold_for_macrophage_recruitment']:
             chemokine_threshold = self.model_parameters['chemokine_scale_for_macrophage_recruitment_above_threshold']
         else:
             chemokine_threshold = self.model_parameters['chemokine_scale_for_macrophage_recruitment_below_threshold']
 
+        # Free von Neumann neighbours of every blood vessel
+        free, offsets = self.free_neighbours(blood_vessel_addresses, 1, 'von_neumann')
         # Loop through each blood vessel
-        for bv_address in self.blood_vessel_addresses:
+        for index, bv_address in enumerate(blood_vessel_addresses):
             # Generate event with probability based on parameters
             r = np.random.randint(1, 101)
             if r <= self.model_parameters['macrophage_recruitment_probability']:
                 # Get neighbours, then reduce to those that are free and have sufficient chemokine scale
-                neighbours = self.von_neumann_neighbours(bv_address, 1)
-                free_neighbours = []
-                for neighbour_address in neighbours:
-                    neighbour = self.grid[neighbour_address]
-                    if neighbour is not None and neighbour['blood_vessel'] == 0.0 and neighbour['contents'] == 0 and \
-                            self.chemokine_scale(neighbour_address) > chemokine_threshold:
-                        free_neighbours.append(neighbour_address)
+                free_neighbours = free[offsets[index]:offsets[index + 1]]
+                free_neighbours = free_neighbours[self.chemokine_scales(free_neighbours) > chemokine_threshold]
 
                 if len(free_neighbours) > 0:
                     # Pick one of the neighbours
-                    chosen_neighbour = free_neighbours[np.random.randint(len(free_neighbours))]
+                    chosen_neighbour = self.addresses_of(free_neighbours[np.random.randint(len(free_neighbours))])
                     # Create event
                     new_event = RecruitMacrophage(bv_address, chosen_neighbour)
                     recruitment_events.append(new_event)
         return recruitment_events
 
-    def chemotherapy_killing_bacteria(self):
+    def chemotherapy_killing_bacteria(self, bacteria=None):
         """
         Chemotherapy destroys bacterium if the level is high enough
+        :param bacteria: Bacteria to process (all of them if None)
         :return:
         """
+        if bacteria is None:
+            bacteria = self.bacteria
         chemo_kill_bac_events = []
         # Loop through all bacteria
-        for bacterium in self.bacteria:
+        for bacterium in bacteria:
             # Check chemotherapy scale against relevant parameter based on metabolism
             chemo_scale = self.chemotherapy_scale(bacterium.address)
             if (bacterium.metabolism == 'fast' and chemo_scale >
@@ -670,10 +1259,17 @@ class TBAutomaton(Automaton):
                 chemo_kill_bac_events.append(new_event)
         return chemo_kill_bac_events
 
-    def chemotherapy_killing_macrophages(self):
+    def chemotherapy_killing_macrophages(self, macrophages=None):
+        """
+        Chemotherapy destroys infected macrophages if the level is high enough
+        :param macrophages: Macrophages to process (all of them if None)
+        :return:
+        """
+        if macrophages is None:
+            macrophages = self.macrophages
         chemo_kill_mac_events = []
         # Loop through all macrophages
-        for macrophage in self.macrophages:
+        for macrophage in macrophages:
             # Check chemotherapy scale against relevant parameter based on metabolism
             chemo_scale = self.chemotherapy_scale(macrophage.address)
             if (macrophage.state == 'infected' or macrophage.state == 'chronically_infected') \
@@ -683,18 +1279,21 @@ class TBAutomaton(Automaton):
                 chemo_kill_mac_events.append(new_event)
         return chemo_kill_mac_events
 
-    def t_cell_processes(self):
+    def t_cell_processes(self, t_cells=None):
         """
         T-cells movement, death and apoptosis of other agents
+        :param t_cells: T-cells to process (all of them if None)
         :return:
         """
+        if t_cells is None:
+            t_cells = self.t_cells
         t_cell_events = []
 
         # T-cells only move after set period of time
         if self.time % self.model_parameters['t_cell_movement_time'] == 0:
 
             # Loop through all T-cells
-            for t_cell in self.t_cells:
+            for t_cell in t_cells:
                 # Increment age
                 t_cell.age += self.time_step
                 # Stochastic age threshold
@@ -712,11 +1311,11 @@ class TBAutomaton(Automaton):
                     if prob_random_move <= self.model_parameters['t_cell_random_move_probability']:
                         random_move = True
                     # Get neighbours
-                    neighbours = self.moore_neighbours(t_cell.address, 1)
+                    neighbours = self.neighbour_indices(t_cell.address, 1)
                     # If a random move, pick a neighbour at random
                     if random_move:
                         index = np.random.randint(0, len(neighbours))
-                        chosen_neighbour_address = neighbours.keys()[index]
+                        chosen_neighbour_address = self.addresses_of(neighbours[index])
                     else: # Pick the neighbour with the highest chemokine level
                         chosen_neighbour_address = self.find_max_chemokine_neighbour(neighbours)[0]
 
@@ -736,14 +1335,17 @@ class TBAutomaton(Automaton):
                             t_cell_events.append(new_event)
         return t_cell_events
 
-    def macrophage_processes(self):
+    def macrophage_processes(self, macrophages=None):
         """
         Macrophages move, die and ingest bacteria
+        :param macrophages: Macrophages to process (all of them if None)
         :return:
         """
+        if macrophages is None:
+            macrophages = self.macrophages
         mac_events = []
         # Loop through macrophages
-        for macrophage in self.macrophages:
+        for macrophage in macrophages:
             death = False
             activate = False
             deactivate = False
@@ -768,7 +1370,7 @@ class TBAutomaton(Automaton):
                     else:
                         # Chemokine moves on random biased walk. Random move with probability based on parameters, if
                         # highest chemokine scale at neighbours does not exceed threshold, then also random move
-                        neighbours = self.moore_neighbours(macrophage.address, 1)
+                        neighbours = self.neighbour_indices(macrophage.address, 1)
                         max_chemokine_address, max_chemokine_scale = self.find_max_chemokine_neighbour(neighbours)
                         # Generate random number for probability of random move
                         prob_random_move = np.random.randint(1, 101)
@@ -779,7 +1381,8 @@ class TBAutomaton(Automaton):
                             random_move = True
                         # Pick the neighbour to move to, either random or highest chemokine scale
                         if random_move:
-                            chosen_neighbour_address = neighbours.keys()[np.random.randint(0, len(neighbours))]
+                            chosen_neighbour_address = self.addresses_of(
+                                neighbours[np.random.randint(0, len(neighbours))])
                         else:
                             chosen_neighbour_address = max_chemokine_address
                         # Check if leaving the grid
@@ -804,7 +1407,7 @@ class TBAutomaton(Automaton):
                         death = True
                     else:
                         # Active macrophages always move to highest chemokine neighbour
-                        neighbours = self.moore_neighbours(macrophage.address, 1)
+                        neighbours = self.neighbour_indices(macrophage.address, 1)
                         chosen_neighbour_address = self.find_max_chemokine_neighbour(neighbours)[0]
                         neighbour = self.grid[chosen_neighbour_address]
                         # If cell to move to has a bacterium
@@ -830,7 +1433,7 @@ class TBAutomaton(Automaton):
                         death = True
                     else:
                         # Infected move to highest chemokine neighbour
-                        neighbours = self.moore_neighbours(macrophage.address, 1)
+                        neighbours = self.neighbour_indices(macrophage.address, 1)
                         chosen_neighbour_address = self.find_max_chemokine_neighbour(neighbours)[0]
                         neighbour = self.grid[chosen_neighbour_address]
                         # Neighbour is empty, so move event
@@ -856,7 +1459,7 @@ class TBAutomaton(Automaton):
                         death = True
                     else:
                         # Move to highest chemokine scale neighbour
-                        neighbours = self.moore_neighbours(macrophage.address, 1)
+                        neighbours = self.neighbour_indices(macrophage.address, 1)
                         chosen_neighbour_address = self.find_max_chemokine_neighbour(neighbours)[0]
                         neighbour = self.grid[chosen_neighbour_address]
                         # Neighbour is empty, so move event
@@ -868,26 +1471,9 @@ class TBAutomaton(Automaton):
 
             # Determine which event is happening
             if burst:
-                # Loop through all neighbours (up to depth 3) and try to find enough empty space to distribute bacteria
-                bacteria_addresses = []
-                for depth in range(1, 4):
-                    neighbours = self.moore_neighbours(macrophage.address, depth).keys()
-                    # Shuffle the neighbours so we don't give priority
-                    np.random.shuffle(neighbours)
-                    for n in neighbours:
-                        # Find empty neighbours
-                        neighbour = self.grid[n]
-                        if neighbour['contents'] == 0 and neighbour['blood_vessel'] == 0.0:
-                            bacteria_addresses.append(n)
-                        # Limit reached - break here stops checking other neighbours at this depth, also need to
-                        # stop searching further depths
-                        if len(bacteria_addresses) == self.model_parameters['bacteria_to_burst_macrophage']:
-                            # Break neighbour loop
-                            break
-                    # Limit reached earlier so don't check other depths
-                    if len(bacteria_addresses) == self.model_parameters['bacteria_to_burst_macrophage']:
-                        # Break depth loop
-                        break
+                # Look through all neighbours (up to depth 3) and try to find enough empty space to distribute bacteria
+                bacteria_addresses = self.sample_free_neighbours(
+                    [macrophage.address], int(self.model_parameters['bacteria_to_burst_macrophage']))[0]
                 new_event = MacrophageBursts(macrophage.address, bacteria_addresses)
                 mac_events.append(new_event)
             elif death:
@@ -907,3 +1493,47 @@ class TBAutomaton(Automaton):
                 mac_events.append(new_event)
 
         return mac_events
+
+
+def subdomain_agent_worker(automaton, index, connection):
+    """
+    Worker process generating the events of one subdomain (forked from the automaton, so with its own copy of it).
+    Each message gives the time, the state of the subdomain and its halo rows, and the agents of the subdomain, which
+    are written into the copy before the events are generated. Sends back the events lying wholly in the subdomain's
+    core that are accepted by a conflict pass among themselves, the rest of the events, and the ages of the agents
+    (incremented by the rules). Stops on a message of None
+    :param automaton: The automaton
+    :param index: Index of the subdomain
+    :param connection: Connection to the automaton
+    :return:
+    """
+    start, end = automaton.subdomain_core(index)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        automaton.time = message['time']
+        automaton.max_oxygen, automaton.max_chemotherapy, automaton.max_chemokine = message['maxima']
+        low, high = message['rows']
+        for field, values in message['fields'].items():
+            automaton.grid[field][low:high] = values
+        automaton.free_mask[low:high] = message['free_mask']
+        automaton.grid.changed.clear()
+        agents = message['agents']
+
+        np.random.seed(message['seed'])
+        events = automaton.agent_events(agents['bacteria'], agents['t_cells'], agents['macrophages'],
+                                        agents['blood_vessel_addresses'], message['total_bacteria'],
+                                        message['chemotherapy'])
+        core_events = []
+        boundary_events = []
+        for event in events:
+            if all([start <= address[0] < end for address in event.dependent_addresses + event.impacted_addresses]):
+                core_events.append(event)
+            else:
+                boundary_events.append(event)
+        ages = dict()
+        for kind in ['bacteria', 't_cells', 'macrophages']:
+            ages[kind] = [agent.age for agent in agents[kind]]
+        connection.send((automaton.resolve_events(core_events, set()), boundary_events, ages))
+    connection.close()
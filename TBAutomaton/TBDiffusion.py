@@ -0,0 +1,1227 @@
+import numpy as np
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    import scipy.fftpack
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    scipy = None
+
+
+class DiffusionEngine:
+
+    def __init__(self, shape):
+        """
+        Finite difference diffusion for fields on a grid. Each field is copied into a buffer padded with a one-cell
+        halo. The boundary condition is applied by filling the halo, so every cell (edges and corners included) is
+        updated by the same five-point stencil in a single vectorised evaluation.
+        :param shape: Shape of the (unpadded) grid
+        """
+        self.shape = tuple(shape)
+        self.padded_shape = (self.shape[0] + 2, self.shape[1] + 2)
+        # Padded buffers, keyed by name. Allocated on first use and then reused every step
+        self.padded = {}
+        # Diffusion coefficients derived from the rates of each field, keyed by field name. Kept until invalidated
+        self.coefficients = {}
+        # Working arrays for intermediate results, keyed by name. Shared by all fields
+        self.scratch = {}
+        # Largest total of the face rates of any cell, keyed by field name. Kept until invalidated
+        self.face_rate_totals = {}
+
+    def pad(self, name, values):
+        """
+        Copy values into the interior of the named padded buffer and fill the halo. The halo mirrors the cells one
+        step in from the boundary (zero-flux boundary), which matches the 2 * neighbour terms used by the original
+        edge and corner equations.
+        :param name: Name of the buffer
+        :param values: Array of grid shape
+        :return: The padded buffer
+        """
+        if name not in self.padded:
+            self.padded[name] = np.zeros(self.padded_shape, dtype=float)
+        buffer = self.padded[name]
+        buffer[1:-1, 1:-1] = values
+        # Rows first, then columns (columns include the corners of the halo)
+        buffer[0, 1:-1] = buffer[2, 1:-1]
+        buffer[-1, 1:-1] = buffer[-3, 1:-1]
+        buffer[:, 0] = buffer[:, 2]
+        buffer[:, -1] = buffer[:, -3]
+        return buffer
+
+    def scratch_buffer(self, name, shape):
+        """
+        Working array for intermediate results. Allocated on first use and then reused every step
+        :param name: Name of the buffer
+        :param shape: Shape of the buffer (buffers of the same name but different shapes are kept separately)
+        :return:
+        """
+        key = (name, shape)
+        if key not in self.scratch:
+            self.scratch[key] = np.empty(shape, dtype=float)
+        return self.scratch[key]
+
+    def invalidate(self, name=None):
+        """
+        Discard cached diffusion coefficients. Must be called whenever the diffusion rates of a field change
+        :param name: Name of the field (all fields if None)
+        :return:
+        """
+        if name is None:
+            self.coefficients.clear()
+            self.face_rate_totals.clear()
+        else:
+            self.coefficients.pop(name, None)
+            self.face_rate_totals.pop(name, None)
+
+    def close(self):
+        """
+        Release any resources held by the engine (none by default)
+        :return:
+        """
+        pass
+
+    def face_rates(self, name, rate):
+        """
+        Diffusion rates on the faces between cells (the average of the rates of the two cells either side). Faces on
+        the boundary use the mirrored halo. Cached until invalidated
+        :param name: Name of the field
+        :param rate: Array of diffusion rates of grid shape
+        :return: Rates on the faces below and to the right of each cell, laid out as the padded buffers (so
+                 [i, j] is the face between padded cells [i, j] and [i + 1, j] / [i, j + 1])
+        """
+        if name not in self.coefficients:
+            rates = self.pad(name + '_rate', rate).ravel()
+            row_stride = self.padded_shape[1]
+            row_face_rates = np.zeros(self.padded_shape, dtype=float)
+            column_face_rates = np.zeros(self.padded_shape, dtype=float)
+            row_face_rates.ravel()[:-row_stride] = (rates[:-row_stride] + rates[row_stride:]) / 2
+            column_face_rates.ravel()[:-1] = (rates[:-1] + rates[1:]) / 2
+            self.coefficients[name] = (row_face_rates, column_face_rates)
+        return self.coefficients[name]
+
+    def stable_time_step(self, name, rate, decay, spatial_step):
+        """
+        Largest time step for which the explicit scheme is stable (and keeps fields non-negative), i.e. in every cell
+            dt * (total of the rates on the four faces of the cell / dx^2 + decay) <= 1
+        The largest face rate total and largest decay are used (which may be from different cells)
+        :param name: Name of the field
+        :param rate: Diffusion rate - either a single value or an array of grid shape
+        :param decay: Proportion removed per unit time - single value or array of grid shape
+        :param spatial_step: Distance between cells
+        :return: The time step, or None if any time step is stable
+        """
+        if np.isscalar(rate):
+            face_rate_total = 4 * rate
+        else:
+            if name not in self.face_rate_totals:
+                row_face_rates, column_face_rates = self.face_rates(name, rate)
+                totals = row_face_rates[1:-1, 1:-1] + row_face_rates[:-2, 1:-1] + column_face_rates[1:-1, 1:-1] + \
+                    column_face_rates[1:-1, :-2]
+                self.face_rate_totals[name] = totals.max()
+            face_rate_total = self.face_rate_totals[name]
+        limit = face_rate_total / spatial_step ** 2 + np.max(decay)
+        if limit <= 0:
+            return None
+        return 1.0 / limit
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one explicit time step:
+            new = old + dt * (div(rate * grad(old)) / dx^2 + source - decay * old)
+        Rates between two cells are the average of the rates of the two cells. For array rates these face rates are
+        cached, so invalidate() must be called if the rates change.
+        :param name: Name of the field (used to key the padded buffers)
+        :param values: Current values of the field
+        :param rate: Diffusion rate - either a single value or an array of grid shape
+        :param source: Amount added per unit time - single value or array of grid shape
+        :param decay: Proportion removed per unit time - single value or array of grid shape
+        :param time_step: Time step
+        :param spatial_step: Distance between cells
+        :param out: Array of grid shape to write new values to
+        :return: Maximum of the new values
+        """
+        if np.isscalar(rate):
+            row_face_rates = column_face_rates = rate
+        else:
+            row_face_rates, column_face_rates = self.face_rates(name, rate)
+        divergence = self.divergence(self.pad(name, values), row_face_rates, column_face_rates, spatial_step)
+        return self.advance(divergence, values, source, decay, time_step, out)
+
+    def advance(self, divergence, values, source, decay, time_step, out):
+        """
+        Apply the explicit update, given the divergence of the padded field
+        :param divergence: Divergence, laid out as the padded buffer (as divergence)
+        :param values: Current values of the field
+        :param source: Amount added per unit time - single value or array of the shape of values
+        :param decay: Proportion removed per unit time - single value or array of the shape of values
+        :param time_step: Time step
+        :param out: Array to write new values to
+        :return: Maximum of the new values
+        """
+        update = self.scratch_buffer('update', self.shape)
+        term = self.scratch_buffer('term', self.shape)
+        update[...] = divergence[1:-1, 1:-1]
+
+        # new = old + dt * ((divergence + source) - decay * old), evaluated in place in that order
+        np.add(update, source, out=update)
+        np.multiply(decay, values, out=term)
+        np.subtract(update, term, out=update)
+        np.multiply(time_step, update, out=update)
+        np.add(values, update, out=out)
+        # Taken while the new values are still in cache, so the automaton needs no separate pass over the field
+        return out.max()
+
+    def step_fields(self, fields, time_step, spatial_step):
+        """
+        Advance several fields by one time step
+        :param fields: Name, current values, diffusion rate, source, decay and output array of each field (as step)
+        :param time_step: Time step
+        :param spatial_step: Distance between cells
+        :return: Maximum of the new values of each field
+        """
+        maxima = []
+        for name, values, rate, source, decay, out in fields:
+            maxima.append(self.step(name, values, rate, source, decay, time_step, spatial_step, out))
+        return maxima
+
+    def divergence(self, padded, row_face_rates, column_face_rates, spatial_step):
+        """
+        Flux differences / dx^2 (below minus above, plus right minus left) for every cell of a padded buffer (or a
+        stack of padded buffers). The stencil works on the flattened buffer, where the neighbours above and below a
+        cell are a row stride away, so every operation is over contiguous memory and needs no temporary arrays.
+        Results for the halo cells are not used.
+        :param padded: Padded buffer(s) of the field(s)
+        :param row_face_rates: Single rate, or face rates laid out as the padded buffer(s) (as face_rates)
+        :param column_face_rates: Single rate, or face rates laid out as the padded buffer(s)
+        :param spatial_step: Distance between cells
+        :return: Scratch buffer of the same shape as padded
+        """
+        field = padded.ravel()
+        row_stride = self.padded_shape[1]
+        interior = slice(row_stride, field.size - row_stride)
+        row_flux = self.scratch_buffer('row_flux', (field.size - row_stride,))
+        column_flux = self.scratch_buffer('column_flux', (field.size - 1,))
+        divergence = self.scratch_buffer('divergence', padded.shape)
+        column_divergence = self.scratch_buffer('column_divergence', (field.size,))
+        if not np.isscalar(row_face_rates):
+            row_face_rates = row_face_rates.ravel()[:-row_stride]
+            column_face_rates = column_face_rates.ravel()[:-1]
+
+        spatial_step_squared = spatial_step ** 2
+
+        # Flux across each face, computed once and shared by the cells either side
+        np.subtract(field[row_stride:], field[:-row_stride], out=row_flux)
+        np.multiply(row_face_rates, row_flux, out=row_flux)
+        np.subtract(field[1:], field[:-1], out=column_flux)
+        np.multiply(column_face_rates, column_flux, out=column_flux)
+
+        flat_divergence = divergence.ravel()
+        np.subtract(row_flux[row_stride:], row_flux[:-row_stride], out=flat_divergence[interior])
+        np.divide(flat_divergence[interior], spatial_step_squared, out=flat_divergence[interior])
+        np.subtract(column_flux[row_stride:-row_stride + 1], column_flux[row_stride - 1:-row_stride],
+                    out=column_divergence[interior])
+        np.divide(column_divergence[interior], spatial_step_squared, out=column_divergence[interior])
+        np.add(flat_divergence[interior], column_divergence[interior], out=flat_divergence[interior])
+        return divergence
+
+
+class StackedDiffusionEngine(DiffusionEngine):
+
+    def __init__(self, shape):
+        """
+        Explicit diffusion of all fields at once. The fields are stacked into one (fields, rows, columns) array, with
+        per-field diffusion rates, sources and decays, and each operation of the stencil is a single call over the
+        whole stack. Same scheme (and results) as DiffusionEngine.
+        :param shape: Shape of the grid
+        """
+        DiffusionEngine.__init__(self, shape)
+
+    def invalidate(self, name=None):
+        """
+        Discard cached diffusion coefficients, including those of any stack containing the field
+        :param name: Name of the field (all fields if None)
+        :return:
+        """
+        DiffusionEngine.invalidate(self, name)
+        for key in self.coefficients.keys():
+            if isinstance(key, tuple) and name in [field for field, rate in key]:
+                del self.coefficients[key]
+
+    def stacked_face_rates(self, fields):
+        """
+        Face rates of each field, stacked. Single rates are expanded to arrays (the average of two equal rates is the
+        rate itself). Cached until invalidated
+        :param fields: Fields as step_fields
+        :return: Row and column face rates, each of shape (fields, padded rows, padded columns)
+        """
+        key = tuple((name, rate if np.isscalar(rate) else None) for name, values, rate, source, decay, out in fields)
+        if key not in self.coefficients:
+            row_face_rates = np.zeros((len(fields),) + self.padded_shape, dtype=float)
+            column_face_rates = np.zeros((len(fields),) + self.padded_shape, dtype=float)
+            for index, (name, values, rate, source, decay, out) in enumerate(fields):
+                if np.isscalar(rate):
+                    row_face_rates[index] = rate
+                    column_face_rates[index] = rate
+                else:
+                    row_face_rates[index], column_face_rates[index] = self.face_rates(name, rate)
+            self.coefficients[key] = (row_face_rates, column_face_rates)
+        return self.coefficients[key]
+
+    def step_fields(self, fields, time_step, spatial_step):
+        """
+        Advance several fields by one time step, in a single batched stencil evaluation. Parameters as
+        DiffusionEngine.step_fields
+        :return: Maximum of the new values of each field
+        """
+        if not fields:
+            return []
+        stack_shape = (len(fields),) + self.shape
+        values = self.scratch_buffer('stack_values', stack_shape)
+        sources = self.scratch_buffer('stack_sources', stack_shape)
+        decays = self.scratch_buffer('stack_decays', stack_shape)
+        update = self.scratch_buffer('stack_update', stack_shape)
+        term = self.scratch_buffer('stack_term', stack_shape)
+        padded = self.scratch_buffer('stack_padded', (len(fields),) + self.padded_shape)
+        for index, (name, field_values, rate, source, decay, out) in enumerate(fields):
+            values[index] = field_values
+            sources[index] = source
+            decays[index] = decay
+
+        # Fill the stack of padded buffers and their halos (as pad)
+        padded[:, 1:-1, 1:-1] = values
+        padded[:, 0, 1:-1] = padded[:, 2, 1:-1]
+        padded[:, -1, 1:-1] = padded[:, -3, 1:-1]
+        padded[:, :, 0] = padded[:, :, 2]
+        padded[:, :, -1] = padded[:, :, -3]
+
+        # Each padded buffer starts and ends with a halo row, so the stencil never reaches from one field's cells
+        # into the next field
+        row_face_rates, column_face_rates = self.stacked_face_rates(fields)
+        divergence = self.divergence(padded, row_face_rates, column_face_rates, spatial_step)
+        update[...] = divergence[:, 1:-1, 1:-1]
+
+        np.add(update, sources, out=update)
+        np.multiply(decays, values, out=term)
+        np.subtract(update, term, out=update)
+        np.multiply(time_step, update, out=update)
+        np.add(values, update, out=update)
+
+        maxima = []
+        for index, (name, field_values, rate, source, decay, out) in enumerate(fields):
+            out[...] = update[index]
+            maxima.append(out.max())
+        return maxima
+
+
+class TiledDiffusionEngine(DiffusionEngine):
+
+    def __init__(self, shape, workers):
+        """
+        Explicit diffusion with the grid split into bands of rows, which are updated in parallel by a pool of threads
+        (NumPy releases the GIL inside the stencil operations). Each band reads the rows either side of it from the
+        padded buffer as its halo, so the results are the same as DiffusionEngine.
+        :param shape: Shape of the grid
+        :param workers: Number of threads (and bands)
+        """
+        DiffusionEngine.__init__(self, shape)
+        assert workers >= 1, "Invalid number of workers: {0}".format(workers)
+        self.workers = min(workers, self.shape[0])
+        bounds = np.linspace(0, self.shape[0], self.workers + 1).astype(int)
+        self.bands = zip(bounds[:-1], bounds[1:])
+        # Each band has its own engine, so that its working arrays aren't shared between threads
+        self.band_engines = [DiffusionEngine((end - start, self.shape[1])) for start, end in self.bands]
+        self.pool = None
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one explicit time step, band by band. Parameters as DiffusionEngine.step
+        :return: Maximum of the new values
+        """
+        if np.isscalar(rate):
+            row_face_rates = column_face_rates = rate
+        else:
+            row_face_rates, column_face_rates = self.face_rates(name, rate)
+        padded = self.pad(name, values)
+
+        def band_step(index):
+            return self.step_band(index, padded, row_face_rates, column_face_rates, values, source, decay, time_step,
+                                  spatial_step, out)
+
+        if self.workers == 1:
+            return band_step(0)
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        return max(self.pool.map(band_step, range(self.workers)))
+
+    def step_band(self, index, padded, row_face_rates, column_face_rates, values, source, decay, time_step,
+                  spatial_step, out):
+        """
+        Advance one band of a field. Parameters as DiffusionEngine.step, with the field already padded and its face
+        rates found
+        :param index: Index of the band
+        :return: Maximum of the new values of the band
+        """
+        start, end = self.bands[index]
+        engine = self.band_engines[index]
+        # Padded rows start to end + 1 are the band and its halo rows
+        divergence = engine.divergence(padded[start:end + 2], band_of(row_face_rates, start, end + 2),
+                                       band_of(column_face_rates, start, end + 2), spatial_step)
+        return engine.advance(divergence, values[start:end], band_of(source, start, end), band_of(decay, start, end),
+                              time_step, out[start:end])
+
+    def close(self):
+        """
+        Stop the threads
+        :return:
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class SubdomainDiffusionEngine(TiledDiffusionEngine):
+
+    def __init__(self, shape, workers, names):
+        """
+        Explicit diffusion with the grid split into subdomains (bands of rows), each owned by a worker process. The
+        padded fields, face rates, sources, decays and new values live in shared memory. Each step the fields are
+        written to the shared padded buffers, and every worker reads its halo rows from the edge rows of the
+        neighbouring subdomains there before updating its own rows. Results are the same as DiffusionEngine.
+        :param shape: Shape of the grid
+        :param workers: Number of worker processes (and subdomains)
+        :param names: Names of the fields to be diffused (shared memory is allocated for each before the workers start)
+        """
+        TiledDiffusionEngine.__init__(self, shape, workers)
+        self.shared = dict()
+        for name in names:
+            self.shared[name] = dict()
+            for buffer, buffer_shape in [('padded', self.padded_shape), ('row_face_rates', self.padded_shape),
+                                         ('column_face_rates', self.padded_shape), ('source', self.shape),
+                                         ('decay', self.shape), ('out', self.shape)]:
+                self.shared[name][buffer] = shared_array(buffer_shape)
+            self.padded[name] = self.shared[name]['padded']
+        self.processes = None
+        self.connections = None
+
+    def face_rates(self, name, rate):
+        """
+        Face rates (as DiffusionEngine.face_rates), held in shared memory
+        :param name: Name of the field
+        :param rate: Array of diffusion rates of grid shape
+        :return:
+        """
+        if name not in self.coefficients:
+            row_face_rates, column_face_rates = DiffusionEngine.face_rates(self, name, rate)
+            self.shared[name]['row_face_rates'][...] = row_face_rates
+            self.shared[name]['column_face_rates'][...] = column_face_rates
+            self.coefficients[name] = (self.shared[name]['row_face_rates'], self.shared[name]['column_face_rates'])
+        return self.coefficients[name]
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one explicit time step, each subdomain in its own process. Parameters as
+        DiffusionEngine.step
+        :return: Maximum of the new values
+        """
+        if self.processes is None:
+            self.start()
+        if np.isscalar(rate):
+            rate = float(rate)
+        else:
+            self.face_rates(name, rate)
+            rate = None
+        # Array terms are passed through shared memory, single values in the message
+        terms = []
+        for term, value in [('source', source), ('decay', decay)]:
+            if np.isscalar(value):
+                terms.append(float(value))
+            else:
+                self.shared[name][term][...] = value
+                terms.append(None)
+        self.pad(name, values)
+
+        for connection in self.connections:
+            connection.send((name, rate, terms[0], terms[1], time_step, spatial_step))
+        maximum = max([connection.recv() for connection in self.connections])
+        out[...] = self.shared[name]['out']
+        return maximum
+
+    def start(self):
+        """
+        Start a worker process for each subdomain
+        :return:
+        """
+        self.processes = []
+        self.connections = []
+        for index in range(self.workers):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=subdomain_worker, args=(self, index, worker_connection))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.connections.append(connection)
+
+    def close(self):
+        """
+        Stop the worker processes
+        :return:
+        """
+        if self.processes is not None:
+            for connection in self.connections:
+                connection.send(None)
+            for process in self.processes:
+                process.join()
+            self.processes = None
+            self.connections = None
+
+
+def subdomain_worker(engine, index, connection):
+    """
+    Worker process of a SubdomainDiffusionEngine. Each message names a field (and gives any single-valued rate,
+    source or decay - None where the value is in shared memory), and the subdomain of that field is updated in shared
+    memory. The maximum new value of the subdomain is sent back. Stops on a message of None
+    :param engine: The engine
+    :param index: Index of the subdomain
+    :param connection: Connection to the engine
+    :return:
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        name, rate, source, decay, time_step, spatial_step = message
+        shared = engine.shared[name]
+        if rate is None:
+            row_face_rates, column_face_rates = shared['row_face_rates'], shared['column_face_rates']
+        else:
+            row_face_rates = column_face_rates = rate
+        if source is None:
+            source = shared['source']
+        if decay is None:
+            decay = shared['decay']
+        padded = shared['padded']
+        connection.send(engine.step_band(index, padded, row_face_rates, column_face_rates, padded[1:-1, 1:-1], source,
+                                         decay, time_step, spatial_step, shared['out']))
+    connection.close()
+
+
+def shared_array(shape):
+    """
+    Array of floats in shared memory, visible to (and writable by) worker processes started after it is created
+    :param shape: Shape of the array
+    :return:
+    """
+    return np.frombuffer(multiprocessing.RawArray('d', int(np.prod(shape))), dtype=float).reshape(shape)
+
+
+def band_of(term, start, end):
+    """
+    Rows start to end - 1 of a term which is either a single value or an array
+    :param term: Single value or array
+    :param start: First row
+    :param end: Row after the last row
+    :return:
+    """
+    if np.isscalar(term):
+        return term
+    return term[start:end]
+
+
+class SparseDiffusionEngine(DiffusionEngine):
+
+    def __init__(self, shape, tile_size=16, threshold=0.0):
+        """
+        Explicit diffusion which only updates the parts of the grid where a field is present. The grid is divided
+        into square tiles, and a tile is active if any of its cells has a value above the threshold or a source. Only
+        the active tiles and the tiles around them (a one tile margin, which the field can spread into) are updated,
+        and every other cell is set to zero. With a threshold of zero the results are the same as DiffusionEngine.
+        Worthwhile when fields are localised on large grids - on small grids the cost of finding the active tiles
+        can outweigh the cells saved.
+        :param shape: Shape of the grid
+        :param tile_size: Rows and columns of each tile
+        :param threshold: Values at or below this are treated as zero
+        """
+        DiffusionEngine.__init__(self, shape)
+        assert tile_size >= 1, "Invalid tile size: {0}".format(tile_size)
+        self.tile_size = int(tile_size)
+        self.threshold = threshold
+        self.row_starts = np.arange(0, self.shape[0], self.tile_size)
+        self.column_starts = np.arange(0, self.shape[1], self.tile_size)
+        # Engines for blocks of tiles, keyed by block shape
+        self.block_engines = {}
+        # Steps taken and cells updated of each field, keyed by field name
+        self.steps = {}
+        self.updated_cells = {}
+
+    def active_tiles(self, values, source):
+        """
+        Tiles holding values above the threshold or a source, plus a one tile margin around them
+        :param values: Current values of the field
+        :param source: Source of the field (single value or array of grid shape)
+        :return: Boolean array with an entry for each tile
+        """
+        active = np.abs(values) > self.threshold
+        if not np.isscalar(source):
+            active |= source != 0
+        tiles = np.logical_or.reduceat(np.logical_or.reduceat(active, self.row_starts, axis=0), self.column_starts,
+                                       axis=1)
+        margin = np.zeros((tiles.shape[0] + 2, tiles.shape[1] + 2), dtype=bool)
+        for row_offset in range(3):
+            for column_offset in range(3):
+                margin[row_offset:row_offset + tiles.shape[0], column_offset:column_offset + tiles.shape[1]] |= tiles
+        return margin[1:-1, 1:-1]
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one explicit time step, updating only the active tiles. Parameters as DiffusionEngine.step
+        :return: Maximum of the new values
+        """
+        self.steps[name] = self.steps.get(name, 0) + 1
+        if np.isscalar(source) and source != 0:
+            tiles = np.ones((len(self.row_starts), len(self.column_starts)), dtype=bool)
+        else:
+            tiles = self.active_tiles(values, source)
+        if tiles.all():
+            self.updated_cells[name] = self.updated_cells.get(name, 0) + values.size
+            return DiffusionEngine.step(self, name, values, rate, source, decay, time_step, spatial_step, out)
+
+        if np.isscalar(rate):
+            row_face_rates = column_face_rates = rate
+        else:
+            row_face_rates, column_face_rates = self.face_rates(name, rate)
+        # Padded first, as out may be the same array as values
+        padded = self.pad(name, values)
+        out[...] = 0.0
+        maxima = [0.0]
+        for rows, columns in self.blocks(tiles):
+            maxima.append(self.step_block(padded, row_face_rates, column_face_rates, source, decay, time_step,
+                                          spatial_step, out, rows, columns))
+            self.updated_cells[name] = self.updated_cells.get(name, 0) + \
+                (rows.stop - rows.start) * (columns.stop - columns.start)
+        return max(maxima)
+
+    def blocks(self, tiles):
+        """
+        Divide the active tiles into rectangular blocks of cells. Each run of active tiles along a row of tiles is a
+        block, and consecutive rows of tiles with the same runs are joined into one block (fewer, larger blocks need
+        fewer array operations)
+        :param tiles: Boolean array with an entry for each tile
+        :return: Rows and columns (as slices) of each block
+        """
+        blocks = []
+        previous_runs = None
+        for tile_row in range(tiles.shape[0]):
+            runs = []
+            tile_column = 0
+            while tile_column < tiles.shape[1]:
+                if not tiles[tile_row, tile_column]:
+                    tile_column += 1
+                    continue
+                run_start = tile_column
+                while tile_column < tiles.shape[1] and tiles[tile_row, tile_column]:
+                    tile_column += 1
+                runs.append((self.column_starts[run_start],
+                             min(self.column_starts[tile_column - 1] + self.tile_size, self.shape[1])))
+            end_row = min(self.row_starts[tile_row] + self.tile_size, self.shape[0])
+            if runs and runs == previous_runs:
+                # Extend the blocks of the previous row of tiles
+                for index in range(len(runs)):
+                    rows, columns = blocks[-len(runs) + index]
+                    blocks[-len(runs) + index] = (slice(rows.start, end_row), columns)
+            else:
+                for start_column, end_column in runs:
+                    blocks.append((slice(self.row_starts[tile_row], end_row), slice(start_column, end_column)))
+            previous_runs = runs
+        return blocks
+
+    def step_block(self, padded, row_face_rates, column_face_rates, source, decay, time_step, spatial_step, out,
+                   rows, columns):
+        """
+        Advance a block of cells. The block (with its halo) is copied from the padded buffer into a contiguous
+        buffer, so the flat stencil can be used
+        :param rows: Rows of the block
+        :param columns: Columns of the block
+        :return: Maximum of the new values of the block
+        """
+        block_shape = (rows.stop - rows.start, columns.stop - columns.start)
+        if block_shape not in self.block_engines:
+            self.block_engines[block_shape] = DiffusionEngine(block_shape)
+        engine = self.block_engines[block_shape]
+        padded_rows = slice(rows.start, rows.stop + 2)
+        padded_columns = slice(columns.start, columns.stop + 2)
+        block = engine.scratch_buffer('block', engine.padded_shape)
+        block[...] = padded[padded_rows, padded_columns]
+        if not np.isscalar(row_face_rates):
+            block_row_face_rates = engine.scratch_buffer('row_face_rates', engine.padded_shape)
+            block_row_face_rates[...] = row_face_rates[padded_rows, padded_columns]
+            block_column_face_rates = engine.scratch_buffer('column_face_rates', engine.padded_shape)
+            block_column_face_rates[...] = column_face_rates[padded_rows, padded_columns]
+            row_face_rates, column_face_rates = block_row_face_rates, block_column_face_rates
+        divergence = engine.divergence(block, row_face_rates, column_face_rates, spatial_step)
+        return engine.advance(divergence, block[1:-1, 1:-1], block_of(source, rows, columns),
+                              block_of(decay, rows, columns), time_step, out[rows, columns])
+
+    def updated_fraction(self, name):
+        """
+        Mean fraction of the grid updated by each step of a field
+        :param name: Name of the field
+        :return:
+        """
+        if self.steps.get(name, 0) == 0:
+            return 1.0
+        return float(self.updated_cells.get(name, 0)) / (self.steps[name] * self.shape[0] * self.shape[1])
+
+
+def block_of(term, rows, columns):
+    """
+    A block of a term which is either a single value or an array
+    :param term: Single value or array
+    :param rows: Rows of the block
+    :param columns: Columns of the block
+    :return:
+    """
+    if np.isscalar(term):
+        return term
+    return term[rows, columns]
+
+
+class ImplicitDiffusionEngine(DiffusionEngine):
+
+    def __init__(self, shape, theta=1.0):
+        """
+        Implicit diffusion by alternating direction (locally one-dimensional) splitting. Each step is a sweep down the
+        columns then a sweep along the rows, and each sweep is a batch of tridiagonal solves. Unconditionally stable,
+        so it can take time steps far larger than the explicit scheme allows. Uses the same zero-flux boundary and
+        face-averaged rates as the explicit scheme.
+        :param shape: Shape of the grid
+        :param theta: Implicitness of each sweep. 1.0 is backward Euler (damps the stiff modes and keeps fields
+               non-negative, so is safe for very large steps), 0.5 is Crank-Nicolson (second order per sweep, but can
+               oscillate around sharp sources when steps are very large)
+        """
+        DiffusionEngine.__init__(self, shape)
+        self.theta = theta
+
+    def stable_time_step(self, name, rate, decay, spatial_step):
+        """
+        The implicit scheme is stable for any time step
+        :return: None
+        """
+        return None
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one implicit step. Parameters as DiffusionEngine.step
+        :return: Maximum of the new values
+        """
+        column_operator, row_operator = self.operators(name, rate, spatial_step)
+        decay = np.broadcast_to(decay, self.shape)
+        implicit_step = self.theta * time_step
+        explicit_step = (1.0 - self.theta) * time_step
+        # Decay and source are split evenly between the two sweeps
+        half_source = np.broadcast_to(source, self.shape) * (time_step / 2.0)
+
+        # Down the columns (along axis 0)
+        lower, diagonal, upper = column_operator
+        diagonal = diagonal - decay / 2.0
+        rhs = values + half_source
+        if explicit_step:
+            rhs += explicit_step * self.apply(lower, diagonal, upper, values)
+        intermediate = self.solve(-implicit_step * lower, 1.0 - implicit_step * diagonal, -implicit_step * upper, rhs)
+
+        # Along the rows (along axis 0 of the transposes)
+        lower, diagonal, upper = row_operator
+        diagonal = diagonal - decay.T / 2.0
+        rhs = intermediate.T + half_source.T
+        if explicit_step:
+            rhs += explicit_step * self.apply(lower, diagonal, upper, intermediate.T)
+        out[...] = self.solve(-implicit_step * lower, 1.0 - implicit_step * diagonal, -implicit_step * upper, rhs).T
+        return out.max()
+
+    def operators(self, name, rate, spatial_step):
+        """
+        Diffusion operators down the columns and along the rows (of the transposes) for a field. Cached until
+        invalidated, or until a single rate or the spatial step differs from the cached values
+        :param name: Name of the field
+        :param rate: Diffusion rate - either a single value or an array of grid shape
+        :param spatial_step: Distance between cells
+        :return: Column and row operators (each a tuple of lower, diagonal and upper coefficients)
+        """
+        key = (rate if np.isscalar(rate) else None, spatial_step)
+        if name not in self.coefficients or self.coefficients[name][0] != key:
+            if np.isscalar(rate):
+                rate = np.full(self.shape, rate, dtype=float)
+            self.coefficients[name] = (key, self.operator(rate, spatial_step), self.operator(rate.T, spatial_step))
+        return self.coefficients[name][1:]
+
+    def operator(self, rate, spatial_step):
+        """
+        Tridiagonal coefficients of the 1D diffusion operator along axis 0. Rate between two cells is the average of
+        the two, and the boundary rows use a mirrored halo (so the single inward flux counts twice)
+        :param rate: Array of diffusion rates
+        :param spatial_step: Distance between cells
+        :return: Lower, diagonal and upper coefficients (arrays of same shape as rate)
+        """
+        face = (rate[:-1] + rate[1:]) / (2.0 * spatial_step ** 2)
+        lower = np.zeros(rate.shape)
+        upper = np.zeros(rate.shape)
+        lower[1:] = face
+        upper[:-1] = face
+        upper[0] *= 2
+        lower[-1] *= 2
+        diagonal = -(lower + upper)
+        return lower, diagonal, upper
+
+    def apply(self, lower, diagonal, upper, values):
+        """
+        Multiply values by the tridiagonal operator along axis 0
+        :return:
+        """
+        result = diagonal * values
+        result[1:] += lower[1:] * values[:-1]
+        result[:-1] += upper[:-1] * values[1:]
+        return result
+
+    def solve(self, lower, diagonal, upper, rhs):
+        """
+        Thomas algorithm for a batch of tridiagonal systems. Each column of rhs is a separate system along axis 0
+        :return: Solution (array of same shape as rhs)
+        """
+        n = rhs.shape[0]
+        upper_prime = np.empty(rhs.shape)
+        solution = np.empty(rhs.shape)
+        upper_prime[0] = upper[0] / diagonal[0]
+        solution[0] = rhs[0] / diagonal[0]
+        for i in range(1, n):
+            denominator = diagonal[i] - lower[i] * upper_prime[i - 1]
+            upper_prime[i] = upper[i] / denominator
+            solution[i] = (rhs[i] - lower[i] * solution[i - 1]) / denominator
+        for i in range(n - 2, -1, -1):
+            solution[i] -= upper_prime[i] * solution[i + 1]
+        return solution
+
+
+class MatrixDiffusionEngine(DiffusionEngine):
+
+    def __init__(self, shape, theta=0.0):
+        """
+        Diffusion as a sparse linear operator. The diffusion operator of each field (same face-averaged rates and
+        mirrored boundary as DiffusionEngine) is assembled as a scipy.sparse CSR matrix, and kept until the rates
+        change. Single-valued decays and the time step are folded into a step matrix, so an explicit step is one
+        sparse matrix-vector product (plus the source, and any per-cell decay, which change every step). With theta
+        above zero the step is implicit, and each step is a solve against a cached factorisation instead.
+        :param shape: Shape of the grid
+        :param theta: Implicitness - 0.0 is explicit (forward Euler), 0.5 Crank-Nicolson, 1.0 backward Euler
+        """
+        if scipy is None:
+            raise Exception, "The matrix diffusion engine requires scipy"
+        DiffusionEngine.__init__(self, shape)
+        self.theta = theta
+        # Operators of each field, keyed by field name. Kept until invalidated
+        self.matrices = {}
+
+    def invalidate(self, name=None):
+        """
+        Discard cached coefficients and operators. Must be called whenever the diffusion rates of a field change
+        :param name: Name of the field (all fields if None)
+        :return:
+        """
+        DiffusionEngine.invalidate(self, name)
+        if name is None:
+            self.matrices.clear()
+        else:
+            self.matrices.pop(name, None)
+
+    def laplacian(self, name, rate, spatial_step):
+        """
+        Sparse matrix of the diffusion operator div(rate * grad) / dx^2 of a field. Cached until invalidated, or
+        until a single rate or the spatial step differs from the cached values
+        :param name: Name of the field
+        :param rate: Diffusion rate - either a single value or an array of grid shape
+        :param spatial_step: Distance between cells
+        :return: CSR matrix (cells x cells, cells in row-major order)
+        """
+        key = (rate if np.isscalar(rate) else None, spatial_step)
+        if name not in self.matrices or self.matrices[name]['key'] != key:
+            if np.isscalar(rate):
+                rate = np.full(self.shape, rate, dtype=float)
+            index = np.arange(rate.size).reshape(self.shape)
+            cells, neighbours, faces = [], [], []
+            # Faces between neighbours down the columns, then along the rows (the transposes)
+            for rates, indices in [(rate, index), (rate.T, index.T)]:
+                face = (rates[:-1] + rates[1:]) / 2 / spatial_step ** 2
+                # Each face carries flux both ways. The mirrored halo doubles the flux across the first and last faces
+                # for the cells on the boundary
+                for cell, neighbour, face_rate in [(indices[:-1], indices[1:], face),
+                                                   (indices[1:], indices[:-1], face),
+                                                   (indices[0], indices[1], face[0]),
+                                                   (indices[-1], indices[-2], face[-1])]:
+                    cells += [cell.ravel(), cell.ravel()]
+                    neighbours += [neighbour.ravel(), cell.ravel()]
+                    faces += [face_rate.ravel(), -face_rate.ravel()]
+            laplacian = scipy.sparse.coo_matrix((np.concatenate(faces), (np.concatenate(cells),
+                                                                         np.concatenate(neighbours))),
+                                                shape=(rate.size, rate.size)).tocsr()
+            self.matrices[name] = {'key': key, 'laplacian': laplacian, 'steps': {}}
+        return self.matrices[name]['laplacian']
+
+    def step_operators(self, name, rate, decay, time_step, spatial_step):
+        """
+        Operators for a step of a field: the matrix applied to the current values and (if implicit) the solver for
+        the new values. Cached until the rates change, for each time step and single-valued decay
+        :param name: Name of the field
+        :param rate: Diffusion rate
+        :param decay: Single-valued decay (0.0 if the decay varies per cell)
+        :param time_step: Time step
+        :param spatial_step: Distance between cells
+        :return: Explicit matrix, and solver (None if explicit)
+        """
+        laplacian = self.laplacian(name, rate, spatial_step)
+        steps = self.matrices[name]['steps']
+        key = (decay, time_step)
+        if key not in steps:
+            identity = scipy.sparse.identity(laplacian.shape[0], format='csr')
+            operator = laplacian - decay * identity
+            explicit = (identity + (1.0 - self.theta) * time_step * operator).tocsr()
+            solver = None
+            if self.theta > 0:
+                solver = scipy.sparse.linalg.factorized((identity - self.theta * time_step * operator).tocsc())
+            steps[key] = (explicit, solver)
+        return steps[key]
+
+    def stable_time_step(self, name, rate, decay, spatial_step):
+        """
+        Stable time step (as DiffusionEngine.stable_time_step). Crank-Nicolson and more implicit steps are stable for
+        any time step
+        :return:
+        """
+        stable_time_step = DiffusionEngine.stable_time_step(self, name, rate, decay, spatial_step)
+        if self.theta >= 0.5 or stable_time_step is None:
+            return None
+        return stable_time_step / (1.0 - 2 * self.theta)
+
+    def step(self, name, values, rate, source, decay, time_step, spatial_step, out):
+        """
+        Advance a field by one step:
+            (I - theta * dt * M) new = (I + (1 - theta) * dt * M) old + dt * (source - per-cell decay * old)
+        where M is the diffusion operator less any single-valued decay. Parameters as DiffusionEngine.step
+        :return: Maximum of the new values
+        """
+        cell_decay = None
+        if not np.isscalar(decay):
+            decay, cell_decay = 0.0, decay
+        explicit, solver = self.step_operators(name, rate, decay, time_step, spatial_step)
+        old = values.ravel()
+        new = explicit.dot(old)
+        if not np.isscalar(source) or source != 0:
+            new += time_step * np.ravel(source)
+        if cell_decay is not None:
+            new -= time_step * cell_decay.ravel() * old
+        if solver is not None:
+            new = solver(new)
+        out[...] = new.reshape(self.shape)
+        return out.max()
+
+
+class CoarseGrid:
+
+    def __init__(self, shape, factor):
+        """
+        A field solved on a grid coarser than the agent grid. Each coarse cell covers a block of factor x factor agent
+        grid cells (smaller at the far edges if the shape is not a multiple of the factor). Sources, decays and rates
+        are restricted to the coarse grid as block means, the field is advanced there by the explicit scheme (at
+        factor times the spatial step, so each step covers factor^2 fewer cells and can be factor^2 longer), and
+        interpolated back to the agent grid bilinearly between the centres of the coarse cells. The coarse field is
+        kept between updates - it is taken from the agent grid field on the first update, or after reset.
+        :param shape: Shape of the agent grid
+        :param factor: Coarsening factor
+        """
+        self.shape = tuple(shape)
+        self.factor = int(factor)
+        self.row_starts = np.arange(0, self.shape[0], self.factor)
+        self.column_starts = np.arange(0, self.shape[1], self.factor)
+        self.coarse_shape = (len(self.row_starts), len(self.column_starts))
+        assert min(self.coarse_shape) >= 2, "Coarsening factor {0} too large for grid {1}".format(factor, shape)
+        self.cell_counts = np.outer(np.diff(np.append(self.row_starts, self.shape[0])),
+                                    np.diff(np.append(self.column_starts, self.shape[1]))).astype(float)
+        self.engine = DiffusionEngine(self.coarse_shape)
+        self.rows = interpolation(self.shape[0], self.factor, self.coarse_shape[0])
+        self.columns = interpolation(self.shape[1], self.factor, self.coarse_shape[1])
+        self.values = None
+        self.rate = None
+        self.buffers = {}
+
+    def restrict(self, values):
+        """
+        Mean of the values over the agent grid cells covered by each coarse cell
+        :param values: Single value or array of agent grid shape
+        :return: Single value or array of coarse grid shape
+        """
+        if np.isscalar(values):
+            return values
+        # Sum each offset within the blocks in turn (strided slices are far quicker than reduceat)
+        rows = self.buffer('rows', (self.coarse_shape[0], self.shape[1]))
+        rows[...] = values[::self.factor]
+        for offset in range(1, self.factor):
+            offset_rows = values[offset::self.factor]
+            rows[:offset_rows.shape[0]] += offset_rows
+        coarse = rows[:, ::self.factor].copy()
+        for offset in range(1, self.factor):
+            offset_columns = rows[:, offset::self.factor]
+            coarse[:, :offset_columns.shape[1]] += offset_columns
+        coarse /= self.cell_counts
+        return coarse
+
+    def prolong(self, coarse, out):
+        """
+        Bilinear interpolation from the centres of the coarse cells to the centres of the agent grid cells (values
+        beyond the outermost coarse centres are held constant, matching the zero-flux boundary)
+        :param coarse: Array of coarse grid shape
+        :param out: Array of agent grid shape to write to
+        :return:
+        """
+        # Along the rows of the coarse grid first, so the gathers over the larger agent grid are of whole rows. The
+        # gathers write into buffers allocated once (mode 'clip' lets take write to them without buffering)
+        lower, upper, weight = self.columns
+        by_column = self.buffer('by_column', (self.coarse_shape[0], self.shape[1]))
+        by_column_upper = self.buffer('by_column_upper', (self.coarse_shape[0], self.shape[1]))
+        np.take(coarse, lower, axis=1, out=by_column, mode='clip')
+        np.take(coarse, upper, axis=1, out=by_column_upper, mode='clip')
+        by_column -= by_column_upper
+        by_column *= 1 - weight
+        by_column += by_column_upper
+        lower, upper, weight = self.rows
+        upper_values = self.buffer('upper_values', self.shape)
+        np.take(by_column, lower, axis=0, out=out, mode='clip')
+        np.take(by_column, upper, axis=0, out=upper_values, mode='clip')
+        out -= upper_values
+        out *= (1 - weight)[:, np.newaxis]
+        out += upper_values
+
+    def buffer(self, name, shape):
+        """
+        Working array, allocated on first use and then reused
+        :param name: Name of the buffer
+        :param shape: Shape of the buffer
+        :return:
+        """
+        if name not in self.buffers:
+            self.buffers[name] = np.empty(shape, dtype=float)
+        return self.buffers[name]
+
+    def reset(self):
+        """
+        Take the coarse field from the agent grid field again on the next update (and recalculate the rates)
+        :return:
+        """
+        self.values = None
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discard the restricted diffusion rates. Must be called whenever the diffusion rates change
+        :return:
+        """
+        self.rate = None
+        self.engine.invalidate()
+
+    def coarse_rate(self, rate):
+        """
+        Diffusion rate restricted to the coarse grid. Cached until invalidated
+        :param rate: Single value or array of agent grid shape
+        :return:
+        """
+        if np.isscalar(rate):
+            return rate
+        if self.rate is None:
+            self.rate = self.restrict(rate)
+        return self.rate
+
+    def stable_time_step(self, rate, decay, spatial_step):
+        """
+        Largest stable time step on the coarse grid (as DiffusionEngine.stable_time_step, with the agent grid decay)
+        :return:
+        """
+        return self.engine.stable_time_step('field', self.coarse_rate(rate), decay, spatial_step * self.factor)
+
+    def step(self, values, rate, source, decay, time_step, spatial_step, steps, out):
+        """
+        Advance the field on the coarse grid and interpolate it to the agent grid
+        :param values: Field on the agent grid (only used if there is no coarse field yet)
+        :param rate: Diffusion rate - single value or array of agent grid shape
+        :param source: Amount added per unit time - single value or array of agent grid shape
+        :param decay: Proportion removed per unit time - single value or array of agent grid shape
+        :param time_step: Time step
+        :param spatial_step: Distance between agent grid cells
+        :param steps: Number of time steps
+        :param out: Array of agent grid shape to write the interpolated field to
+        :return: Maximum of the interpolated field
+        """
+        if self.values is None:
+            self.values = self.restrict(values)
+        rate = self.coarse_rate(rate)
+        source = self.restrict(source)
+        decay = self.restrict(decay)
+        for step in range(steps):
+            self.engine.step('field', self.values, rate, source, decay, time_step, spatial_step * self.factor,
+                             self.values)
+        self.prolong(self.values, out)
+        return out.max()
+
+
+class SpectralField:
+
+    def __init__(self, shape):
+        """
+        Exact solver for a field with a single diffusion rate and decay. With the mirrored halo the diffusion operator
+        is diagonalised by the type I discrete cosine transform, so the diffusion and decay of each cosine mode over a
+        whole update is a single exponential (and the source, held fixed over the update, is integrated exactly
+        alongside it). Each update is one forward and one inverse transform, however long the update.
+        :param shape: Shape of the grid
+        """
+        if scipy is None:
+            raise Exception, "The spectral solver requires scipy"
+        self.shape = tuple(shape)
+        assert min(self.shape) >= 2, "Spectral solver needs at least 2 cells along each axis"
+        # Eigenvalues of the second difference (with mirrored halo) along each axis
+        self.row_eigenvalues = 2 * np.cos(np.pi * np.arange(self.shape[0]) / (self.shape[0] - 1)) - 2
+        self.column_eigenvalues = 2 * np.cos(np.pi * np.arange(self.shape[1]) / (self.shape[1] - 1)) - 2
+        self.scale = 4.0 * (self.shape[0] - 1) * (self.shape[1] - 1)
+        # Growth of each mode over an update, and gain from the source, keyed by rate, decay, spatial step and time
+        self.factors = {}
+
+    def transform(self, values):
+        """
+        Two dimensional type I discrete cosine transform (its own inverse, up to the scale)
+        :param values: Array of grid shape
+        :return:
+        """
+        return scipy.fftpack.dct(scipy.fftpack.dct(values, type=1, axis=0), type=1, axis=1)
+
+    def mode_factors(self, rate, decay, spatial_step, time):
+        """
+        Growth of each mode over the time, exp(lambda t), and its gain from a unit source, (exp(lambda t) - 1) / lambda
+        (or t where lambda is zero), where lambda = rate * eigenvalue / dx^2 - decay. Scaled for the inverse transform
+        :return: Growth and gain (arrays of grid shape)
+        """
+        key = (rate, decay, spatial_step, time)
+        if key not in self.factors:
+            eigenvalues = rate * np.add.outer(self.row_eigenvalues, self.column_eigenvalues) / spatial_step ** 2 - decay
+            growth = np.exp(eigenvalues * time)
+            gain = np.full(self.shape, float(time))
+            nonzero = eigenvalues != 0
+            gain[nonzero] = np.expm1(eigenvalues[nonzero] * time) / eigenvalues[nonzero]
+            self.factors[key] = (growth / self.scale, gain / self.scale)
+        return self.factors[key]
+
+    def invalidate(self):
+        """
+        Nothing is derived from the rates of the cells
+        :return:
+        """
+        pass
+
+    def reset(self):
+        """
+        No state is kept between updates
+        :return:
+        """
+        pass
+
+    def stable_time_step(self, rate, decay, spatial_step):
+        """
+        Exact for any time step
+        :return: None
+        """
+        return None
+
+    def step(self, values, rate, source, decay, time_step, spatial_step, steps, out):
+        """
+        Advance the field exactly over steps time steps. Parameters as CoarseGrid.step, except that the rate and decay
+        must be single values (and the source non-negative)
+        :return: Maximum of the new values
+        """
+        if not np.isscalar(rate) or not np.isscalar(decay):
+            raise Exception, "Spectral solver needs a single diffusion rate and decay"
+        growth, gain = self.mode_factors(rate, decay, spatial_step, time_step * steps)
+        modes = self.transform(values) * growth
+        if not np.isscalar(source) or source != 0:
+            modes += self.transform(np.broadcast_to(source, self.shape)) * gain
+        out[...] = self.transform(modes)
+        # The solution is non-negative, but far from the sources the transforms leave round-off either side of zero
+        np.maximum(out, 0.0, out=out)
+        return out.max()
+
+
+def interpolation(size, factor, coarse_size):
+    """
+    Linear interpolation along one axis, from the centres of coarse cells to the centres of agent grid cells
+    :param size: Agent grid cells along the axis
+    :param factor: Coarsening factor
+    :param coarse_size: Coarse cells along the axis
+    :return: Lower and upper coarse cell, and the weight of the upper cell, for each agent grid cell
+    """
+    # Centres of the coarse cells, in agent grid cells (the last may cover fewer cells)
+    starts = np.arange(0, size, factor)
+    centres = (starts + np.minimum(starts + factor, size)) / 2.0 - 0.5
+    positions = np.arange(size, dtype=float)
+    upper = np.searchsorted(centres, positions).clip(0, coarse_size - 1)
+    lower = (upper - 1).clip(0, coarse_size - 1)
+    spacing = centres[upper] - centres[lower]
+    weight = np.where(spacing > 0, (positions - centres[lower]) / np.where(spacing > 0, spacing, 1.0), 0.0)
+    return lower, upper, weight.clip(0.0, 1.0)
+
+
+class DiffusingSpecies:
+
+    def __init__(self, name, diffusion, caseum_reduces_diffusion=False, from_blood_vessels=None,
+                 from_bacteria=None, from_macrophages=None, decay=None, uptake_by_bacteria=None, schedule='always',
+                 coarsening=1, solver='engine'):
+        """
+        A chemical which diffuses over the grid. Coefficients are either numbers, or names of model parameters (which
+        are looked up each time they're used). Coefficients which are None are left out of the source / decay.
+        :param name: Name of the species (and of its grid attribute)
+        :param diffusion: Diffusion rate
+        :param caseum_reduces_diffusion: If True, the diffusion rate is held per cell (attribute name_diffusion_rate)
+               and reduced near caseum
+        :param from_blood_vessels: Amount produced per unit of blood vessel value per unit time
+        :param from_bacteria: Amount produced by each bacterium per unit time
+        :param from_macrophages: Amount produced by each non-resting macrophage per unit time
+        :param decay: Proportion lost per unit time
+        :param uptake_by_bacteria: Proportion taken up per unit time in cells with a bacterium
+        :param schedule: 'always', or 'chemotherapy' to only be present while chemotherapy is given
+        :param coarsening: Factor by which the grid the species is solved on is coarser than the agent grid (1 solves
+               on the agent grid)
+        :param solver: 'engine' to use the diffusion engine of the automaton, or 'spectral' for the exact spectral
+               solver (only for a single diffusion rate and decay)
+        """
+        assert schedule in ['always', 'chemotherapy'], "Invalid schedule: {0}".format(schedule)
+        assert int(coarsening) >= 1, "Invalid coarsening: {0}".format(coarsening)
+        assert solver in ['engine', 'spectral'], "Invalid solver: {0}".format(solver)
+        assert solver == 'engine' or (not caseum_reduces_diffusion and uptake_by_bacteria is None), \
+            "Spectral solver needs a single diffusion rate and decay"
+        assert solver == 'engine' or coarsening == 1, "Spectral solver can't be used on a coarse grid"
+        self.name = name
+        self.diffusion = diffusion
+        self.caseum_reduces_diffusion = caseum_reduces_diffusion
+        self.from_blood_vessels = from_blood_vessels
+        self.from_bacteria = from_bacteria
+        self.from_macrophages = from_macrophages
+        self.decay = decay
+        self.uptake_by_bacteria = uptake_by_bacteria
+        self.schedule = schedule
+        self.coarsening = int(coarsening)
+        self.solver = solver
+
+    def coefficient(self, name, model_parameters):
+        """
+        Value of a coefficient
+        :param name: Name of the coefficient (e.g. 'decay')
+        :param model_parameters: Model parameters
+        :return: Value (None if the coefficient is not used)
+        """
+        value = getattr(self, name)
+        if isinstance(value, basestring):
+            return model_parameters[value]
+        return value
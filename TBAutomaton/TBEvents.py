@@ -13,6 +13,8 @@ class BacteriumReplication(Event):
         new_bacterium = Bacterium(self.new_bac_address, self.new_metabolism)
         tb_automaton.bacteria.append(new_bacterium)
         tb_automaton.work_grid[(self.new_bac_address)]['contents'] = new_bacterium
+        tb_automaton.bacteria_mask[self.new_bac_address] = 1
+        tb_automaton.free_mask[self.new_bac_address] = False
 
         original_bacterium = tb_automaton.grid[self.original_bac_address]['contents']
         if original_bacterium.division_neighbourhood == 'mo':
@@ -48,6 +50,7 @@ class RecruitTCell(Event):
         new_t_cell = TCell(self.new_t_cell_address)
         automaton.t_cells.append(new_t_cell)
         automaton.work_grid[self.new_t_cell_address]['contents'] = new_t_cell
+        automaton.free_mask[self.new_t_cell_address] = False
 
 
 class RecruitMacrophage(Event):
@@ -60,6 +63,7 @@ class RecruitMacrophage(Event):
         new_macrophage = Macrophage(self.new_macrophage_address, 'resting')
         automaton.macrophages.append(new_macrophage)
         automaton.work_grid[self.new_macrophage_address]['contents'] = new_macrophage
+        automaton.free_mask[self.new_macrophage_address] = False
 
 
 class ChemoKillBacterium(Event):
@@ -70,7 +74,9 @@ class ChemoKillBacterium(Event):
     def perform_event(self, automaton):
         bacterium = automaton.grid[self.bacterium_address]['contents']
         automaton.bacteria.remove(bacterium)
-        automaton.grid[self.bacterium_address]['contents'] = 0
+        automaton.work_grid[self.bacterium_address]['contents'] = 0
+        automaton.bacteria_mask[self.bacterium_address] = 0
+        automaton.free_mask[self.bacterium_address] = True
 
 
 class ChemoKillMacrophage(Event):
@@ -81,6 +87,7 @@ class ChemoKillMacrophage(Event):
     def perform_event(self, automaton):
         macrophage = automaton.grid[self.macrophage_address]['contents']
         automaton.macrophages.remove(macrophage)
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = 0
         caseum = Caseum(self.macrophage_address)
         automaton.caseum_addresses.append(self.macrophage_address)
         automaton.work_grid[self.macrophage_address]['contents'] = caseum
@@ -95,6 +102,7 @@ class TCellDeath(Event):
         t_cell = automaton.grid[self.t_cell_address]['contents']
         automaton.t_cells.remove(t_cell)
         automaton.work_grid[self.t_cell_address]['contents'] = 0
+        automaton.free_mask[self.t_cell_address] = True
 
 
 class TCellMovement(Event):
@@ -108,6 +116,8 @@ class TCellMovement(Event):
         t_cell.address = self.tcell_to_address
         automaton.work_grid[self.tcell_from_address]['contents'] = 0
         automaton.work_grid[self.tcell_to_address]['contents'] = t_cell
+        automaton.free_mask[self.tcell_from_address] = True
+        automaton.free_mask[self.tcell_to_address] = False
 
 
 class TCellKillsMacrophage(Event):
@@ -122,7 +132,9 @@ class TCellKillsMacrophage(Event):
 
         automaton.t_cells.remove(t_cell)
         automaton.work_grid[self.tcell_address]['contents'] = 0
+        automaton.free_mask[self.tcell_address] = True
         automaton.macrophages.remove(macrophage)
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = 0
         caseum = Caseum(self.macrophage_address)
         automaton.caseum_addresses.append(self.macrophage_address)
         automaton.work_grid[self.macrophage_address]['contents'] = caseum
@@ -136,12 +148,14 @@ class MacrophageDeath(Event):
     def perform_event(self, automaton):
         macrophage = automaton.grid[self.macrophage_address]['contents']
         automaton.macrophages.remove(macrophage)
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = 0
         if macrophage.state == 'infected' or macrophage.state == 'chronically_infected':
             caseum = Caseum(self.macrophage_address)
             automaton.caseum_addresses.append(self.macrophage_address)
             automaton.work_grid[self.macrophage_address]['contents'] = caseum
         else:
             automaton.work_grid[self.macrophage_address]['contents'] = 0
+            automaton.free_mask[self.macrophage_address] = True
 
 
 class MacrophageMovement(Event):
@@ -156,6 +170,11 @@ class MacrophageMovement(Event):
         macrophage.address = self.macrophage_to_address
         automaton.work_grid[self.macrophage_from_address]['contents'] = 0
         automaton.work_grid[self.macrophage_to_address]['contents'] = macrophage
+        automaton.non_resting_macrophage_mask[self.macrophage_to_address] = \
+            automaton.non_resting_macrophage_mask[self.macrophage_from_address]
+        automaton.non_resting_macrophage_mask[self.macrophage_from_address] = 0
+        automaton.free_mask[self.macrophage_from_address] = True
+        automaton.free_mask[self.macrophage_to_address] = False
 
 
 class MacrophageIngestsBacterium(Event):
@@ -184,6 +203,11 @@ class MacrophageIngestsBacterium(Event):
                 automaton.model_parameters['bacteria_to_turn_chronically_infected']:
                 macrophage.state = 'chronically_infected'
 
+        automaton.bacteria_mask[self.bacterium_address] = 0
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = 0
+        automaton.non_resting_macrophage_mask[self.bacterium_address] = macrophage.state != 'resting'
+        automaton.free_mask[self.macrophage_address] = True
+
 
 class MacrophageActivation(Event):
     def __init__(self, mac_address, state):
@@ -193,6 +217,7 @@ class MacrophageActivation(Event):
 
     def perform_event(self, automaton):
         automaton.grid[self.macrophage_address]['contents'].state = self.new_state
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = self.new_state != 'resting'
 
 
 class MacrophageBursts(Event):
@@ -206,6 +231,7 @@ class MacrophageBursts(Event):
     def perform_event(self, automaton):
         macrophage = automaton.grid[self.macrophage_address]['contents']
         automaton.macrophages.remove(macrophage)
+        automaton.non_resting_macrophage_mask[self.macrophage_address] = 0
         caseum = Caseum(self.macrophage_address)
         automaton.caseum_addresses.append(self.macrophage_address)
         automaton.work_grid[self.macrophage_address]['contents'] = caseum
@@ -217,4 +243,6 @@ class MacrophageBursts(Event):
                 bac = Bacterium(address, 'slow')
                 automaton.bacteria.append(bac)
                 automaton.work_grid[address]['contents'] = bac
+                automaton.bacteria_mask[address] = 1
+                automaton.free_mask[address] = False
 
@@ -105,72 +105,128 @@ def initialise():
 
     return blood_vessel_addresses, fast_addresses, slow_addresses, macrophage_addresses
 
-print '------------------------'
-print 'TB Simulation Automaton'
-print '------------------------'
-whole_start_time = time.time()
-print "Begin:   {", whole_start_time, "}"
-
-config = ConfigParser.RawConfigParser()
-if not config.read('config.properties'):
-    raise IOError("Config file (config.properties) not found")
-
-# LOAD PARAMETERS
-parameters = {}
-# Get all options in parameters section and add to the dictionary
-for i in config.options("ModelParametersSection"):
-    parameters[i] = config.getfloat("ModelParametersSection", i)
-
-# TIME PARAMETERS
-time_parameters = {}
-# Get all options in time parameters section
-for i in config.options("TimeParametersSection"):
-    time_parameters[i] = config.getfloat("TimeParametersSection", i)
-
-# LOAD GRID ATTRIBUTES
-total_shape = [int(a) for a in config.get("GridSection", "total_shape").split(",")]
-
-# LOAD RUN PARAMETERS
-profile = config.getboolean("RunParametersSection", "profile")
-numpy_seed = None
-if not config.getboolean("RunParametersSection", "random"):
-    numpy_seed = config.getint("RunParametersSection", "non_random_seed")
-
-number_of_runs = config.getint("RunParametersSection", "number_runs")
-
-main_output_location = config.get("RunParametersSection", "output_location")
-# Make the main output folder
-if not os.path.exists(main_output_location):
-    os.makedirs(main_output_location)
-
-random = config.getboolean("RunParametersSection", "random")
-debug = config.getboolean("RunParametersSection", "debug")
-
-# LOAD INITIALISATION
-blood_vessels, fast_bacteria, slow_bacteria, macrophages = initialise()
-
-for n in range(number_of_runs):
-    output_location = main_output_location + "/" + str(n)
-    if not os.path.exists(output_location):
-        os.makedirs(output_location)
-
-    if not random:
+
+def load_species(config):
+    """
+    Further diffusing species, each declared in its own section [Species:name]
+    :param config: Configuration
+    :return: Dictionary of species name to keyword arguments of DiffusingSpecies
+    """
+    species = {}
+    for section in config.sections():
+        if section.startswith("Species:"):
+            options = {}
+            for i in config.options(section):
+                if i == 'caseum_reduces_diffusion':
+                    options[i] = config.getboolean(section, i)
+                elif i in ['schedule', 'solver']:
+                    options[i] = config.get(section, i)
+                elif i == 'coarsening':
+                    options[i] = config.getint(section, i)
+                else:
+                    # Coefficients are either numbers or names of model parameters
+                    options[i] = config.get(section, i)
+                    try:
+                        options[i] = float(options[i])
+                    except ValueError:
+                        pass
+            species[section[len("Species:"):]] = options
+    return species
+
+
+if __name__ == '__main__':
+    print '------------------------'
+    print 'TB Simulation Automaton'
+    print '------------------------'
+    whole_start_time = time.time()
+    print "Begin:   {", whole_start_time, "}"
+
+    config = ConfigParser.RawConfigParser()
+    if not config.read('config.properties'):
+        raise IOError("Config file (config.properties) not found")
+
+    # LOAD PARAMETERS
+    parameters = {}
+    # Get all options in parameters section and add to the dictionary
+    for i in config.options("ModelParametersSection"):
+        parameters[i] = config.getfloat("ModelParametersSection", i)
+
+    # TIME PARAMETERS
+    time_parameters = {}
+    # Get all options in time parameters section
+    for i in config.options("TimeParametersSection"):
+        time_parameters[i] = config.getfloat("TimeParametersSection", i)
+
+    # LOAD GRID ATTRIBUTES
+    total_shape = [int(a) for a in config.get("GridSection", "total_shape").split(",")]
+
+    # LOAD RUN PARAMETERS
+    profile = config.getboolean("RunParametersSection", "profile")
+    numpy_seed = None
+    if not config.getboolean("RunParametersSection", "random"):
         numpy_seed = config.getint("RunParametersSection", "non_random_seed")
-        automaton = TBAutomaton(total_shape, time_parameters, parameters, output_location, blood_vessels, macrophages,
-                            fast_bacteria, slow_bacteria, numpy_seed=numpy_seed, debug=debug)
-    else:
-        automaton = TBAutomaton(total_shape, time_parameters, parameters, output_location, blood_vessels, macrophages,
-                                fast_bacteria, slow_bacteria, debug=debug)
-
-    if profile:
-        pr = cProfile.Profile()
-        pr.enable()
-        automaton.run()
-        pr.disable()
-        pr.print_stats(sort='cumtime')
-    else:
-        automaton.run()
-
-whole_end_time = time.time()
-print "End:     {", whole_end_time, "}"
-print "Duration: ", whole_end_time - whole_start_time
+
+    number_of_runs = config.getint("RunParametersSection", "number_runs")
+
+    main_output_location = config.get("RunParametersSection", "output_location")
+    # Make the main output folder
+    if not os.path.exists(main_output_location):
+        os.makedirs(main_output_location)
+
+    # LOAD DIFFUSION SETTINGS
+    diffusion_parameters = {}
+    if config.has_section("DiffusionSection"):
+        diffusion_parameters['engine'] = config.get("DiffusionSection", "engine")
+        diffusion_parameters['diffusion_interval'] = config.getint("DiffusionSection", "diffusion_interval")
+        diffusion_parameters['diffusion_sub_steps'] = config.getint("DiffusionSection", "diffusion_sub_steps")
+        diffusion_parameters['adaptive_time_step'] = config.getboolean("DiffusionSection", "adaptive_time_step")
+        diffusion_parameters['matrix_theta'] = config.getfloat("DiffusionSection", "matrix_theta")
+        diffusion_parameters['sparse_tile_size'] = config.getint("DiffusionSection", "sparse_tile_size")
+        diffusion_parameters['sparse_threshold'] = config.getfloat("DiffusionSection", "sparse_threshold")
+        diffusion_parameters['implicit_theta'] = config.getfloat("DiffusionSection", "implicit_theta")
+        diffusion_parameters['oxygen_coarsening'] = config.getint("DiffusionSection", "oxygen_coarsening")
+        diffusion_parameters['chemokine_solver'] = config.get("DiffusionSection", "chemokine_solver")
+        diffusion_parameters['validate'] = config.getboolean("DiffusionSection", "validate")
+        diffusion_parameters['steady_state_tolerance'] = config.getfloat("DiffusionSection", "steady_state_tolerance")
+    # Workers of the tiled and subdomain diffusion engines, and of the agent subdomains
+    if config.has_option("RunParametersSection", "workers"):
+        diffusion_parameters['workers'] = config.getint("RunParametersSection", "workers")
+    # Agent events generated by subdomain, one worker process each
+    if config.has_option("RunParametersSection", "subdomain_agents"):
+        diffusion_parameters['subdomain_agents'] = config.getboolean("RunParametersSection", "subdomain_agents")
+    # Further diffusing species, each declared in its own section [Species:name]
+    diffusion_parameters['species'] = load_species(config)
+
+    random = config.getboolean("RunParametersSection", "random")
+    debug = config.getboolean("RunParametersSection", "debug")
+
+    # LOAD INITIALISATION
+    blood_vessels, fast_bacteria, slow_bacteria, macrophages = initialise()
+
+    for n in range(number_of_runs):
+        output_location = main_output_location + "/" + str(n)
+        if not os.path.exists(output_location):
+            os.makedirs(output_location)
+
+        if not random:
+            numpy_seed = config.getint("RunParametersSection", "non_random_seed")
+            automaton = TBAutomaton(total_shape, time_parameters, parameters, output_location, blood_vessels,
+                                    macrophages, fast_bacteria, slow_bacteria, numpy_seed=numpy_seed, debug=debug,
+                                    diffusion_parameters=diffusion_parameters)
+        else:
+            automaton = TBAutomaton(total_shape, time_parameters, parameters, output_location, blood_vessels,
+                                    macrophages, fast_bacteria, slow_bacteria, debug=debug,
+                                    diffusion_parameters=diffusion_parameters)
+
+        if profile:
+            pr = cProfile.Profile()
+            pr.enable()
+            automaton.run()
+            pr.disable()
+            pr.print_stats(sort='cumtime')
+        else:
+            automaton.run()
+
+    whole_end_time = time.time()
+    print "End:     {", whole_end_time, "}"
+    print "Duration: ", whole_end_time - whole_start_time
@@ -104,6 +104,32 @@ class AutomatonTestCase(unittest.TestCase):
         self.assertEqual(test_automaton.time, self.time_params['initial_time'] +
                          self.time_params['time_limit'] / self.time_params['time_step'])
 
+    def test_double_buffer(self):
+        automaton = Automaton(self.shape, self.attributes, self.formats, self.time_params, self.model_params,
+                              self.output_loc, self.record_values, self.grid_records, self.initialise,
+                              static_attributes=['b'], double_buffer=True)
+        # Static attributes are stored once
+        self.assertTrue(automaton.grid['b'] is automaton.work_grid['b'])
+        self.assertFalse(automaton.grid['a'] is automaton.work_grid['a'])
+        self.assertEqual(automaton.work_grid[(2, 2)]['b'], 13)
+
+        grid_a = automaton.grid['a']
+        work_grid_a = automaton.work_grid['a']
+        agent = Agent((5, 5))
+        automaton.work_grid['a'][(1, 1)] = 3.3
+        automaton.work_grid[(5, 5)]['c'] = agent
+        automaton.swap_grids()
+
+        # Numeric attributes swap buffers
+        self.assertTrue(automaton.grid['a'] is work_grid_a)
+        self.assertTrue(automaton.work_grid['a'] is grid_a)
+        self.assertEqual(automaton.grid[(1, 1)]['a'], 3.3)
+        # Object attributes carry changed cells across
+        self.assertEqual(automaton.grid[(5, 5)]['c'], agent)
+        self.assertEqual(automaton.grid[(4, 4)]['c'], automaton.work_grid[(4, 4)]['c'])
+        self.assertEqual(len(automaton.work_grid.changed), 0)
+        automaton.close_files()
+
     def test_neighbour_relatives(self):
         self.assertItemsEqual(self.automaton.moore_relative.keys(), [1, 2, 3])
         self.assertItemsEqual(self.automaton.moore_relative[1],
@@ -166,6 +192,32 @@ class AutomatonTestCase(unittest.TestCase):
         neighbours_5_5_1 = self.automaton.von_neumann_neighbours((5, 5), 1)
         self.assertItemsEqual(neighbours_5_5_1.keys(), [(4,5),(5,4),(5,6),(6,5)])
 
+    def test_box_sum(self):
+        values = np.arange(100).reshape(self.shape)
+        sums = self.automaton.box_sum(values, 2)
+        for x in range(self.shape[0]):
+            for y in range(self.shape[1]):
+                self.assertEqual(sums[x, y], values[max(x - 2, 0):x + 3, max(y - 2, 0):y + 3].sum())
+
+    def test_nearest_depths(self):
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[2, 3] = True
+        mask[9, 9] = True
+        for type in ['moore', 'von_neumann']:
+            depths = self.automaton.nearest_depths(mask, type)
+            for x in range(self.shape[0]):
+                for y in range(self.shape[1]):
+                    # Lowest depth whose neighbours include a masked cell
+                    expected = 4
+                    for depth in range(3, 0, -1):
+                        if any(mask[n] for n in self.automaton.neighbours((x, y), depth, type)):
+                            expected = depth
+                    if mask[x, y]:
+                        expected = 0
+                    self.assertEqual(depths[x, y], expected)
+        self.assertEqual(self.automaton.nearest_depths(mask)[5, 6], 3)
+        self.assertEqual(self.automaton.nearest_depths(mask, 'von_neumann')[5, 6], 4)
+
     def test_record_grids(self):
         # 2 records - check both are in the output file
 
@@ -0,0 +1,53 @@
+import unittest
+from CAPE.Grid import *
+from CAPE.Agent import *
+
+
+class GridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.shape = (10, 10)
+        self.attributes = ['a', 'b', 'c']
+        self.formats = ['float', 'int', 'object']
+        self.grid = Grid(self.shape, self.attributes, self.formats)
+
+    def test_initialise(self):
+        self.assertSequenceEqual(self.grid.shape, self.shape)
+        self.assertItemsEqual(self.grid.fields.keys(), self.attributes)
+        self.assertEqual(self.grid['a'].dtype, np.dtype(float))
+        self.assertEqual(self.grid['b'].dtype, np.dtype(int))
+        self.assertEqual(self.grid['c'].dtype, np.dtype(object))
+        for attribute in self.attributes:
+            # Each attribute is a separate contiguous array
+            self.assertTrue(self.grid[attribute].flags['C_CONTIGUOUS'])
+            self.assertSequenceEqual(self.grid[attribute].shape, self.shape)
+            self.assertEqual(self.grid[attribute].sum(), 0)
+
+    def test_cell_read_write(self):
+        agent = Agent((3, 4))
+        self.grid[(3, 4)]['c'] = agent
+        self.grid[(3, 4)]['a'] = 2.5
+        self.assertEqual(self.grid['c'][3, 4], agent)
+        self.assertEqual(self.grid[(3, 4)]['c'], agent)
+        self.assertEqual(self.grid['a'][3, 4], 2.5)
+        self.grid[(3, 4)]['a'] /= 2
+        self.assertEqual(self.grid[(3, 4)]['a'], 1.25)
+
+    def test_set_attribute_in_place(self):
+        array = self.grid['a']
+        self.grid['a'] = np.ones(self.shape)
+        # Same array, new values
+        self.assertTrue(self.grid['a'] is array)
+        self.assertEqual(array.sum(), 100)
+
+    def test_copy(self):
+        self.grid[(1, 1)]['a'] = 8.8
+        copied = self.grid.copy()
+        self.assertEqual(copied[(1, 1)]['a'], 8.8)
+        self.grid[(1, 1)]['a'] = 1.0
+        self.assertEqual(copied[(1, 1)]['a'], 8.8)
+        self.assertFalse(copied['c'] is self.grid['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from CAPE.Neighbourhood import *
+
+
+class NeighbourTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.shape = (6, 5)
+        self.relative_addresses = [(-1, 0), (0, -1), (0, 1), (1, 0), (2, 2)]
+        self.table = NeighbourTable(self.shape, self.relative_addresses)
+
+    def test_flat_index(self):
+        self.assertEqual(self.table.flat_index((0, 0)), 0)
+        self.assertEqual(self.table.flat_index((2, 3)), 13)
+        self.assertEqual(self.table.flat_index((5, 4)), 29)
+
+    def test_offsets(self):
+        self.assertEqual(len(self.table.offsets), 31)
+        self.assertEqual(self.table.offsets[0], 0)
+        self.assertEqual(self.table.offsets[-1], len(self.table.indices))
+
+    def test_matches_relative_addresses(self):
+        for x in range(self.shape[0]):
+            for y in range(self.shape[1]):
+                expected = []
+                for relative_address in self.relative_addresses:
+                    neighbour = (x + relative_address[0], y + relative_address[1])
+                    if 0 <= neighbour[0] < self.shape[0] and 0 <= neighbour[1] < self.shape[1]:
+                        expected.append(neighbour[0] * self.shape[1] + neighbour[1])
+                # Same neighbours, in the order of the relative addresses
+                self.assertSequenceEqual(list(self.table.neighbours(self.table.flat_index((x, y)))), expected)
+
+    def test_queries_leave_table_unchanged(self):
+        indices = self.table.indices.copy()
+        neighbours = self.table.neighbours(7)
+        self.table.gather([0, 7, 29])
+        self.assertTrue(np.array_equal(self.table.indices, indices))
+        self.assertTrue(np.array_equal(neighbours, indices[self.table.offsets[7]:self.table.offsets[8]]))
+
+    def test_corner(self):
+        self.assertItemsEqual(self.table.neighbours(0), [1, 5, 12])
+        self.assertItemsEqual(self.table.neighbours(29), [24, 28])
+
+    def test_address(self):
+        self.assertEqual(self.table.address(13), (2, 3))
+        self.assertEqual(self.table.address(self.table.flat_index((5, 1))), (5, 1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -157,6 +157,36 @@ class TBAutomatonTestCase(unittest.TestCase):
                     self.assertEqual(cell['oxygen_diffusion_rate'], self.model_params['oxygen_diffusion'])
                     self.assertEqual(cell['chemotherapy_diffusion_rate'], self.model_params['chemotherapy_diffusion'])
 
+    def test_diffusion_pre_process_incremental(self):
+        self.automaton.model_parameters['caseum_distance_to_reduce_diffusion'] = 2
+        self.automaton.model_parameters['caseum_threshold_to_reduce_diffusion'] = 2
+        self.automaton.model_parameters['diffusion_caseum_reduction'] = 2.0
+
+        self.automaton.caseum_addresses.append((4, 1))
+        self.automaton.diffusion_pre_process()
+        self.assertFalse(self.automaton.caseum_reduced.any())
+
+        # New caseum updates the counts around it - same result as counting everything again
+        self.automaton.caseum_addresses.append((4, 3))
+        self.automaton.caseum_addresses.append((2, 3))
+        self.automaton.diffusion_pre_process()
+        counts = self.automaton.caseum_counts.copy()
+        oxygen_rates = self.automaton.grid['oxygen_diffusion_rate'].copy()
+        blood_vessels = self.automaton.grid['blood_vessel'].copy()
+        self.assertEqual(counts[(3, 2)], 3)
+        self.assertEqual(counts[(6, 5)], 1)
+        self.assertEqual(oxygen_rates[(6, 5)], 1.0)
+        self.assertEqual(oxygen_rates[(3, 2)], 0.5)
+        self.assertEqual(oxygen_rates[(9, 9)], 1.0)
+        self.assertEqual(blood_vessels[(2, 3)], 0.5)
+        self.assertEqual(blood_vessels[(1, 1)], 1.0)
+        self.assertEqual(blood_vessels[(3, 5)], 0.5)
+
+        self.automaton.rebuild_caseum_map(self.automaton.caseum_map_parameters)
+        np.testing.assert_array_equal(self.automaton.caseum_counts, counts)
+        np.testing.assert_array_equal(self.automaton.grid['oxygen_diffusion_rate'], oxygen_rates)
+        np.testing.assert_array_equal(self.automaton.grid['blood_vessel'], blood_vessels)
+
     def test_record_counts(self):
         # BASE
         self.automaton.record_counts()
@@ -464,12 +494,62 @@ class TBAutomatonTestCase(unittest.TestCase):
         self.assertTrue(isinstance(events[0], TCellDeath))
         self.assertEqual(events[0].t_cell_address, (7, 2))
 
+    def test_free_neighbours(self):
+        addresses = [(8, 2), (0, 0), (1, 2)]
+        for depth in range(1, 4):
+            free, offsets = self.automaton.free_neighbours(addresses, depth)
+            self.assertEqual(len(offsets), 4)
+            for index, address in enumerate(addresses):
+                # Same as checking each neighbour of the address in turn
+                expected = [n for n in self.automaton.neighbour_indices(address, depth)
+                            if self.automaton.grid[self.automaton.addresses_of(n)]['contents'] == 0 and
+                            self.automaton.grid[self.automaton.addresses_of(n)]['blood_vessel'] == 0.0]
+                self.assertSequenceEqual(list(free[offsets[index]:offsets[index + 1]]), expected)
+        # Blood vessel is not free
+        free, offsets = self.automaton.free_neighbours([(1, 2)], 1, 'von_neumann')
+        self.assertItemsEqual(self.automaton.addresses_of(free), [(0, 2), (2, 2), (1, 3)])
+
+    def test_nearest_free_neighbours(self):
+        # Fill all but a few cells
+        for x in range(self.shape[0]):
+            for y in range(self.shape[1]):
+                if self.automaton.grid[(x, y)]['contents'] == 0:
+                    self.automaton.grid[(x, y)]['contents'] = Caseum((x, y))
+        for address in [(5, 5), (6, 4), (0, 9)]:
+            self.automaton.grid[address]['contents'] = 0
+        addresses = [(8, 2), (5, 4), (0, 0), (5, 5)]
+        free, offsets, depths = self.automaton.nearest_free_neighbours(addresses, 'von_neumann')
+        self.assertSequenceEqual(list(depths), [4, 1, 4, 2])
+        self.assertEqual(len(offsets), 5)
+        self.assertItemsEqual(self.automaton.addresses_of(free[offsets[1]:offsets[2]]), [(5, 5), (6, 4)])
+        self.assertEqual(offsets[1], offsets[0])
+        self.assertEqual(offsets[3], offsets[2])
+        self.assertItemsEqual(self.automaton.addresses_of(free[offsets[3]:offsets[4]]), [(6, 4)])
+
+        free, offsets, depths = self.automaton.nearest_free_neighbours(addresses)
+        self.assertSequenceEqual(list(depths), [2, 1, 4, 1])
+        self.assertItemsEqual(self.automaton.addresses_of(free[offsets[0]:offsets[1]]), [(6, 4)])
+        self.assertItemsEqual(self.automaton.addresses_of(free[offsets[1]:offsets[2]]), [(5, 5), (6, 4)])
+
+        free, offsets, depths = self.automaton.nearest_free_neighbours([])
+        self.assertEqual(len(free), 0)
+        self.assertSequenceEqual(list(offsets), [0])
+
+    def test_sample_free_neighbours(self):
+        samples = self.automaton.sample_free_neighbours([(0, 0), (8, 2)], 2)
+        self.assertEqual(len(samples), 2)
+        self.assertItemsEqual(samples[0], [(0, 1), (1, 0)])
+        # Nearest free cells only
+        self.assertEqual(len(samples[1]), 2)
+        for address in samples[1]:
+            self.assertTrue(address in [(7, 1), (7, 2), (7, 3), (9, 1), (9, 2), (9, 3)])
+
     def test_find_max_chemokine_neighbour(self):
 
         self.automaton.grid[(0,0)]['chemokine'] = 1.0
         self.automaton.max_chemokine = 1.0
 
-        neighbours = self.automaton.moore_neighbours((1,1), 1)
+        neighbours = self.automaton.neighbour_indices((1,1), 1)
         address, scale = self.automaton.find_max_chemokine_neighbour(neighbours)
         self.assertEqual(address, (0,0))
         self.assertEqual(scale, 1.0)
@@ -477,7 +557,7 @@ class TBAutomatonTestCase(unittest.TestCase):
         # tie-break
         self.automaton.grid[(2, 0)]['chemokine'] = 1.0
         np.random.seed(101) # Force pick of (2, 0)
-        neighbours = self.automaton.moore_neighbours((1, 1), 1)
+        neighbours = self.automaton.neighbour_indices((1, 1), 1)
         address, scale = self.automaton.find_max_chemokine_neighbour(neighbours)
         self.assertEqual(address, (2, 0))
         self.assertEqual(scale, 1.0)
@@ -515,7 +595,7 @@ class TBAutomatonTestCase(unittest.TestCase):
         self.assertEqual(len(events), 1)
         self.assertTrue(isinstance(events[0], TCellMovement))
         self.assertEqual(events[0].tcell_from_address, (5, 1))
-        self.assertEqual(events[0].tcell_to_address, (6, 1))
+        self.assertEqual(events[0].tcell_to_address, (4, 1))
 
     def test_t_cell_kills_mac(self):
 
@@ -631,7 +711,7 @@ class TBAutomatonTestCase(unittest.TestCase):
         self.automaton.model_parameters['resting_macrophage_movement_time'] = 1.0
         self.automaton.model_parameters['prob_resting_macrophage_random_move'] = 100.0
 
-        self.automaton.grid[(7,8)]['chemokine'] = 100.0
+        self.automaton.grid[(9, 9)]['chemokine'] = 100.0
         self.automaton.max_chemokine = 100.0
 
         self.automaton.macrophages = []
@@ -649,13 +729,13 @@ class TBAutomatonTestCase(unittest.TestCase):
         self.assertEqual(len(events), 1)
         self.assertTrue(isinstance(events[0], MacrophageMovement))
         self.assertEqual(events[0].macrophage_from_address, (8, 8))
-        self.assertEqual(events[0].macrophage_to_address, (7, 7))
+        self.assertEqual(events[0].macrophage_to_address, (7, 8))
 
     def test_macrophage_resting_move_random_through_not_enough_chemokine(self):
         self.automaton.model_parameters['resting_macrophage_movement_time'] = 1.0
         self.automaton.model_parameters['minimum_chemokine_for_resting_macrophage_movement'] = 101.0
 
-        self.automaton.grid[(7, 8)]['chemokine'] = 100.0
+        self.automaton.grid[(9, 9)]['chemokine'] = 100.0
         self.automaton.max_chemokine = 100.0
 
         self.automaton.macrophages = []
@@ -673,7 +753,7 @@ class TBAutomatonTestCase(unittest.TestCase):
         self.assertEqual(len(events), 1)
         self.assertTrue(isinstance(events[0], MacrophageMovement))
         self.assertEqual(events[0].macrophage_from_address, (8, 8))
-        self.assertEqual(events[0].macrophage_to_address, (7, 7))
+        self.assertEqual(events[0].macrophage_to_address, (7, 8))
 
     def test_macrophage_resting_kill_bac(self):
         self.automaton.model_parameters['resting_macrophage_movement_time'] = 1.0
@@ -1101,7 +1181,97 @@ class TBAutomatonTestCase(unittest.TestCase):
         bac.resting = True
         events = self.automaton.bacteria_processes()
         self.assertEqual(len(events), 0)
-        
+
+    def test_bacteria_resting_space_within_depth(self):
+        self.automaton.bacteria = []
+        for x in range(self.shape[0]):
+            for y in range(self.shape[1]):
+                self.automaton.grid[(x, y)]['contents'] = Caseum((x, y))
+        bac = Bacterium((8, 8), 'fast')
+        self.automaton.bacteria.append(bac)
+        self.automaton.grid[(8, 8)]['contents'] = bac
+        bac.resting = True
+
+        # Free cell 4 away is beyond the search
+        self.automaton.grid[(4, 8)]['contents'] = 0
+        self.assertEqual(len(self.automaton.bacteria_processes()), 0)
+        # Free cell at depth 3 wakes the bacterium
+        self.automaton.grid[(5, 5)]['contents'] = 0
+        events = self.automaton.bacteria_processes()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].bacterium_address, (8, 8))
+        self.assertEqual(events[0].value, False)
+
+        # Same when read from the Moore depth map built for a dividing bacterium (not due to divide)
+        self.automaton.time = 1
+        self.automaton.grid[(5, 5)]['contents'] = Caseum((5, 5))
+        dividing = Bacterium((0, 0), 'slow')
+        self.automaton.bacteria.append(dividing)
+        self.automaton.grid[(0, 0)]['contents'] = dividing
+        self.assertEqual(len(self.automaton.bacteria_processes()), 0)
+        self.automaton.grid[(5, 5)]['contents'] = 0
+        events = self.automaton.bacteria_processes()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].bacterium_address, (8, 8))
+
+    def test_subdomain_core(self):
+        subdomains = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                 self.bv, self.macs, self.fb, self.sb,
+                                 diffusion_parameters={'subdomain_agents': True, 'workers': 2})
+        self.assertSequenceEqual(subdomains.agent_bands, [(0, 5), (5, 10)])
+        # Rows within max_depth (3) of the other subdomain are boundary rows
+        self.assertEqual(subdomains.subdomain_core(0), (0, 2))
+        self.assertEqual(subdomains.subdomain_core(1), (8, 10))
+        agents = subdomains.subdomain_agents()
+        self.assertItemsEqual([b.address for b in agents[0]['bacteria']], self.sb)
+        self.assertItemsEqual([b.address for b in agents[1]['bacteria']], self.fb)
+        self.assertItemsEqual(agents[0]['blood_vessel_addresses'], self.bv)
+        subdomains.close_files()
+
+    def test_subdomain_events(self):
+        subdomains = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                 self.bv, self.macs, self.fb, self.sb, numpy_seed=3,
+                                 diffusion_parameters={'subdomain_agents': True, 'workers': 2})
+        subdomains.time = 50.0
+        subdomains.model_parameters['bacteria_replication_fast_upper'] = 6.0
+        subdomains.model_parameters['bacteria_replication_fast_lower'] = 5.0
+        subdomains.model_parameters['bacteria_replication_slow_upper'] = 100.0
+        subdomains.model_parameters['bacteria_replication_slow_lower'] = 99.0
+
+        subdomains.potential_events = subdomains.generate_events_from_agents()
+        events = subdomains.subdomain_accepted + subdomains.potential_events
+        self.assertEqual(len(events), len(self.fb))
+        for event in events:
+            self.assertTrue(isinstance(event, BacteriumReplication))
+            self.assertTrue(event.original_bac_address in self.fb)
+            self.assertEqual(subdomains.grid[event.new_bac_address]['contents'], 0.0)
+        # Events accepted by the subdomain lie in its core, the rest touch a boundary row
+        for event in subdomains.subdomain_accepted:
+            self.assertTrue(event.new_bac_address[0] >= 8)
+        for event in subdomains.potential_events:
+            self.assertEqual(event.new_bac_address[0], 7)
+        # Ages were incremented once, in the worker, and passed back
+        for agent in subdomains.bacteria + subdomains.macrophages:
+            self.assertAlmostEqual(agent.age, self.time_params['time_step'])
+
+        # Cross-domain pass - no two accepted events create a bacterium in the same cell
+        accepted = subdomains.conflict_resolve_events()
+        new_addresses = [event.new_bac_address for event in accepted]
+        self.assertEqual(len(new_addresses), len(set(new_addresses)))
+        self.assertEqual(subdomains.subdomain_accepted, [])
+
+        # The workers are kept for the next step, and given the agents' state as it is then
+        processes = subdomains.agent_processes
+        subdomains.time = 51.0
+        subdomains.generate_events_from_agents()
+        self.assertTrue(subdomains.agent_processes is processes)
+        for agent in subdomains.bacteria + subdomains.macrophages:
+            self.assertAlmostEqual(agent.age, 2 * self.time_params['time_step'])
+        subdomains.close_files()
+        self.assertEqual(subdomains.agent_processes, None)
+        for process in processes:
+            self.assertFalse(process.is_alive())
+
 
 if __name__ == '__main__':
     unittest.main()
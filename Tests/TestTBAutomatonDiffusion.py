@@ -1,3 +1,4 @@
+import os
 import shutil
 import unittest
 
@@ -404,7 +405,545 @@ class DiffusionTestCase(unittest.TestCase):
         self.assertEqual(self.automaton.work_grid[(4, 5)]['chemokine'], 0.0)
         self.assertEqual(self.automaton.work_grid[(5, 4)]['chemokine'], 0.0)
 
-    # TODO need to check edges cases as well :(
+    def test_chemokine_edge_diffusion(self):
+        # Edge cell - halo above mirrors the cell below, so flux in from below counts twice
+        self.automaton.grid[(0, 4)]['chemokine'] = 10.0
+        self.automaton.diffusion(True)
+
+        previous_chemo_at_source_cell = 10.0
+        expected_chemo_at_cell = (previous_chemo_at_source_cell) + self.time_params['time_step'] * (
+            (self.model_params['chemokine_diffusion'] * (0 - previous_chemo_at_source_cell) -
+             self.model_params['chemokine_diffusion'] * (previous_chemo_at_source_cell - 0)) /
+            self.model_params['spatial_step'] ** 2
+            + (self.model_params['chemokine_diffusion'] * (0 - previous_chemo_at_source_cell) -
+               self.model_params['chemokine_diffusion'] * (previous_chemo_at_source_cell - 0)) /
+            self.model_params['spatial_step'] ** 2
+            + 0 + 0)
+        self.assertEqual(self.automaton.work_grid[(0, 4)]['chemokine'], expected_chemo_at_cell)
+        expected_chemo_at_cell = self.time_params['time_step'] * (
+            (0 - self.model_params['chemokine_diffusion'] * (0 - previous_chemo_at_source_cell)) /
+            self.model_params['spatial_step'] ** 2)
+        self.assertEqual(self.automaton.work_grid[(1, 4)]['chemokine'], expected_chemo_at_cell)
+        self.assertEqual(self.automaton.work_grid[(0, 3)]['chemokine'], expected_chemo_at_cell)
+        self.assertEqual(self.automaton.work_grid[(0, 5)]['chemokine'], expected_chemo_at_cell)
+
+    def test_chemokine_corner_decay(self):
+        # Corners use the same source and decay terms as the rest of the grid
+        self.automaton.model_parameters['chemokine_diffusion'] = 0.0
+        self.automaton.model_parameters['chemokine_decay'] = 1.0
+        for corner in [(0, 0), (0, 9), (9, 0), (9, 9)]:
+            self.automaton.grid[corner]['chemokine'] = 10.0
+
+        self.automaton.diffusion(True)
+
+        expected_chemo_at_cell = 10.0 + self.time_params['time_step'] * (0.0 + 0.0 - 1.0 * 10.0)
+        for corner in [(0, 0), (0, 9), (9, 0), (9, 9)]:
+            self.assertEqual(self.automaton.work_grid[corner]['chemokine'], expected_chemo_at_cell)
+
+    def test_implicit_matches_explicit(self):
+        # Smooth field, so both schemes should be close to the exact solution
+        x, y = np.indices(self.shape)
+        smooth = 10.0 * np.exp(-((x - 4.5) ** 2 + (y - 4.5) ** 2) / 8.0)
+        self.automaton.grid['chemokine'] = smooth
+        self.automaton.diffusion(False)
+
+        implicit = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                               self.bv, self.macs, self.fb, self.sb,
+                               diffusion_parameters={'engine': 'implicit', 'implicit_theta': 0.5})
+        implicit.grid['chemokine'] = smooth
+        implicit.diffusion(False)
+        implicit.close_files()
+
+        for x in range(10):
+            for y in range(10):
+                self.assertAlmostEqual(implicit.work_grid[(x, y)]['chemokine'],
+                                       self.automaton.work_grid[(x, y)]['chemokine'], delta=0.01)
+
+    def test_implicit_large_step(self):
+        # 100 times the automaton time step - far beyond the explicit stability limit
+        implicit = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                               self.bv, self.macs, self.fb, self.sb,
+                               diffusion_parameters={'engine': 'implicit', 'diffusion_interval': 100})
+        implicit.grid[(0, 0)]['chemokine'] = 10.0
+        implicit.diffusion(False)
+        implicit.close_files()
+
+        for field in ['oxygen', 'chemokine']:
+            self.assertTrue(np.all(np.isfinite(implicit.work_grid[field])))
+            self.assertTrue(implicit.work_grid[field].min() >= 0.0)
+            self.assertTrue(implicit.work_grid[field].max() < implicit.grid[field].max())
+        # Spread out from the source
+        self.assertTrue(implicit.work_grid[(0, 3)]['chemokine'] > 0.0)
+
+    def test_diffusion_interval_holds_fields(self):
+        held = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                           self.bv, self.macs, self.fb, self.sb, diffusion_parameters={'diffusion_interval': 2})
+        held.grid[(4, 4)]['chemokine'] = 10.0
+        # Second step of the interval - no diffusion
+        held.time = 2
+        held.update_cells()
+        held.close_files()
+        for field in ['oxygen', 'chemotherapy', 'chemokine']:
+            self.assertTrue(np.array_equal(held.work_grid[field], held.grid[field]))
+
+    def test_implicit_validation(self):
+        implicit = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                               self.bv, self.macs, self.fb, self.sb,
+                               diffusion_parameters={'engine': 'implicit', 'diffusion_interval': 5,
+                                                     'validate': True})
+        implicit.time = 1
+        implicit.diffusion(False)
+        implicit.close_files()
+
+        with open(self.output_loc + '/diffusion_validation.csv', 'rb') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=','))
+        self.assertEqual(rows[0], ['timestep', 'oxygen', 'chemotherapy', 'chemokine'])
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(0.0 < float(rows[1][1]) < 0.1)
+        self.assertEqual(float(rows[1][2]), 0.0)
+
+    def test_diffusion_sub_steps(self):
+        self.time_params['time_step'] = 0.004
+        split = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                            self.bv, self.macs, self.fb, self.sb, diffusion_parameters={'diffusion_sub_steps': 4})
+        split.grid[(4, 4)]['chemokine'] = 10.0
+        split.diffusion(False)
+        split.close_files()
+
+        # Same as four explicit steps at a quarter of the time step
+        engine = DiffusionEngine(self.shape)
+        oxygen = split.grid['oxygen'].copy()
+        chemokine = split.grid['chemokine'].copy()
+        for i in range(4):
+            engine.step('oxygen', oxygen, split.grid['oxygen_diffusion_rate'], 0.0, 0.0, 0.001,
+                        self.model_params['spatial_step'], oxygen)
+            engine.step('chemokine', chemokine, self.model_params['chemokine_diffusion'], 0.0, 0.0, 0.001,
+                        self.model_params['spatial_step'], chemokine)
+        self.assertTrue(np.array_equal(split.work_grid['oxygen'], oxygen))
+        self.assertTrue(np.array_equal(split.work_grid['chemokine'], chemokine))
+
+    def test_cached_face_rates(self):
+        engine = DiffusionEngine(self.shape)
+        rate = np.ones(self.shape)
+        values = np.zeros(self.shape)
+        values[(4, 4)] = 10.0
+        out = np.zeros(self.shape)
+        engine.step('oxygen', values, rate, 0.0, 0.0, 0.001, self.model_params['spatial_step'], out)
+        row_face_rates, column_face_rates = engine.face_rates('oxygen', rate)
+        self.assertSequenceEqual(row_face_rates.shape, (12, 12))
+        self.assertSequenceEqual(column_face_rates.shape, (12, 12))
+
+        # Cached until invalidated
+        rate[(4, 4)] = 0.0
+        self.assertTrue(engine.face_rates('oxygen', rate)[0] is row_face_rates)
+        engine.invalidate('oxygen')
+        row_face_rates = engine.face_rates('oxygen', rate)[0]
+        # Faces above and below cell (4, 4) (cell (5, 5) in the padded layout)
+        self.assertEqual(row_face_rates[(4, 5)], 0.5)
+        self.assertEqual(row_face_rates[(5, 5)], 0.5)
+        self.assertEqual(row_face_rates[(6, 5)], 1.0)
+
+    def test_caseum_invalidates_coefficients(self):
+        self.automaton.model_parameters['caseum_distance_to_reduce_diffusion'] = 1
+        self.automaton.model_parameters['caseum_threshold_to_reduce_diffusion'] = 1
+        self.automaton.model_parameters['diffusion_caseum_reduction'] = 2.0
+        self.automaton.diffusion(False)
+        self.assertTrue('oxygen' in self.automaton.diffusion_engine.coefficients)
+        self.automaton.caseum_addresses.append((4, 1))
+        self.automaton.diffusion_pre_process()
+        self.assertFalse('oxygen' in self.automaton.diffusion_engine.coefficients)
+
+    def test_field_maxima(self):
+        self.automaton.grid[(4, 4)]['chemokine'] = 10.0
+        self.automaton.update_field_maxima()
+        self.assertEqual(self.automaton.field_maxima['chemokine'], 10.0)
+        self.automaton.model_parameters['chemotherapy_schedule1_end'] = 20000.0
+        self.automaton.model_parameters['chemotherapy_schedule2_start'] = 30000.0
+        self.automaton.time = 1
+        self.automaton.update_cells()
+        self.assertEqual(self.automaton.max_chemokine, 10.0)
+        # Maxima of the new values come from the diffusion update
+        for field in ['oxygen', 'chemotherapy', 'chemokine']:
+            self.assertEqual(self.automaton.field_maxima[field], self.automaton.work_grid[field].max())
+
+    def test_chemotherapy_schedule(self):
+        self.automaton.chemo_schedule1_start = 1.0
+        self.automaton.model_parameters['chemotherapy_schedule1_end'] = 2.0
+        self.automaton.model_parameters['chemotherapy_schedule2_start'] = 3.0
+        for time, scheduled in [(999, False), (1000, True), (1999, True), (2000, False), (3000, True)]:
+            self.automaton.time = time
+            self.assertEqual(self.automaton.chemotherapy_scheduled(), scheduled)
+
+    def test_chemotherapy_cleared_once(self):
+        self.model_params['chemotherapy_from_source'] = 1.0
+        self.assertFalse(self.automaton.field_in_grid('chemotherapy'))
+        self.automaton.diffusion(True)
+        self.assertTrue(self.automaton.work_grid[(4, 4)]['chemotherapy'] > 0.0)
+        self.automaton.swap_grids()
+        self.assertTrue(self.automaton.field_in_grid('chemotherapy'))
+
+        # Off - work grid is cleared, and the grid is still read this step
+        self.automaton.diffusion(False)
+        self.assertEqual(self.automaton.work_grid['chemotherapy'].max(), 0.0)
+        self.assertEqual(self.automaton.field_maxima['chemotherapy'], 0.0)
+        self.automaton.swap_grids()
+        self.assertFalse(self.automaton.field_in_grid('chemotherapy'))
+        self.automaton.diffusion(False)
+        self.automaton.swap_grids()
+
+        # Both arrays are now known to be zero, so are not written to again
+        self.automaton.work_grid['chemotherapy'][(1, 1)] = 5.0
+        self.automaton.diffusion(False)
+        self.assertEqual(self.automaton.work_grid[(1, 1)]['chemotherapy'], 5.0)
+
+    def test_steady_state_skips_updates(self):
+        self.model_params['chemokine_from_bacteria'] = 1.0
+        steady = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                             self.bv, self.macs, self.fb, self.sb,
+                             diffusion_parameters={'steady_state_tolerance': 1e-6})
+        # No chemokine and no bacteria to produce it, so the chemokine field is steady after the first update
+        steady.diffusion(False)
+        steady.swap_grids()
+        self.assertTrue('chemokine' in steady.steady_fields)
+        steady.work_grid['chemokine'][(1, 1)] = 5.0
+        steady.diffusion(False)
+        self.assertEqual(steady.work_grid[(1, 1)]['chemokine'], 0.0)
+        self.assertEqual(steady.skipped_updates['chemokine'], 1)
+        self.assertEqual(steady.diffusion_updates['chemokine'], 2)
+        # Oxygen is still spreading from the vessel
+        self.assertEqual(steady.skipped_updates['oxygen'], 0)
+
+        # A new bacterium changes the chemokine source
+        steady.swap_grids()
+        steady.bacteria_mask[(2, 2)] = 1
+        steady.diffusion(False)
+        self.assertEqual(steady.skipped_updates['chemokine'], 1)
+        self.assertTrue(steady.work_grid[(2, 2)]['chemokine'] > 0.0)
+
+        steady.write_steady_state_report()
+        steady.close_files()
+        with open(self.output_loc + '/steady_state_report.csv', 'rb') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=','))
+        self.assertEqual(rows[0], ['field', 'updates', 'skipped'])
+        self.assertEqual(rows[3], ['chemokine', '3', '1'])
+
+    def test_stable_time_step(self):
+        engine = DiffusionEngine(self.shape)
+        # 4 * 1.0 / 0.2^2 + 1.0
+        self.assertAlmostEqual(engine.stable_time_step('chemokine', 1.0, 1.0, 0.2), 1.0 / 101)
+        rate = np.ones(self.shape)
+        rate[(4, 4)] = 3.0
+        # Faces around (4, 4) have rate 2.0
+        self.assertAlmostEqual(engine.stable_time_step('oxygen', rate, 0.0, 0.2), 0.04 / 8)
+        self.assertTrue(engine.stable_time_step('chemotherapy', np.zeros(self.shape), 0.0, 0.2) is None)
+        self.assertTrue(ImplicitDiffusionEngine(self.shape).stable_time_step('oxygen', rate, 0.0, 0.2) is None)
+
+    def test_adaptive_time_step(self):
+        self.time_params['time_step'] = 0.025
+        adaptive = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                               self.bv, self.macs, self.fb, self.sb,
+                               diffusion_parameters={'adaptive_time_step': True})
+        adaptive.grid[(4, 4)]['chemokine'] = 10.0
+        adaptive.diffusion(False)
+        # Stable step is 0.01, so 3 solver steps
+        self.assertEqual(adaptive.solver_steps['oxygen'], 3)
+        self.assertEqual(adaptive.solver_steps['chemokine'], 3)
+        self.assertTrue(adaptive.work_grid['chemokine'].min() >= 0.0)
+        self.assertAlmostEqual(adaptive.work_grid['chemokine'].sum(), 10.0)
+
+        # Lower oxygen rates need fewer steps
+        adaptive.swap_grids()
+        adaptive.grid['oxygen_diffusion_rate'] = 0.5
+        adaptive.diffusion_rates_changed()
+        adaptive.diffusion(False)
+        self.assertEqual(adaptive.solver_steps['oxygen'], 5)
+        self.assertEqual(adaptive.solver_steps['chemokine'], 6)
+        # Agent time step is unchanged
+        self.assertEqual(adaptive.time_step, 0.025)
+
+        adaptive.write_solver_step_report()
+        adaptive.close_files()
+        with open(self.output_loc + '/solver_step_report.csv', 'rb') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=','))
+        self.assertEqual(rows[0], ['field', 'updates', 'solver_steps', 'mean_time_step'])
+        self.assertEqual(rows[1][:3], ['oxygen', '2', '5'])
+        self.assertAlmostEqual(float(rows[1][3]), 0.01)
+
+    def test_adaptive_validation(self):
+        self.time_params['time_step'] = 0.025
+        adaptive = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                               self.bv, self.macs, self.fb, self.sb,
+                               diffusion_parameters={'adaptive_time_step': True, 'validate': True})
+        adaptive.grid[(4, 4)]['chemokine'] = 10.0
+        adaptive.diffusion(False)
+        adaptive.close_files()
+        # The reference is also run at the stable step (not the unstable time step), so matches
+        with open(self.output_loc + '/diffusion_validation.csv', 'rb') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=','))
+        self.assertTrue(float(rows[1][1]) < 1e-12)
+        self.assertTrue(float(rows[1][3]) < 1e-12)
+
+    def test_fixed_time_step_checked_once(self):
+        self.time_params['time_step'] = 0.025
+        fixed = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                            self.bv, self.macs, self.fb, self.sb)
+        fixed.diffusion(False)
+        self.assertItemsEqual(fixed.unstable_fields, ['oxygen', 'chemokine'])
+        self.assertItemsEqual(fixed.checked_fields, ['oxygen', 'chemokine'])
+        # Checked again once the rates change
+        fixed.diffusion_rates_changed()
+        self.assertEqual(len(fixed.checked_fields), 0)
+        fixed.close_files()
+
+    def test_stacked_matches_explicit(self):
+        self.model_params['oxygen_from_source'] = 2.0
+        self.model_params['oxygen_uptake_from_bacteria'] = 0.5
+        self.model_params['chemotherapy_from_source'] = 1.0
+        self.model_params['chemotherapy_decay'] = 0.1
+        self.model_params['chemokine_from_bacteria'] = 1.0
+        self.model_params['chemokine_decay'] = 0.2
+        automata = []
+        for engine in ['explicit', 'stacked']:
+            automaton = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                    self.bv, self.macs, self.fb, self.sb, diffusion_parameters={'engine': engine})
+            automaton.grid['oxygen_diffusion_rate'][(4, 5)] = 0.25
+            automaton.bacteria_mask[(6, 6)] = 1.0
+            for i in range(3):
+                automaton.diffusion(True)
+                automaton.swap_grids()
+            automaton.close_files()
+            automata.append(automaton)
+
+        for field in ['oxygen', 'chemotherapy', 'chemokine']:
+            self.assertTrue(np.array_equal(automata[0].grid[field], automata[1].grid[field]))
+            self.assertEqual(automata[0].field_maxima[field], automata[1].field_maxima[field])
+
+    def test_banded_engines_match_explicit(self):
+        self.model_params['oxygen_from_source'] = 2.0
+        self.model_params['oxygen_uptake_from_bacteria'] = 0.5
+        self.model_params['chemokine_from_bacteria'] = 1.0
+        self.model_params['chemokine_decay'] = 0.2
+        automata = []
+        for parameters in [{'engine': 'explicit'}, {'engine': 'tiled', 'workers': 3},
+                           {'engine': 'subdomain', 'workers': 3}]:
+            automaton = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                    self.bv, self.macs, self.fb, self.sb, diffusion_parameters=parameters)
+            automaton.grid['oxygen_diffusion_rate'][(3, 5)] = 0.25
+            automaton.bacteria_mask[(6, 6)] = 1.0
+            for i in range(3):
+                automaton.diffusion(False)
+                automaton.swap_grids()
+            automaton.close_files()
+            automata.append(automaton)
+
+        for automaton in automata[1:]:
+            # Bands of 3, 3 and 4 rows
+            self.assertEqual(automaton.diffusion_engine.bands, [(0, 3), (3, 6), (6, 10)])
+            for field in ['oxygen', 'chemokine']:
+                self.assertTrue(np.array_equal(automata[0].grid[field], automaton.grid[field]))
+                self.assertEqual(automata[0].field_maxima[field], automaton.field_maxima[field])
+        # Worker processes are stopped when the files are closed
+        self.assertTrue(automata[2].diffusion_engine.processes is None)
+
+    def test_sparse_matches_explicit(self):
+        shape = (40, 40)
+        dense = DiffusionEngine(shape)
+        sparse = SparseDiffusionEngine(shape, tile_size=8)
+        rate = np.ones(shape)
+        rate[10:12, 10:14] = 0.5
+        source = np.zeros(shape)
+        source[12, 9] = 2.0
+        values = np.zeros(shape)
+        values[14, 12] = 10.0
+        dense_out = values.copy()
+        sparse_out = values.copy()
+        for i in range(5):
+            dense.step('chemokine', dense_out, rate, source, 0.3, 0.001, 0.2, dense_out)
+            sparse.step('chemokine', sparse_out, rate, source, 0.3, 0.001, 0.2, sparse_out)
+            self.assertTrue(np.array_equal(dense_out, sparse_out))
+
+        # The field starts in tile (1, 1), so the first step updates tiles 0 to 2 in each direction (9 of the 25
+        # tiles). It then reaches tile row 2 (row 16), so later steps update tile rows 0 to 3 (12 tiles)
+        self.assertAlmostEqual(sparse.updated_fraction('chemokine'), (9 + 4 * 12) / (5 * 25.0))
+
+        # Rows of tiles with the same active columns are updated as one block
+        tiles = np.zeros((5, 5), dtype=bool)
+        tiles[0:3, 1:3] = True
+        tiles[3, 0] = True
+        self.assertEqual(sparse.blocks(tiles), [(slice(0, 24), slice(8, 24)), (slice(24, 32), slice(0, 8))])
+
+        # Values at or below the threshold are dropped
+        thresholded = SparseDiffusionEngine(shape, tile_size=8, threshold=1.0)
+        values[35, 35] = 0.5
+        out = np.zeros(shape)
+        thresholded.step('chemokine', values, 1.0, 0.0, 0.0, 0.001, 0.2, out)
+        self.assertEqual(out[35, 35], 0.0)
+        self.assertTrue(out[14, 12] > 0.0)
+
+    def test_matrix_matches_explicit(self):
+        dense = DiffusionEngine(self.shape)
+        matrix = MatrixDiffusionEngine(self.shape)
+        rate = np.ones(self.shape)
+        rate[3:5, 2:6] = 0.25
+        source = np.zeros(self.shape)
+        source[0, 9] = 3.0
+        decay = np.zeros(self.shape)
+        decay[6, 6] = 0.5
+        values = np.zeros(self.shape)
+        values[0, 0] = 10.0
+        values[5, 5] = 4.0
+        dense_out = values.copy()
+        matrix_out = values.copy()
+        for i in range(5):
+            for field_decay in [decay, 0.3]:
+                dense_maximum = dense.step('oxygen', dense_out, rate, source, field_decay, 0.001, 0.2, dense_out)
+                matrix_maximum = matrix.step('oxygen', matrix_out, rate, source, field_decay, 0.001, 0.2, matrix_out)
+                self.assertTrue(np.allclose(dense_out, matrix_out, rtol=1e-12, atol=0.0))
+                self.assertAlmostEqual(dense_maximum, matrix_maximum)
+
+        # The operator is only rebuilt when the rates change
+        laplacian = matrix.laplacian('oxygen', rate, 0.2)
+        matrix.step('oxygen', matrix_out, rate, source, decay, 0.001, 0.2, matrix_out)
+        self.assertTrue(matrix.laplacian('oxygen', rate, 0.2) is laplacian)
+        matrix.invalidate('oxygen')
+        self.assertFalse(matrix.laplacian('oxygen', rate, 0.2) is laplacian)
+
+    def test_matrix_implicit(self):
+        implicit = MatrixDiffusionEngine(self.shape, theta=1.0)
+        self.assertTrue(implicit.stable_time_step('chemokine', 1.0, 0.0, 0.2) is None)
+        values = np.zeros(self.shape)
+        values[0, 0] = 10.0
+        out = np.zeros(self.shape)
+        # 100 times the explicit stability limit
+        implicit.step('chemokine', values, 1.0, 0.0, 0.0, 1.0, 0.2, out)
+        self.assertTrue(out.min() >= 0.0)
+        self.assertTrue(out.max() < 10.0)
+        self.assertTrue(out[9, 9] > 0.0)
+
+    def test_coarse_grid(self):
+        coarse_grid = CoarseGrid((7, 7), 2)
+        self.assertEqual(coarse_grid.coarse_shape, (4, 4))
+        values = np.arange(49.0).reshape((7, 7))
+        restricted = coarse_grid.restrict(values)
+        self.assertEqual(restricted[0, 0], np.mean(values[0:2, 0:2]))
+        self.assertEqual(restricted[3, 3], values[6, 6])
+        self.assertEqual(restricted[1, 3], np.mean(values[2:4, 6]))
+        # Linear along the rows and columns, so interpolated exactly between the coarse centres
+        out = np.zeros((7, 7))
+        coarse_grid.prolong(np.add.outer(np.arange(4.0), np.arange(4.0)), out)
+        self.assertAlmostEqual(out[2, 1], (2 - 0.5) / 2 + (1 - 0.5) / 2)
+        # Held constant beyond the outermost centres
+        self.assertEqual(out[0, 0], 0.0)
+
+        # Uniform field with no sources stays uniform
+        out = np.zeros((7, 7))
+        maximum = coarse_grid.step(np.ones((7, 7)), 1.0, 0.0, 0.0, 0.001, 0.2, 3, out)
+        self.assertTrue(np.allclose(out, 1.0))
+        self.assertAlmostEqual(maximum, 1.0)
+
+    def test_oxygen_coarsening(self):
+        self.model_params['oxygen_from_source'] = 2.0
+        coarse = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                             self.bv, self.macs, self.fb, self.sb,
+                             diffusion_parameters={'oxygen_coarsening': 2, 'validate': True,
+                                                   'adaptive_time_step': True})
+        self.assertEqual(coarse.coarse_grids.keys(), ['oxygen'])
+        self.assertEqual(coarse.coarse_grids['oxygen'].coarse_shape, (5, 5))
+        # Stable step on the coarse grid is 4 times longer
+        fine_time_step = coarse.diffusion_engine.stable_time_step('oxygen', coarse.grid['oxygen_diffusion_rate'],
+                                                                   0.0, 0.2)
+        self.assertAlmostEqual(coarse.coarse_grids['oxygen'].stable_time_step(coarse.grid['oxygen_diffusion_rate'],
+                                                                              0.0, 0.2), 4 * fine_time_step)
+        for i in range(5):
+            coarse.time += 1
+            coarse.diffusion(False)
+            coarse.swap_grids()
+        coarse.close_files()
+
+        # Oxygen spreads from the vessel block, and is read from the interpolated field
+        self.assertTrue(coarse.grid[(4, 4)]['oxygen'] > coarse.grid[(0, 9)]['oxygen'] > 0.0)
+        self.assertEqual(coarse.field_maxima['oxygen'], coarse.grid['oxygen'].max())
+        coarse.max_oxygen = coarse.field_maxima['oxygen']
+        self.assertEqual(coarse.oxygen_scale((4, 4)), coarse.grid[(4, 4)]['oxygen'] / coarse.max_oxygen * 100.0)
+
+        with open(self.output_loc + '/coarse_error_report.csv', 'rb') as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=','))
+        self.assertEqual(rows[0], ['timestep', 'oxygen_max_error', 'oxygen_relative_error'])
+        self.assertEqual(len(rows), 6)
+        self.assertTrue(0.0 < float(rows[5][1]))
+
+    def test_spectral_field(self):
+        import scipy.linalg
+        spectral = SpectralField(self.shape)
+        self.assertTrue(spectral.stable_time_step(1.0, 0.1, 0.2) is None)
+        values = np.zeros(self.shape)
+        values[0, 0] = 10.0
+        values[5, 5] = 4.0
+        source = np.zeros(self.shape)
+        source[0, 9] = 3.0
+        # Exact solution from the matrix exponential of the operator (with the same mirrored boundary)
+        operator = MatrixDiffusionEngine(self.shape).laplacian('chemokine', 1.0, 0.2).toarray() - \
+            0.1 * np.identity(values.size)
+        # 50 times the explicit stability limit, in one step
+        growth = scipy.linalg.expm(operator * 0.5)
+        expected = growth.dot(values.ravel()) + \
+            np.linalg.solve(operator, (growth - np.identity(values.size)).dot(source.ravel()))
+        out = np.zeros(self.shape)
+        maximum = spectral.step(values, 1.0, source, 0.1, 0.1, 0.2, 5, out)
+        self.assertTrue(np.allclose(out.ravel(), expected, rtol=1e-10, atol=1e-12))
+        self.assertEqual(maximum, out.max())
+
+        # Without decay the total (plus the source added) is conserved, with the boundary cells (on the mirror line)
+        # counted by half
+        spectral.step(values, 1.0, source, 0.0, 0.1, 0.2, 5, out)
+        weights = np.ones(self.shape)
+        weights[[0, -1], :] *= 0.5
+        weights[:, [0, -1]] *= 0.5
+        self.assertAlmostEqual((out * weights).sum(), (values * weights).sum() + 0.5 * (source * weights).sum())
+
+        self.assertRaises(Exception, spectral.step, values, np.ones(self.shape), 0.0, 0.0, 0.1, 0.2, 1, out)
+
+    def test_chemokine_spectral_solver(self):
+        self.model_params['chemokine_from_bacteria'] = 1.0
+        self.model_params['chemokine_decay'] = 0.5
+        self.fb = [(2, 2)]
+        automata = []
+        for diffusion_parameters in [{'chemokine_solver': 'spectral', 'diffusion_interval': 5},
+                                     {'diffusion_interval': 5, 'diffusion_sub_steps': 20}]:
+            automaton = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                    self.bv, self.macs, self.fb, self.sb, diffusion_parameters=diffusion_parameters)
+            automaton.time += 5
+            automaton.diffusion(False)
+            automaton.close_files()
+            automata.append(automaton)
+        spectral, explicit = automata
+        self.assertEqual(spectral.spectral_fields.keys(), ['chemokine'])
+        # One exact step over the whole update, close to many small explicit steps
+        self.assertEqual(spectral.solver_steps['chemokine'], 1)
+        self.assertTrue(spectral.work_grid[(2, 3)]['chemokine'] > 0.0)
+        difference = np.abs(spectral.work_grid['chemokine'] - explicit.work_grid['chemokine']).max()
+        self.assertTrue(difference < 0.02 * explicit.work_grid['chemokine'].max())
+        self.assertAlmostEqual(spectral.field_maxima['chemokine'], spectral.work_grid['chemokine'].max())
+
+    def test_species_from_configuration(self):
+        self.model_params['drug_diffusion'] = 1.0
+        species = {'drug': {'diffusion': 'drug_diffusion', 'caseum_reduces_diffusion': True,
+                            'from_blood_vessels': 1.0, 'decay': 0.5, 'schedule': 'chemotherapy'}}
+        automaton = TBAutomaton(self.shape, self.time_params, self.model_params, self.output_loc,
+                                self.bv, self.macs, self.fb, self.sb,
+                                diffusion_parameters={'engine': 'stacked', 'species': species})
+        self.assertTrue(np.all(automaton.grid['drug_diffusion_rate'] == 1.0))
+
+        # Only present while chemotherapy is given
+        automaton.diffusion(False)
+        self.assertFalse(automaton.work_grid['drug'].any())
+        automaton.diffusion(True)
+        self.assertEqual(automaton.work_grid[(4, 4)]['drug'], 0.001)
+        automaton.swap_grids()
+        automaton.diffusion(True)
+        self.assertTrue(automaton.work_grid[(4, 5)]['drug'] > 0.0)
+        self.assertEqual(automaton.field_maxima['drug'], automaton.work_grid['drug'].max())
+        automaton.close_files()
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import unittest
+import ConfigParser
+
+from TBAutomatonRunner import *
+
+
+class RunnerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.output_loc = 'test_output'
+        if not os.path.exists(self.output_loc):
+            os.makedirs(self.output_loc)
+        self.config_file = self.output_loc + '/species.properties'
+        with open(self.config_file, 'w') as properties:
+            properties.write("[ModelParametersSection]\n"
+                             "drug_diffusion = 1.5\n"
+                             "\n"
+                             "[Species:drug]\n"
+                             "diffusion = drug_diffusion\n"
+                             "caseum_reduces_diffusion = True\n"
+                             "from_blood_vessels = 2.0\n"
+                             "decay = 0.5\n"
+                             "schedule = chemotherapy\n"
+                             "coarsening = 2\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_loc)
+
+    def test_load_species(self):
+        config = ConfigParser.RawConfigParser()
+        config.read(self.config_file)
+        species = load_species(config)
+        self.assertEqual(species.keys(), ['drug'])
+        self.assertEqual(species['drug'], {'diffusion': 'drug_diffusion', 'caseum_reduces_diffusion': True,
+                                           'from_blood_vessels': 2.0, 'decay': 0.5, 'schedule': 'chemotherapy',
+                                           'coarsening': 2})
+
+        # Parameter names are looked up in the model parameters, numbers used as they are
+        drug = DiffusingSpecies('drug', **species['drug'])
+        model_parameters = {'drug_diffusion': config.getfloat("ModelParametersSection", "drug_diffusion")}
+        self.assertEqual(drug.coefficient('diffusion', model_parameters), 1.5)
+        self.assertEqual(drug.coefficient('decay', model_parameters), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -79,6 +79,7 @@ class EventPerformsTestCase(unittest.TestCase):
         self.automaton.grid[(3, 8)]['contents'].intracellular_bacteria = 7
         self.automaton.grid[(4, 8)]['contents'].state = 'chronically_infected'
         self.automaton.grid[(4, 8)]['contents'].intracellular_bacteria = 19
+        self.automaton.rebuild_presence_masks()
 
     def tearDown(self):
         # Close output files and delete
@@ -309,6 +310,48 @@ class EventPerformsTestCase(unittest.TestCase):
 
         self.assertEqual(self.automaton.work_grid[(4,9)]['contents'], 0.0)
 
+    def test_presence_masks_maintained(self):
+        events = [BacteriumReplication((8, 1), (7, 1), 'fast'),
+                  MacrophageIngestsBacterium((1, 8), (8, 2)),
+                  MacrophageMovement((2, 8), (2, 7)),
+                  MacrophageActivation((3, 8), 'resting'),
+                  MacrophageBursts((4, 8), [(5, 8), (4, 9)]),
+                  ChemoKillBacterium((8, 1))]
+        for event in events:
+            event.perform_event(self.automaton)
+        self.assertEqual(self.automaton.bacteria_mask[(7, 1)], 1)
+        self.assertEqual(self.automaton.non_resting_macrophage_mask[(8, 2)], 1)
+        self.assertEqual(self.automaton.non_resting_macrophage_mask[(2, 7)], 1)
+
+        # Same as recalculating from the agents
+        bacteria_mask = self.automaton.bacteria_mask.copy()
+        non_resting_macrophage_mask = self.automaton.non_resting_macrophage_mask.copy()
+        self.automaton.rebuild_presence_masks()
+        self.assertTrue(np.array_equal(bacteria_mask, self.automaton.bacteria_mask))
+        self.assertTrue(np.array_equal(non_resting_macrophage_mask, self.automaton.non_resting_macrophage_mask))
+
+    def test_free_mask_maintained(self):
+        # Agents added straight to the grid are picked up
+        self.automaton.update_free_mask()
+        self.assertFalse(self.automaton.free_mask[(5, 5)])
+        events = [BacteriumReplication((8, 1), (7, 1), 'fast'),
+                  MacrophageIngestsBacterium((1, 8), (8, 2)),
+                  MacrophageMovement((2, 8), (2, 7)),
+                  MacrophageBursts((4, 8), [(5, 8), (4, 9)]),
+                  ChemoKillBacterium((8, 1)),
+                  TCellMovement((5, 5), (6, 6))]
+        for event in events:
+            event.perform_event(self.automaton)
+        self.automaton.swap_grids()
+        self.assertTrue(self.automaton.free_mask[(5, 5)])
+        self.assertFalse(self.automaton.free_mask[(6, 6)])
+        self.assertFalse(self.automaton.free_mask[(7, 1)])
+
+        # Same as recalculating from the grid
+        free_mask = self.automaton.free_mask.copy()
+        self.automaton.rebuild_free_mask()
+        self.assertTrue(np.array_equal(free_mask, self.automaton.free_mask))
+
 
 if __name__ == '__main__':
     unittest.main()